@@ -0,0 +1,229 @@
+import os
+import json
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Headless batch runner: ingestion -> merge -> taxonomy table -> diversity -> tests -> figures.
+# Nothing here imports Qt. Figures are rendered with the Agg backend, so the pipeline runs
+# on compute nodes without a display.
+#
+# Layout of the input directory:
+#   input/                  one study: MEGAN export files (*.txt, *.tsv, *.csv) directly in it, or
+#   input/<study>/          several studies: one sub-directory of export files per study
+# Every export file is one sample, named after the file without its last extension.
+# The metadata is a tab-delimited file with the columns SampleID, Group and (optionally) Property.
+# A metadata.tsv inside a study directory is used instead of the shared one.
+#
+# Results of a study go to output/<study>/, a summary of all studies to output/summary.json.
+
+EXPORT_EXTENSIONS = (".txt", ".tsv", ".csv")
+METADATA_FILE = "metadata.tsv"
+SUMMARY_FILE = "summary.json"
+
+DEFAULT_OPTIONS = {
+    "tests": ["t_test", "kruskal"],
+    "correction": "fdr_bh",
+    "alpha": 0.05,
+    "metric": "braycurtis",
+    "permutations": 999,
+    "seed": 0,
+    "rank": "Phylum",
+    "top": 5,
+    "figures": True,
+}
+
+
+class FigureFile:
+    # Off-screen canvas with the attributes the plot functions of the analyzer use (axes, figure, draw)
+    def __init__(self, width=8, height=6, dpi=100):
+        self.figure = Figure(figsize=(width, height), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(111)
+
+    def draw(self):
+        self.canvas.draw()
+
+    def save(self, path):
+        self.figure.savefig(path)
+
+
+def find_studies(input_dir):
+    # {study name: directory}. The input directory itself is the only study if it holds export files.
+    if _export_files(input_dir):
+        return {os.path.basename(os.path.normpath(input_dir)): input_dir}
+    studies = {}
+    for name in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, name)
+        if os.path.isdir(path) and _export_files(path):
+            studies[name] = path
+    return studies
+
+
+def read_metadata(path):
+    metadata = pd.read_csv(path, sep="\t", dtype=str)
+    missing = {"SampleID", "Group"} - set(metadata.columns)
+    if missing:
+        raise ValueError(f"{path}: missing metadata columns {', '.join(sorted(missing))}")
+    if "Property" not in metadata.columns:
+        metadata["Property"] = ""
+    return metadata
+
+
+def load_study(study_dir, metadata_path=None):
+    """
+        Reads the MEGAN exports of a study and builds its analyzer.
+
+        Returns
+        -------
+        MicrobiomeDataAnalyzer
+        """
+    from Model.modificator import dataset_modifier, merge_data, split_comparison
+    from Model.microbiome_class import MicrobiomeDataAnalyzer
+
+    datasets = []
+    for path in _export_files(study_dir):
+        with open(path, encoding="utf-8") as handle:
+            name = os.path.splitext(os.path.basename(path))[0]
+            dataset = dataset_modifier(handle.read(), name)
+        if dataset is None:
+            raise ValueError(f"{path} is not a MEGAN export (Taxa, weight, reads)")
+        datasets.append(dataset)
+    otu_mat, taxids, tax_mat = split_comparison(merge_data(datasets))
+
+    study_metadata = os.path.join(study_dir, METADATA_FILE)
+    if os.path.exists(study_metadata):
+        metadata_path = study_metadata
+    if metadata_path is None:
+        raise ValueError(f"No metadata for {study_dir}")
+    metadata = read_metadata(metadata_path)
+    metadata = metadata[metadata["SampleID"].isin(otu_mat.columns)].reset_index(drop=True)
+    return MicrobiomeDataAnalyzer(otu_mat, tax_mat, metadata, taxids=taxids)
+
+
+def run_study(name, study_dir, metadata_path, output_dir, options=None):
+    """
+        Runs the whole analysis of one study and writes its results to output_dir/name.
+
+        Written files: alpha_diversity.csv, differential_abundance_<test>.csv, pcoa.csv,
+        <rank>_abundance.csv, results.json and (with figures) top_taxa.png, rank.png, pcoa.png.
+        results.json includes the stage timings and counters of Model.instrumentation.
+
+        Returns
+        -------
+        dict
+            Summary of the study, the same as results.json.
+        """
+    from Model import instrumentation
+
+    options = {**DEFAULT_OPTIONS, **(options or {})}
+    # Worker processes run one study at a time, so the timings of the registry belong to this study
+    instrumentation.registry.reset()
+    study_output = os.path.join(output_dir, name)
+    os.makedirs(study_output, exist_ok=True)
+
+    analyzer = load_study(study_dir, metadata_path)
+    groups = analyzer.Metadata["Group"].nunique()
+    summary = {
+        "study": name,
+        "samples": int(analyzer.OTU_table.shape[1]),
+        "otus": int(analyzer.OTU_table.shape[0]),
+        "groups": int(groups),
+        "tests": {},
+        "errors": {},
+        "unresolved_taxids": [int(taxid) for taxid in analyzer.Taxa_table.attrs.get("unresolved", [])],
+        "merged_taxids": {str(old): int(new) for old, new in analyzer.Taxa_table.attrs.get("merged", {}).items()},
+    }
+
+    analyzer.alpha_diversity().to_csv(os.path.join(study_output, "alpha_diversity.csv"))
+    analyzer.rank_cube().rank_sums(options["rank"]).to_csv(
+        os.path.join(study_output, f"{options['rank']}_abundance.csv"))
+
+    if groups >= 2:
+        for test in options["tests"]:
+            try:
+                result = analyzer.differential_abundance(test, options["correction"], options["alpha"])
+            except ValueError as error:
+                summary["errors"][test] = str(error)
+                continue
+            result.to_csv(os.path.join(study_output, f"differential_abundance_{test}.csv"))
+            summary["tests"][test] = {"tested": int(len(result)), "significant": int(result["significant"].sum())}
+        try:
+            # Studies already run in parallel processes, so the permutations stay in this one
+            permanova = analyzer.permanova(options["metric"], options["permutations"], seed=options["seed"], workers=1)
+            summary["permanova"] = {key: _plain(value) for key, value in permanova.items()}
+        except ValueError as error:
+            summary["errors"]["permanova"] = str(error)
+
+    pcoa_samples = analyzer.pcoa_samples()
+    pcoa_samples.to_csv(os.path.join(study_output, "pcoa.csv"))
+
+    if options["figures"]:
+        for file_name, plot in (("top_taxa.png", lambda canvas: analyzer.plot_top(options["top"], canvas)),
+                                ("rank.png", lambda canvas: analyzer.plot_rank(options["rank"], canvas)),
+                                ("pcoa.png", lambda canvas: analyzer.plot_pcoa(canvas, pcoa_samples))):
+            canvas = FigureFile()
+            plot(canvas)
+            canvas.save(os.path.join(study_output, file_name))
+
+    diagnostics = instrumentation.registry.snapshot()
+    summary["timings"] = {name: stage["seconds"] for name, stage in diagnostics["stages"].items()}
+    summary["counters"] = diagnostics["counters"]
+    with open(os.path.join(study_output, "results.json"), "w", encoding="utf-8") as handle:
+        json.dump(summary, handle, indent=2)
+    return summary
+
+
+def run_pipeline(input_dir, metadata_path, output_dir, options=None, workers=None):
+    """
+        Runs run_study() for every study of the input directory on a process pool.
+
+        A failing study does not stop the others: its error is recorded in the summary.
+
+        Returns
+        -------
+        list
+            Summaries of all studies, also written to output_dir/summary.json.
+        """
+    studies = find_studies(input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, max(1, len(studies)))
+
+    summaries = []
+    # 'spawn' gives every worker its own taxonomy database connection (SQLite handles do not survive fork)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {name: pool.submit(_run_study_safely, name, path, metadata_path, output_dir, options)
+                   for name, path in studies.items()}
+        for name, future in futures.items():
+            summaries.append(future.result())
+
+    with open(os.path.join(output_dir, SUMMARY_FILE), "w", encoding="utf-8") as handle:
+        json.dump(summaries, handle, indent=2)
+    return summaries
+
+
+def _run_study_safely(name, study_dir, metadata_path, output_dir, options):
+    try:
+        return run_study(name, study_dir, metadata_path, output_dir, options)
+    except Exception as error:
+        return {"study": name, "failed": f"{type(error).__name__}: {error}",
+                "traceback": traceback.format_exc()}
+
+
+# Helper function. Export files of a directory, sorted by name.
+def _export_files(directory):
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.lower().endswith(EXPORT_EXTENSIONS) and name != METADATA_FILE
+            and os.path.isfile(os.path.join(directory, name))]
+
+
+# Helper function. NumPy scalars as plain Python values for JSON.
+def _plain(value):
+    return value.item() if isinstance(value, np.generic) else value
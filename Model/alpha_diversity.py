@@ -0,0 +1,188 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+
+from Model.sparse_counts import count_matrix
+
+# Alpha diversity of every sample of an OTU table.
+# Empty cells count as 0 reads.
+#
+# Supported metrics:
+#   observed    number of OTUs with reads
+#   shannon     -sum(p * ln(p)) of the relative abundances p
+#   simpson     1 - sum(p^2)
+#   chao1       observed + F1 * (F1 - 1) / (2 * (F2 + 1)), F1/F2 = OTUs with exactly 1/2 reads (bias-corrected)
+#   pielou      shannon / ln(observed)
+# All metrics are computed together from the non-zero counts and their sample (column) numbers,
+# so every count is touched once and sparse tables are never densified.
+#
+# Rarefaction only draws from the OTUs a sample has reads of: the rarefied counts of a block of
+# samples and iterations are a sparse (OTUs x iterations*samples) matrix.
+
+METRICS = ("observed", "shannon", "simpson", "chao1", "pielou")
+# Largest number of rarefied counts in one block (iterations x non-zero OTUs of the block's samples)
+BLOCK_ELEMENTS = 1_000_000
+# Number of threads used for rarefaction
+WORKERS = os.cpu_count() or 1
+
+
+def alpha_diversity(otu_table):
+    """
+        All alpha-diversity metrics of every sample.
+
+        Parameters
+        ----------
+        otu_table : pandas.DataFrame
+            Rows: OTUs, columns: samples. Dense or sparse.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Rows: samples, columns: METRICS.
+        """
+    values = _diversity(count_matrix(otu_table))
+    return pd.DataFrame(values, index=otu_table.columns, columns=list(METRICS))
+
+
+def rarefy(otu_table, depth, iterations=1, seed=None):
+    """
+        Subsamples every sample to depth reads.
+
+        The reads are drawn with replacement (multinomial) from the relative abundances,
+        for all samples and iterations in one call. Samples with fewer than depth reads are left out.
+
+        Returns
+        -------
+        tuple
+            (rarefied counts as an (iterations x kept samples x OTUs) array, labels of the kept samples)
+        """
+    counts = count_matrix(otu_table)
+    totals = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    kept = np.flatnonzero(totals >= depth)
+    rng = np.random.default_rng(seed)
+    probabilities = _probabilities(counts, totals, kept)
+    rarefied = _subsample(probabilities, np.arange(len(kept)), depth, iterations, rng)
+    rarefied = rarefied.toarray().T.reshape(iterations, len(kept), counts.shape[0])
+    return rarefied, otu_table.columns[kept]
+
+
+def rarefied_diversity(otu_table, depth, iterations=10, seed=None):
+    """
+        Mean alpha diversity of iterations rarefactions of every sample to depth reads.
+
+        The samples and iterations are split into blocks of at most BLOCK_ELEMENTS rarefied counts,
+        which are subsampled on a thread pool. Every block has its own child of the seed, so the result
+        does not depend on the number of threads.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Rows: samples, columns: METRICS. NaN for samples with fewer than depth reads.
+        """
+    counts = count_matrix(otu_table)
+    totals = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    kept = np.flatnonzero(totals >= depth)
+    result = pd.DataFrame(np.nan, index=otu_table.columns, columns=list(METRICS))
+    if len(kept) == 0 or depth <= 0:
+        return result
+
+    # The probabilities of all samples are computed once, the blocks only draw from them
+    probabilities = _probabilities(counts, totals, kept)
+    num_otus = np.diff(probabilities.indptr)
+    block_iterations = int(min(iterations, max(1, BLOCK_ELEMENTS // max(1, num_otus.max()))))
+    sizes = [min(block_iterations, iterations - start) for start in range(0, iterations, block_iterations)]
+    sample_blocks = _sample_blocks(num_otus * block_iterations)
+    blocks = [(samples, size) for size in sizes for samples in sample_blocks]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+
+    def block_sum(block):
+        seed_sequence, (samples, size) = block
+        rarefied = _subsample(probabilities, samples, depth, size, np.random.default_rng(seed_sequence))
+        values = _diversity(rarefied).reshape(size, len(samples), len(METRICS))
+        return samples, np.nansum(values, axis=0), (~np.isnan(values)).sum(axis=0)
+
+    sums = np.zeros((len(kept), len(METRICS)))
+    valid = np.zeros((len(kept), len(METRICS)))
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for samples, block_sums, block_valid in pool.map(block_sum, zip(seeds, blocks)):
+            sums[samples] += block_sums
+            valid[samples] += block_valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result.iloc[kept] = sums / valid
+    return result
+
+
+def rarefaction_depths(otu_table, steps=10):
+    # Evenly spaced depths from 1 read to the largest sample
+    totals = np.asarray(count_matrix(otu_table).sum(axis=0)).ravel()
+    largest = int(totals.max()) if len(totals) else 0
+    return np.unique(np.linspace(1, max(largest, 1), steps).astype(int))
+
+
+# Helper function. Relative abundances of the kept samples as a sparse (OTUs x kept samples) CSC matrix.
+def _probabilities(counts, totals, kept):
+    probabilities = sparse.csc_matrix(counts[:, kept], dtype=np.float64)
+    probabilities.eliminate_zeros()
+    probabilities.data /= np.repeat(totals[kept], np.diff(probabilities.indptr))
+    return probabilities
+
+
+# Helper function. Consecutive samples grouped so that the sizes of a group add up to at most BLOCK_ELEMENTS.
+# A sample larger than that is a group of its own.
+def _sample_blocks(sizes):
+    blocks, start, total = [], 0, 0
+    for sample, size in enumerate(sizes):
+        if sample > start and total + size > BLOCK_ELEMENTS:
+            blocks.append(np.arange(start, sample))
+            start, total = sample, 0
+        total += size
+    if len(sizes):
+        blocks.append(np.arange(start, len(sizes)))
+    return blocks
+
+
+# Helper function. Rarefied counts of some columns of the probabilities as a sparse (OTUs x iterations*samples)
+# CSC matrix, iteration by iteration. Only the OTUs with reads in a sample are drawn.
+def _subsample(probabilities, samples, depth, iterations, rng):
+    starts, ends = probabilities.indptr[samples], probabilities.indptr[np.asarray(samples) + 1]
+    offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+    draws = np.empty((iterations, offsets[-1]), dtype=np.int32)
+    for position, (start, end) in enumerate(zip(starts, ends)):
+        draws[:, offsets[position]:offsets[position + 1]] = rng.multinomial(
+            int(depth), probabilities.data[start:end], size=iterations)
+    indices = np.concatenate([probabilities.indices[start:end] for start, end in zip(starts, ends)] or [[]])
+    indptr = np.concatenate([[0], np.cumsum(np.tile(ends - starts, iterations))])
+    return sparse.csc_matrix((draws.ravel(), np.tile(indices.astype(np.int32), iterations), indptr),
+                             shape=(probabilities.shape[0], iterations * len(samples)))
+
+
+# Helper function. (samples x METRICS) array of a (OTUs x samples) count matrix.
+def _diversity(counts):
+    num_samples = counts.shape[1]
+    if sparse.issparse(counts):
+        counts = sparse.csc_matrix(counts)
+        counts.eliminate_zeros()
+        values = counts.data.astype(np.float64)
+        samples = np.repeat(np.arange(num_samples), np.diff(counts.indptr))
+    else:
+        rows, samples = np.nonzero(counts)
+        values = np.asarray(counts[rows, samples], dtype=np.float64)
+
+    def per_sample(weights=None):
+        return np.bincount(samples, weights=weights, minlength=num_samples).astype(np.float64)
+
+    totals = per_sample(values)
+    observed = per_sample()
+    singletons = per_sample(values == 1)
+    doubletons = per_sample(values == 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = values / totals[samples]
+        shannon = -per_sample(shares * np.log(shares))
+        simpson = 1.0 - per_sample(shares ** 2)
+        chao1 = observed + singletons * (singletons - 1) / (2.0 * (doubletons + 1))
+        pielou = np.where(observed > 1, shannon / np.log(observed), np.nan)
+    empty = totals == 0
+    shannon[empty] = simpson[empty] = np.nan
+    return np.column_stack([observed, shannon, simpson, chao1, pielou])
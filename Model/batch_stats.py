@@ -0,0 +1,359 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from Model.sparse_counts import count_matrix, is_sparse
+
+# Batched versions of the per-OTU tests of MicrobiomeDataAnalyzer.
+# Samples are split by group once into NumPy arrays with one row per OTU and one column per sample.
+# Every test then works on whole arrays along axis 1, so all OTUs are tested with a single call.
+# Missing values (NaN) are left out per OTU, the same way the per-column dropna() did. The Wilcoxon
+# test also drops them before pairing the samples by position (see _paired_differences).
+# Sparse OTU tables give sparse group matrices. They are densified BLOCK_ROWS OTUs at a time, so the
+# whole table is never dense in memory. The empty cells of a block become NaN again, so the tests give
+# the same results for sparse and dense storage of the same table.
+# scipy.stats is imported inside the tests only, because importing it takes long.
+
+# Number of OTUs densified at once when the groups are sparse matrices
+BLOCK_ROWS = 4096
+
+# Tests available for differential abundance. Name: function taking the list of group arrays.
+# Filled at the end of the module.
+TESTS = {}
+
+# Largest number of pairs for which the exact distribution of the Wilcoxon statistic is used
+WILCOXON_EXACT_LIMIT = 50
+# Largest number of pairs with ties or zeros for which all sign flips are enumerated (2^13 outcomes)
+WILCOXON_PERMUTATION_LIMIT = 13
+# Number of OTUs whose sign flips are enumerated at once, limits the memory use
+PERMUTATION_CHUNK = 1000
+
+
+def split_groups(otu_table, metadata):
+    """
+        Splits the samples of the OTU table by the 'Group' column of the metadata.
+
+        Parameters
+        ----------
+        otu_table : pandas.DataFrame
+            Rows: OTUs, columns: samples.
+        metadata : pandas.DataFrame
+            Must contain the columns 'SampleID' and 'Group'.
+
+        Returns
+        -------
+        tuple
+            (group_names, arrays) where arrays[i] is a float64 array of shape
+            (number of OTUs, number of samples in group_names[i]).
+            For sparse OTU tables the arrays are scipy.sparse CSR matrices.
+        """
+    sample_groups = metadata.set_index('SampleID')['Group']
+    samples = [sample for sample in otu_table.columns if sample in sample_groups.index]
+    groups = sample_groups.loc[samples].to_numpy()
+    group_names = pd.unique(groups)
+    # One copy of the whole table, the groups are column selections of it
+    if is_sparse(otu_table):
+        values = count_matrix(otu_table[samples]).tocsc()
+        arrays = [values[:, np.flatnonzero(groups == name)].tocsr() for name in group_names]
+    else:
+        values = otu_table[samples].to_numpy(dtype=np.float64)
+        arrays = [values[:, groups == name] for name in group_names]
+    return list(group_names), arrays
+
+
+# Helper function. Calls function(group_arrays, *args) on dense arrays.
+# Sparse groups are densified BLOCK_ROWS OTUs at a time and the results are concatenated.
+def _blockwise(function, group_arrays, *args):
+    if not any(sparse.issparse(group) for group in group_arrays):
+        return function(group_arrays, *args)
+    num_rows = group_arrays[0].shape[0]
+    parts = []
+    for start in range(0, num_rows, BLOCK_ROWS):
+        block = [_densify(group[start:start + BLOCK_ROWS]) for group in group_arrays]
+        parts.append(function(block, *args))
+    if not parts:
+        parts.append(function([np.empty((0, group.shape[1])) for group in group_arrays], *args))
+    if isinstance(parts[0], tuple):
+        return tuple(np.concatenate(values) for values in zip(*parts))
+    return np.concatenate(parts)
+
+
+# Helper function. Dense float64 copy of a sparse matrix with NaN in the empty cells.
+def _densify(matrix):
+    coo = matrix.tocoo()
+    dense = np.full(matrix.shape, np.nan)
+    dense[coo.row, coo.col] = coo.data
+    return dense
+
+
+def prefilter(otu_table, min_prevalence=2, min_abundance=0.0):
+    """
+        Selects the OTUs worth testing.
+
+        Parameters
+        ----------
+        otu_table : pandas.DataFrame
+            Rows: OTUs, columns: samples. Empty cells (NaN) count as absent.
+        min_prevalence : int
+            Minimal number of samples in which the OTU has a positive read count.
+        min_abundance : float
+            Minimal total read count of the OTU over all samples.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean mask over the rows of the OTU table.
+        """
+    values = count_matrix(otu_table)
+    prevalence = np.asarray((values > 0).sum(axis=1)).ravel()
+    abundance = np.asarray(values.sum(axis=1)).ravel()
+    return (prevalence >= min_prevalence) & (abundance >= min_abundance)
+
+
+def testable(test, group_arrays, alpha=None):
+    """
+        Boolean mask of the OTUs for which the test can produce a significant result.
+
+        OTUs with an empty group or with the same value in every sample are left out.
+        For the Wilcoxon test the smallest possible p-value with n pairs is 2 / 2^n,
+        so OTUs with too few pairs to ever reach alpha are left out as well.
+        """
+    return _blockwise(_testable, group_arrays, test, alpha)
+
+
+def _testable(group_arrays, test, alpha):
+    values = np.hstack(group_arrays)
+    with np.errstate(invalid='ignore'):
+        constant = ~(np.nanmax(values, axis=1) > np.nanmin(values, axis=1))
+    empty_group = np.stack([np.isnan(group).all(axis=1) for group in group_arrays]).any(axis=0)
+    mask = ~constant & ~empty_group
+    if test == 'wilcoxon' and alpha is not None and len(group_arrays) == 2:
+        differences = _paired_differences(*group_arrays)
+        n = (np.nan_to_num(differences) != 0).sum(axis=1)
+        mask &= 2.0 / 2.0 ** n <= alpha
+    return mask
+
+
+def adjust_pvalues(p_values, method='fdr_bh'):
+    """
+        Corrects p-values for multiple testing. NaN p-values are ignored and stay NaN.
+
+        Parameters
+        ----------
+        p_values : array-like
+        method : str
+            'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or 'none'.
+
+        Returns
+        -------
+        numpy.ndarray
+            Adjusted p-values (q-values) in the order of the input.
+        """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = ~np.isnan(p_values)
+    p = p_values[valid]
+    m = len(p)
+    if method == 'none':
+        adjusted[valid] = p
+    elif method == 'bonferroni':
+        adjusted[valid] = np.minimum(1.0, p * m)
+    elif method == 'fdr_bh':
+        order = np.argsort(p)
+        # p * m / rank, then the running minimum from the largest p-value down
+        scaled = p[order] * m / np.arange(1, m + 1)
+        q = np.minimum.accumulate(scaled[::-1])[::-1]
+        result = np.empty(m)
+        result[order] = np.minimum(1.0, q)
+        adjusted[valid] = result
+    else:
+        raise ValueError(f"Unknown correction method: {method}")
+    return adjusted
+
+
+def results_frame(index, statistic, p_value):
+    # Tidy result table: one row per OTU
+    return pd.DataFrame({'statistic': statistic, 'pvalue': p_value}, index=index)
+
+
+# Helper function. Number of values, sum and sum of squared deviations per row, ignoring NaN.
+def _moments(values):
+    mask = ~np.isnan(values)
+    n = mask.sum(axis=1)
+    total = np.where(mask, values, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+    deviations = np.where(mask, values - mean[:, None], 0.0)
+    return n, mean, (deviations ** 2).sum(axis=1)
+
+
+def t_test(group_arrays):
+    return _blockwise(_t_test, group_arrays)
+
+
+def _t_test(group_arrays):
+    # Independent two-sample t-test with pooled variance (same as scipy.stats.ttest_ind)
+    from scipy import stats
+    if len(group_arrays) != 2:
+        raise ValueError("There must be exactly two groups for the t-test.")
+    n1, mean1, ss1 = _moments(group_arrays[0])
+    n2, mean2, ss2 = _moments(group_arrays[1])
+    df = n1 + n2 - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled_var = (ss1 + ss2) / df
+        t_stat = (mean1 - mean2) / np.sqrt(pooled_var * (1.0 / n1 + 1.0 / n2))
+        p_value = 2 * stats.t.sf(np.abs(t_stat), df)
+    return t_stat, p_value
+
+
+def anova(group_arrays):
+    return _blockwise(_anova, group_arrays)
+
+
+def _anova(group_arrays):
+    # One-way ANOVA (same as scipy.stats.f_oneway)
+    from scipy import stats
+    moments = [_moments(values) for values in group_arrays]
+    n = np.stack([m[0] for m in moments])
+    means = np.stack([m[1] for m in moments])
+    ss_within = np.sum([m[2] for m in moments], axis=0)
+    total_n = n.sum(axis=0)
+    num_groups = len(group_arrays)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grand_mean = np.nansum(n * means, axis=0) / total_n
+        ss_between = np.nansum(n * (means - grand_mean) ** 2, axis=0)
+        df_between = num_groups - 1
+        df_within = total_n - num_groups
+        f_value = (ss_between / df_between) / (ss_within / df_within)
+        p_value = stats.f.sf(f_value, df_between, df_within)
+    # A group without any value makes the test undefined
+    undefined = (n == 0).any(axis=0)
+    f_value[undefined] = np.nan
+    p_value[undefined] = np.nan
+    return f_value, p_value
+
+
+# Helper function. Ranks every row, ignoring NaN.
+# Returns the average ranks and the tie term sum(t^3 - t) of every row.
+def _rank_rows(values):
+    from scipy import stats
+    mask = ~np.isnan(values)
+    # NaN is replaced by infinity, so it is ranked after every real value and does not change their ranks
+    filled = np.where(mask, values, np.inf)
+    ranks = stats.rankdata(filled, axis=1)
+    # A value tied with t values has max rank - min rank = t - 1. Summing t^2 - 1 over the values gives sum(t^3 - t)
+    tie_size = stats.rankdata(filled, method='max', axis=1) - stats.rankdata(filled, method='min', axis=1) + 1
+    ties = np.where(mask, tie_size ** 2 - 1, 0).sum(axis=1)
+    return np.where(mask, ranks, 0.0), ties
+
+
+def kruskal(group_arrays):
+    return _blockwise(_kruskal, group_arrays)
+
+
+def _kruskal(group_arrays):
+    # Kruskal-Wallis H-test with tie correction (same as scipy.stats.kruskal)
+    from scipy import stats
+    values = np.hstack(group_arrays)
+    ranks, ties = _rank_rows(values)
+    bounds = np.cumsum([0] + [group.shape[1] for group in group_arrays])
+    rank_sums = np.stack([ranks[:, start:end].sum(axis=1) for start, end in zip(bounds[:-1], bounds[1:])])
+    n = np.stack([(~np.isnan(group)).sum(axis=1) for group in group_arrays])
+    total_n = n.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        h_stat = 12.0 / (total_n * (total_n + 1)) * (rank_sums ** 2 / n).sum(axis=0) - 3 * (total_n + 1)
+        h_stat /= 1 - ties / (total_n ** 3 - total_n)
+        p_value = stats.chi2.sf(h_stat, len(group_arrays) - 1)
+    undefined = (n == 0).any(axis=0)
+    h_stat[undefined] = np.nan
+    p_value[undefined] = np.nan
+    return h_stat, p_value
+
+
+# Helper function. Exact null distribution of the Wilcoxon signed-rank statistic for n pairs.
+# Returns the cumulative probabilities P(W <= w) for w = 0 ... n(n+1)/2.
+def _wilcoxon_exact_cdf(n):
+    counts = np.zeros(n * (n + 1) // 2 + 1)
+    counts[0] = 1
+    for rank in range(1, n + 1):
+        counts[rank:] = counts[rank:] + counts[:-rank]
+    return np.cumsum(counts) / 2.0 ** n
+
+
+# Helper function. Two-sided p-values of the signed-rank statistic by enumerating all sign flips.
+# Used for small samples with ties or zeros, where the exact distribution does not apply.
+def _wilcoxon_permutation_pvalue(ranks, positive, n):
+    # Keep only the ranks of the non-zero differences, packed to the left
+    compact = -np.sort(-ranks, axis=1)[:, :n]
+    signs = (np.arange(2 ** n)[:, None] >> np.arange(n)) & 1
+    p_value = np.empty(len(ranks))
+    for start in range(0, len(ranks), PERMUTATION_CHUNK):
+        distribution = compact[start:start + PERMUTATION_CHUNK] @ signs.T
+        observed = positive[start:start + PERMUTATION_CHUNK, None]
+        less = (distribution <= observed + 1e-9).mean(axis=1)
+        greater = (distribution >= observed - 1e-9).mean(axis=1)
+        p_value[start:start + PERMUTATION_CHUNK] = np.minimum(1.0, 2 * np.minimum(less, greater))
+    return p_value
+
+
+def wilcoxon(group_arrays):
+    return _blockwise(_wilcoxon, group_arrays)
+
+
+# Helper function. Differences of the pairs of the Wilcoxon test, NaN where a row has no pair.
+# As in the per-OTU test, the missing values of every group are dropped first and the remaining values
+# are paired by position, up to the length of the shorter group.
+def _paired_differences(group1, group2):
+    num_pairs = min(group1.shape[1], group2.shape[1])
+    present1, present2 = ~np.isnan(group1), ~np.isnan(group2)
+    # A stable sort moves the values to the left, in their order, and the NaN to the right
+    values1 = np.take_along_axis(group1, np.argsort(~present1, axis=1, kind='stable'), axis=1)[:, :num_pairs]
+    values2 = np.take_along_axis(group2, np.argsort(~present2, axis=1, kind='stable'), axis=1)[:, :num_pairs]
+    row_pairs = np.minimum(present1.sum(axis=1), present2.sum(axis=1))
+    differences = values1 - values2
+    differences[np.arange(num_pairs)[None, :] >= row_pairs[:, None]] = np.nan
+    return differences
+
+
+def _wilcoxon(group_arrays):
+    # Wilcoxon signed-rank test for two paired groups (same as scipy.stats.wilcoxon).
+    # Samples are paired by their position inside each group (see _paired_differences). Zero differences are dropped.
+    from scipy import stats
+    if len(group_arrays) != 2:
+        raise ValueError("There must be exactly two groups for the Wilcoxon signed-rank test.")
+    differences = _paired_differences(*group_arrays)
+    # Zero differences are counted but not ranked
+    pairs = (~np.isnan(differences)).sum(axis=1)
+    zeros = (differences == 0).sum(axis=1)
+    differences[differences == 0] = np.nan
+    ranks, ties = _rank_rows(np.abs(differences))
+    n = (~np.isnan(differences)).sum(axis=1)
+    positive = np.where(differences > 0, ranks, 0.0).sum(axis=1)
+    negative = np.where(differences < 0, ranks, 0.0).sum(axis=1)
+    w_stat = np.minimum(positive, negative)
+
+    # Normal approximation
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = n * (n + 1) / 4.0
+        std = np.sqrt(n * (n + 1) * (2 * n + 1) / 24.0 - ties / 48.0)
+        p_value = 2 * stats.norm.sf(np.abs(positive - mean) / std)
+
+    # Exact distribution for small samples without ties or zeros
+    exact = (ties == 0) & (zeros == 0) & (n > 0) & (n <= WILCOXON_EXACT_LIMIT)
+    for size in np.unique(n[exact]):
+        rows = exact & (n == size)
+        cdf = _wilcoxon_exact_cdf(size)
+        p_value[rows] = np.minimum(1.0, 2 * cdf[w_stat[rows].astype(int)])
+
+    # All sign flips for very small samples with ties or zeros
+    permutation = ~exact & (n > 0) & (pairs <= WILCOXON_PERMUTATION_LIMIT)
+    for size in np.unique(n[permutation]):
+        rows = permutation & (n == size)
+        p_value[rows] = _wilcoxon_permutation_pvalue(ranks[rows], positive[rows], size)
+
+    w_stat[n == 0] = np.nan
+    p_value[n == 0] = np.nan
+    return w_stat, p_value
+
+
+TESTS.update({'t_test': t_test, 'anova': anova, 'kruskal': kruskal, 'wilcoxon': wilcoxon})
@@ -0,0 +1,52 @@
+# Which cached results are computed from which data.
+#
+# When data changes, stale() lists every result that depends on it, directly or through other
+# results, in an order where every result comes after the results it is computed from.
+# Results that do not depend on the changed data stay valid and are not recomputed.
+
+
+class DependencyGraph:
+    """
+        Dependencies between named data and results.
+
+        Parameters
+        ----------
+        dependencies : dict, optional
+            {result: names of the data or results it is computed from}
+        """
+
+    def __init__(self, dependencies=None):
+        self._dependencies = {}
+        for name, sources in (dependencies or {}).items():
+            self.add(name, sources)
+
+    def add(self, name, sources):
+        self._dependencies[name] = tuple(sources)
+
+    def sources(self, name):
+        return self._dependencies.get(name, ())
+
+    def dependents(self, name):
+        # Results computed directly from name
+        return [result for result, sources in self._dependencies.items() if name in sources]
+
+    def stale(self, changed):
+        # All results that depend on one of the changed names, sources before dependents
+        stale = set()
+        pending = list(changed)
+        while pending:
+            for result in self.dependents(pending.pop()):
+                if result not in stale:
+                    stale.add(result)
+                    pending.append(result)
+        ordered = []
+
+        def visit(name):
+            if name in stale and name not in ordered:
+                for source in self.sources(name):
+                    visit(source)
+                ordered.append(name)
+
+        for name in self._dependencies:
+            visit(name)
+        return ordered
@@ -0,0 +1,295 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+
+from Model.sparse_counts import count_matrix, is_sparse
+
+# Beta-diversity distances between the samples of an OTU table.
+# Empty cells count as 0 reads, so taxa missing in some samples are kept.
+#
+# Supported metrics:
+#   braycurtis          1 - 2 * sum(min(a, b)) / (sum(a) + sum(b))
+#   jaccard             1 - shared taxa / taxa present in either sample
+#   aitchison           euclidean distance of the clr-transformed counts (pseudocount 1)
+#   weighted_unifrac    sum over the branches of |share of a - share of b| (not normalized)
+#   unweighted_unifrac  unique branches / branches present in either sample
+# UniFrac uses the taxonomy as the tree: every assigned rank of a lineage and the OTU itself
+# is a branch of length 1.
+#
+# The heavy part of every metric is one samples x samples product: a sum of minima
+# computed in blocks of OTUs on a thread pool (NumPy releases the GIL), or a sparse matrix product.
+#
+# Every metric can also compute only the rows of some samples (columns=...). extend_distances() uses
+# this when samples are added: the distances between the existing samples are kept, only the
+# rows of the new samples are computed.
+
+# Largest number of values in one dense block (OTUs x samples x samples)
+BLOCK_ELEMENTS = 4_000_000
+# Number of threads used for the blocks
+WORKERS = os.cpu_count() or 1
+
+
+def beta_diversity(otu_table, metric="braycurtis", taxa_table=None):
+    """
+        Distances between all samples of the OTU table.
+
+        Parameters
+        ----------
+        otu_table : pandas.DataFrame
+            Rows: OTUs, columns: samples. Dense or sparse.
+        metric : str
+            One of METRICS.
+        taxa_table : pandas.DataFrame, optional
+            Taxonomy table, required for the UniFrac metrics.
+
+        Returns
+        -------
+        skbio.DistanceMatrix
+        """
+    from skbio.stats.distance import DistanceMatrix
+
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}. Use one of {', '.join(METRICS)}.")
+    if metric in UNIFRAC_METRICS:
+        if taxa_table is None:
+            raise ValueError(f"The taxonomy table is required for {metric}.")
+        distances = METRICS[metric](otu_table, taxa_table)
+    else:
+        distances = METRICS[metric](otu_table)
+    np.fill_diagonal(distances, 0.0)
+    return DistanceMatrix(distances, ids=[str(sample) for sample in otu_table.columns], validate=False)
+
+
+def extend_distances(distance_matrix, otu_table, metric="braycurtis", taxa_table=None, otus_changed=False):
+    """
+        Distances between all samples of the OTU table, reusing the distances of a part of them.
+
+        Only the rows of the samples that are not in distance_matrix are computed. The distances
+        between the other samples do not change when samples are added, also not when the new
+        samples bring new OTUs: the existing samples have no reads of them. The exception is
+        aitchison, whose clr transformation depends on the number of OTUs; it is recomputed
+        completely when otus_changed is set.
+
+        Parameters
+        ----------
+        distance_matrix : skbio.DistanceMatrix
+            Distances between some of the samples of otu_table, computed with the same metric.
+        otu_table : pandas.DataFrame
+            All samples. Rows: OTUs, columns: samples.
+        metric : str
+        taxa_table : pandas.DataFrame, optional
+            Taxonomy table, required for the UniFrac metrics.
+        otus_changed : bool
+            True when OTUs were added since distance_matrix was computed.
+
+        Returns
+        -------
+        skbio.DistanceMatrix
+        """
+    from skbio.stats.distance import DistanceMatrix
+
+    ids = pd.Index([str(sample) for sample in otu_table.columns])
+    known = ids.get_indexer(list(distance_matrix.ids))
+    if (known < 0).any():
+        raise ValueError("The distance matrix contains samples that are not in the OTU table.")
+    added = np.setdiff1d(np.arange(len(ids)), known)
+    if metric == "aitchison" and otus_changed:
+        return beta_diversity(otu_table, metric)
+    if metric in UNIFRAC_METRICS:
+        if taxa_table is None:
+            raise ValueError(f"The taxonomy table is required for {metric}.")
+        rows = METRICS[metric](otu_table, taxa_table, columns=added)
+    else:
+        rows = METRICS[metric](otu_table, columns=added)
+
+    distances = np.zeros((len(ids), len(ids)))
+    distances[np.ix_(known, known)] = distance_matrix.data
+    distances[added, :] = rows
+    distances[:, added] = rows.T
+    np.fill_diagonal(distances, 0.0)
+    return DistanceMatrix(distances, ids=list(ids), validate=False)
+
+
+def braycurtis(otu_table, columns=None):
+    counts = count_matrix(otu_table)
+    totals = _column_sums(counts)
+    if columns is None:
+        shared, row_totals = _shared_minimum(counts), totals
+    else:
+        shared, row_totals = _cross_minimum(counts, columns), totals[columns]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1.0 - 2.0 * shared / (row_totals[:, None] + totals[None, :])
+
+
+def jaccard(otu_table, columns=None):
+    return _jaccard_presence(count_matrix(otu_table) > 0, columns)
+
+
+def aitchison(otu_table, pseudocount=1.0, columns=None):
+    counts = count_matrix(otu_table)
+    num_otus = counts.shape[0]
+    # log(x + p) = log(p) + log(1 + x / p). The constant log(p) cancels in the clr transformation,
+    # so log(1 + x / p) is used, which is 0 for empty cells and keeps a sparse table sparse.
+    if sparse.issparse(counts):
+        logs = counts.astype(np.float64)
+        logs.data = np.log1p(logs.data / pseudocount)
+    else:
+        logs = np.log1p(counts / pseudocount)
+    # clr(x) = log(x) - mean(log(x)). The Gram matrix of the clr values is derived from
+    # the Gram matrix of the logs, so the logs never have to be centered (and densified).
+    sums = _column_sums(logs)
+    left = logs if columns is None else logs[:, columns]
+    gram = left.T @ logs
+    gram = gram.toarray() if sparse.issparse(gram) else np.asarray(gram)
+    left_sums = sums if columns is None else sums[columns]
+    clr_gram = gram - np.outer(left_sums, sums) / num_otus
+    squared_logs = logs.multiply(logs) if sparse.issparse(logs) else logs ** 2
+    squared_norms = _column_sums(squared_logs) - sums ** 2 / num_otus
+    left_norms = squared_norms if columns is None else squared_norms[columns]
+    squared = left_norms[:, None] + squared_norms[None, :] - 2 * clr_gram
+    return np.sqrt(np.maximum(squared, 0.0))
+
+
+def weighted_unifrac(otu_table, taxa_table, columns=None):
+    branches = taxonomy_branches(otu_table, taxa_table)
+    counts = count_matrix(otu_table)
+    totals = _column_sums(counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(totals > 0, 1.0 / totals, 0.0)
+    # Share of the reads of every sample below every branch
+    shares = branches @ counts
+    shares = shares @ sparse.diags(scale) if sparse.issparse(shares) else shares * scale
+    share_totals = _column_sums(shares)
+    # sum |a - b| = sum(a) + sum(b) - 2 * sum(min(a, b)) for non-negative values
+    if columns is None:
+        return share_totals[:, None] + share_totals[None, :] - 2.0 * _shared_minimum(shares)
+    return share_totals[columns, None] + share_totals[None, :] - 2.0 * _cross_minimum(shares, columns)
+
+
+def unweighted_unifrac(otu_table, taxa_table, columns=None):
+    branches = taxonomy_branches(otu_table, taxa_table)
+    present = (branches @ (count_matrix(otu_table) > 0).astype(np.float64)) > 0
+    return _jaccard_presence(present, columns)
+
+
+def taxonomy_branches(otu_table, taxa_table):
+    """
+        Sparse indicator matrix (branches x OTUs) of the taxonomy tree.
+
+        Every distinct lineage prefix (for example Bacteria;Proteobacteria) is one branch.
+        Every OTU also has its own leaf branch. OTUs without taxonomy only have their leaf.
+        """
+    taxa = taxa_table.reindex(otu_table.index).astype(object)
+    num_otus = len(otu_table)
+    rows, columns = [np.arange(num_otus)], [np.arange(num_otus)]
+    num_branches = num_otus
+    prefix = pd.Series([""] * num_otus, index=taxa.index)
+    for rank in taxa.columns:
+        names = taxa[rank]
+        prefix = prefix + ";" + names.fillna("").astype(str)
+        assigned = names.notna().to_numpy()
+        codes, uniques = pd.factorize(prefix[assigned])
+        rows.append(codes + num_branches)
+        columns.append(np.flatnonzero(assigned))
+        num_branches += len(uniques)
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(num_branches, num_otus))
+
+
+def fingerprint(frame):
+    # Hash of the values and labels of a DataFrame. Used as cache key for computed results.
+    digest = hashlib.sha1()
+    digest.update(repr((list(frame.index), list(frame.columns))).encode())
+    if is_sparse(frame):
+        matrix = frame.sparse.to_coo().tocsr()
+        for part in (matrix.data, matrix.indices, matrix.indptr):
+            digest.update(np.ascontiguousarray(part).tobytes())
+    else:
+        digest.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+# Helper function. Sum of every column as a dense array.
+def _column_sums(matrix):
+    return np.asarray(matrix.sum(axis=0), dtype=np.float64).ravel()
+
+
+# Helper function. Distances 1 - |a and b| / |a or b| of a boolean (features x samples) matrix.
+# With columns, only the rows of these samples.
+def _jaccard_presence(present, columns=None):
+    present = present.astype(np.float64)
+    left = present if columns is None else present[:, columns]
+    shared = left.T @ present
+    shared = shared.toarray() if sparse.issparse(shared) else np.asarray(shared)
+    counts = _column_sums(present)
+    left_counts = counts if columns is None else counts[columns]
+    union = left_counts[:, None] + counts[None, :] - shared
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1.0 - shared / union
+
+
+# Helper function. Sum over rows of min(value in column i, value in column j) for all column pairs.
+# The rows are processed in blocks on a thread pool. Sparse blocks are densified
+# on the columns (samples) in which their rows occur only.
+def _shared_minimum(matrix):
+    num_samples = matrix.shape[1]
+    if sparse.issparse(matrix):
+        matrix = matrix.tocsr()
+    block_rows = max(1, BLOCK_ELEMENTS // max(1, num_samples ** 2))
+    starts = range(0, matrix.shape[0], block_rows)
+
+    def block_minimum(start):
+        block = matrix[start:start + block_rows]
+        if sparse.issparse(block):
+            columns = np.unique(block.indices)
+            dense = block[:, columns].toarray()
+        else:
+            columns = np.arange(num_samples)
+            dense = np.asarray(block, dtype=np.float64)
+        if len(columns) == 0:
+            return columns, None
+        return columns, np.minimum(dense[:, :, None], dense[:, None, :]).sum(axis=0)
+
+    shared = np.zeros((num_samples, num_samples))
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for columns, minimum in pool.map(block_minimum, starts):
+            if minimum is not None:
+                shared[np.ix_(columns, columns)] += minimum
+    return shared
+
+
+# Helper function. Like _shared_minimum(), but only for the pairs of the given columns with all columns:
+# (len(columns) x samples).
+def _cross_minimum(matrix, columns):
+    num_samples = matrix.shape[1]
+    columns = np.asarray(columns, dtype=np.int64)
+    if sparse.issparse(matrix):
+        matrix = matrix.tocsr()
+    block_rows = max(1, BLOCK_ELEMENTS // max(1, len(columns) * num_samples))
+    starts = range(0, matrix.shape[0], block_rows)
+
+    def block_minimum(start):
+        block = matrix[start:start + block_rows]
+        dense = block.toarray() if sparse.issparse(block) else np.asarray(block, dtype=np.float64)
+        return np.minimum(dense[:, columns, None], dense[:, None, :]).sum(axis=0)
+
+    shared = np.zeros((len(columns), num_samples))
+    if len(columns) == 0:
+        return shared
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for minimum in pool.map(block_minimum, starts):
+            shared += minimum
+    return shared
+
+
+METRICS = {
+    "braycurtis": braycurtis,
+    "jaccard": jaccard,
+    "aitchison": aitchison,
+    "weighted_unifrac": weighted_unifrac,
+    "unweighted_unifrac": unweighted_unifrac,
+}
+UNIFRAC_METRICS = ("weighted_unifrac", "unweighted_unifrac")
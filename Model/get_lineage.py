@@ -1,10 +1,78 @@
+import os
+import pickle
+import hashlib
+import warnings
+import threading
+import numpy as np
 import pandas as pd
-from ete3 import NCBITaxa
 
-ncbi = NCBITaxa()
+from Model import instrumentation
+
 #ncbi.update_taxonomy_database()
 
+# Columns of the taxonomy table
+RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+# NCBI ranks that are kept and the column of the taxonomy table they go to
+MAJOR_RANKS = {"superkingdom": 0, "domain": 0, "phylum": 1, "class": 2, "order": 3,
+               "family": 4, "genus": 5, "species": 6}
+# MEGAN uses -2 for reads that could not be assigned to any taxon
+NOT_ASSIGNED = -2
+# Where resolved lineages are kept between runs
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".statapp", "lineage_cache")
+# Number of taxids sent to SQLite in one query
+QUERY_CHUNK = 5000
+# Number of taxids named in the warning about unresolved or merged taxids
+REPORT_PREVIEW = 10
+# Offline taxonomy snapshot (see Model/taxonomy_snapshot.py), used instead of ete3 when it exists
+SNAPSHOT_DIR = os.environ.get("STATAPP_TAXONOMY", os.path.join(os.path.expanduser("~"), ".statapp", "taxonomy"))
+
+# The NCBI taxonomy database is opened on first use only (importing ete3 alone takes about a second).
+# get_ncbi() returns one shared NCBITaxa instance. SQLite connections can only be used in the thread
+# that opened them, so other threads get their own connection to the same database file.
+# When a compiled snapshot exists in SNAPSHOT_DIR, a TaxonomySnapshot is returned instead:
+# it needs neither ete3 nor the network, and all threads share it.
+_ncbi = None
+_ncbi_thread = None
+_ncbi_lock = threading.Lock()
+_ncbi_local = threading.local()
+
+
+def get_ncbi():
+    global _ncbi, _ncbi_thread
+    with _ncbi_lock:
+        if _ncbi is None:
+            with instrumentation.stage("get_lineage.open_database"):
+                _ncbi = _open_taxonomy()
+            _ncbi_thread = threading.get_ident()
+    if threading.get_ident() == _ncbi_thread or not hasattr(_ncbi, "db"):
+        return _ncbi
+    if getattr(_ncbi_local, "ncbi", None) is None:
+        _ncbi_local.ncbi = type(_ncbi)(dbfile=_ncbi.dbfile)
+    return _ncbi_local.ncbi
+
+
+def _open_taxonomy():
+    from Model.taxonomy_snapshot import TaxonomySnapshot, is_snapshot
+    if is_snapshot(SNAPSHOT_DIR):
+        return TaxonomySnapshot(SNAPSHOT_DIR)
+    from ete3 import NCBITaxa
+    return NCBITaxa()
+
+
+def taxonomy_loaded():
+    # True once the taxonomy database has been opened
+    return _ncbi is not None
+
+
+def __getattr__(name):
+    # The former module-level 'ncbi' instance, now opened on first access
+    if name == "ncbi":
+        return get_ncbi()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def get_lineage_from_cell(taxa_name):
+    ncbi = get_ncbi()
 
     # Step 1: Convert name to taxid
     name2taxid = ncbi.get_name_translator([taxa_name])
@@ -25,6 +93,251 @@ def get_lineage_from_cell(taxa_name):
 
     return taxonomy_path
 
+class LineageRecord:
+    """
+        Names of the seven major ranks of one taxon (None where a rank is not assigned).
+        taxid is the current taxid of the taxon: for a merged taxid it is the one it was merged into.
+        rank_taxids holds the taxids of the named taxa, in the same order as the names.
+
+        Uses __slots__, so a record has no per-instance dictionary. Records behave like
+        a tuple of the names in the order of RANKS (indexing, iteration, len).
+        """
+
+    __slots__ = ("taxid", "rank_taxids", "kingdom", "phylum", "class_", "order", "family", "genus", "species")
+    _RANK_SLOTS = __slots__[2:]
+
+    def __init__(self, taxid, names, rank_taxids=None):
+        self.taxid = taxid
+        self.rank_taxids = tuple(rank_taxids) if rank_taxids is not None else (None,) * len(RANKS)
+        for slot, name in zip(self._RANK_SLOTS, names):
+            setattr(self, slot, name)
+
+    def __getitem__(self, position):
+        return self.as_tuple()[position]
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __len__(self):
+        return len(self._RANK_SLOTS)
+
+    def __eq__(self, other):
+        if isinstance(other, LineageRecord):
+            return self.taxid == other.taxid and self.as_tuple() == other.as_tuple()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.taxid, self.as_tuple()))
+
+    def __repr__(self):
+        return f"LineageRecord({self.taxid}, {self.as_tuple()}, {self.rank_taxids})"
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def as_tuple(self):
+        return tuple(getattr(self, slot) for slot in self._RANK_SLOTS)
+
+    def named_taxids(self):
+        # (name, taxid) of every assigned rank whose taxid is known
+        return [(name, taxid) for name, taxid in zip(self.as_tuple(), self.rank_taxids)
+                if name is not None and taxid is not None]
+
+    def lowest(self):
+        # (rank, name) of the deepest assigned rank, or None
+        for rank, name in zip(reversed(RANKS), reversed(self.as_tuple())):
+            if name is not None:
+                return rank, name
+        return None
+
+
+NOT_ASSIGNED_ROW = LineageRecord(NOT_ASSIGNED, ("Not assigned",) + (None,) * (len(RANKS) - 1))
+# Row of a taxid that could not be resolved
+EMPTY_ROW = LineageRecord(None, (None,) * len(RANKS))
+
+
+class TaxidsByName(dict):
+    """
+        {name: taxid} of the taxa named in a taxonomy table, kept in df.attrs["taxids"].
+
+        pandas deep-copies attrs with every derived frame or column. The mapping is never
+        modified after it is built, so the copies share it instead.
+        """
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class LineageWarning(UserWarning):
+    # Issued once per taxonomy table with unresolved or merged taxids
+    pass
+
+
+class LineageResolver:
+    """
+        Resolves NCBI taxids into rows of the seven major ranks (see RANKS).
+
+        All taxids are deduplicated and resolved with a few bulk queries: one
+        lineage query, one rank query and one name query per QUERY_CHUNK taxids.
+        Resolved rows are kept in memory and in a pickle file in cache_dir, and so
+        are taxids that cannot be resolved (as None), so they are not queried again.
+        The cache file name contains a fingerprint of the taxonomy database, so an
+        updated database never returns stale lineages.
+
+        Parameters
+        ----------
+        taxonomy : NCBITaxa or TaxonomySnapshot, optional
+            Taxonomy database to query, used as given from every thread. By default get_ncbi()
+            is used, which gives every thread its own connection.
+        cache_dir : str or None
+            Directory of the persistent cache. None keeps the cache in memory only.
+        """
+
+    def __init__(self, taxonomy=None, cache_dir=CACHE_DIR):
+        self._taxonomy = taxonomy
+        self.cache_dir = cache_dir
+        self._rows = None
+        # The resolver is used from background threads of the GUI as well
+        self._lock = threading.Lock()
+
+    @property
+    def taxonomy(self):
+        return self._taxonomy if self._taxonomy is not None else get_ncbi()
+
+    def thread_taxonomy(self):
+        # The taxonomy to query from the current thread (see get_ncbi() for the per-thread connections)
+        return self.taxonomy
+
+    def version(self):
+        # Size and modification time of the database file identify its version
+        stat = os.stat(self.taxonomy.dbfile)
+        key = f"{os.path.abspath(self.taxonomy.dbfile)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def cache_path(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"records_v3_{self.version()}.pkl")
+
+    def _load_cache(self):
+        self._rows = {}
+        path = self.cache_path()
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path, "rb") as handle, instrumentation.stage("get_lineage.load_cache") as record:
+                self._rows = pickle.load(handle)
+                record.rows = len(self._rows)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # A broken cache is simply rebuilt
+            self._rows = {}
+
+    def _save_cache(self):
+        path = self.cache_path()
+        if path is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first, so a crash never leaves a half-written cache
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as handle:
+                pickle.dump(self._rows, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The cache is only an optimization. Read-only home directories are fine.
+            pass
+
+    def resolve(self, taxids):
+        """
+            Returns a dictionary {taxid: LineageRecord} for all resolvable taxids.
+            'Not assigned' (-2) and unknown taxids are left out.
+            """
+        unique_ids = {int(taxid) for taxid in taxids} - {NOT_ASSIGNED}
+        with self._lock:
+            if self._rows is None:
+                self._load_cache()
+            missing = [taxid for taxid in unique_ids if taxid not in self._rows]
+            instrumentation.cache("get_lineage.lineages", True, len(unique_ids) - len(missing))
+            instrumentation.cache("get_lineage.lineages", False, len(missing))
+            if missing:
+                rows = self._query(missing)
+                self._rows.update({taxid: rows.get(taxid) for taxid in missing})
+                self._save_cache()
+            return {taxid: self._rows[taxid] for taxid in unique_ids if self._rows.get(taxid) is not None}
+
+    @instrumentation.timed("get_lineage.query")
+    def _query(self, taxids):
+        instrumentation.rows(len(taxids))
+        taxonomy = self.thread_taxonomy()
+        # A taxonomy snapshot resolves all taxids in one walk over its arrays
+        if hasattr(taxonomy, "major_lineages"):
+            instrumentation.count("snapshot.walks")
+            current = dict(zip(taxids, taxonomy.translate(taxids).tolist()))
+            return {taxid: LineageRecord(current[taxid], names, rank_taxids)
+                    for taxid, (names, rank_taxids) in taxonomy.major_lineages(taxids, MAJOR_RANKS).items()}
+        # Step 1: lineages of all taxids
+        lineages = {}
+        for chunk in _chunks(taxids):
+            lineages.update(taxonomy.get_lineage_translator(chunk))
+            instrumentation.count("ncbi.queries")
+        lineages = {taxid: lineage for taxid, lineage in lineages.items() if lineage}
+        # Obsolete taxids are not in the species table. get_lineage() follows the merged table for them.
+        # Merged taxids are reported by lineage_table() for the whole table, not one warning each.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            for taxid in taxids:
+                if taxid not in lineages:
+                    instrumentation.count("ncbi.queries")
+                    instrumentation.count("ncbi.single_taxid_queries")
+                    try:
+                        lineage = taxonomy.get_lineage(taxid)
+                    except ValueError:
+                        continue
+                    # Some unknown taxids (for example 0) give None instead of an error
+                    if lineage:
+                        lineages[taxid] = lineage
+
+        # Step 2: ranks of every taxid that appears in any lineage
+        lineage_ids = list(set().union(*lineages.values())) if lineages else []
+        ranks = {}
+        for chunk in _chunks(lineage_ids):
+            ranks.update(taxonomy.get_rank(chunk))
+            instrumentation.count("ncbi.queries")
+
+        # Step 3: names of the major ranks only
+        major_ids = [taxid for taxid in lineage_ids if ranks.get(taxid) in MAJOR_RANKS]
+        names = {}
+        for chunk in _chunks(major_ids):
+            names.update(taxonomy.get_taxid_translator(chunk))
+            instrumentation.count("ncbi.queries")
+
+        rows = {}
+        for taxid, lineage in lineages.items():
+            row = [None] * len(RANKS)
+            row_taxids = [None] * len(RANKS)
+            for node in lineage:
+                column = MAJOR_RANKS.get(ranks.get(node))
+                if column is not None and row[column] is None:
+                    row[column] = names.get(node)
+                    row_taxids[column] = node if row[column] is not None else None
+            # The last taxid of the lineage is the current one (it differs for merged taxids)
+            rows[taxid] = LineageRecord(lineage[-1] if lineage else taxid, row, row_taxids)
+        return rows
+
+
+# Helper function. Splits a list of taxids into parts of QUERY_CHUNK elements.
+def _chunks(taxids):
+    taxids = list(taxids)
+    for start in range(0, len(taxids), QUERY_CHUNK):
+        yield taxids[start:start + QUERY_CHUNK]
+
+
+resolver = LineageResolver()
+
 def get_lineage(dataset):
     """
         Reads a tab-delimited dataset containing a column 'Taxa' with NCBI taxonomy IDs
@@ -32,14 +345,12 @@ def get_lineage(dataset):
 
         Steps:
         1. Reads the dataset into a DataFrame.
-        2. Iterates through the Taxa IDs:
-            - If the ID is -2, appends 'Not assigned' to the result list.
-            - Otherwise, queries the ETE3 NCBITaxa database to fetch the full lineage.
-            - Skips invalid/missing taxon IDs that raise ValueError.
-        3. Passes the collected lineages through:
-            - sort_ranks(): to arrange lineage elements consistently by rank.
-            - translate_lineage(): to convert taxon IDs into human-readable taxonomic names.
-        4. Returns a list of translated lineage strings.
+        2. Resolves all Taxa IDs at once with the module-wide LineageResolver:
+            - If the ID is -2, 'Not assigned' is used as the lineage.
+            - Otherwise, the lineage is taken from the resolver cache or fetched in bulk
+              from the ETE3 NCBITaxa database.
+            - Invalid/missing taxon IDs get an empty row, so the rows stay aligned with the input.
+        3. Passes the lineages through translate_lineage() to build the taxonomy table.
 
         Parameters
         ----------
@@ -48,77 +359,126 @@ def get_lineage(dataset):
 
         Returns
         -------
-        list
-            A list of strings where each string represents the full lineage of a taxon.
-            Example: ["Bacteria; Proteobacteria; Gammaproteobacteria; Enterobacterales; ..."]
+        pandas.DataFrame
+            One row per taxon and one column per major rank (see RANKS).
+            Example: ["Bacteria", "Proteobacteria", "Gammaproteobacteria", "Enterobacterales", ...]
             For -2 entries, "Not assigned" is returned instead.
+            df.attrs lists the unresolved and merged taxids (see lineage_table()).
         """
 
     # Read the input file
     df = pd.read_csv(dataset, delimiter="\t")
+    return lineage_table(df['Taxa'])
+
+@instrumentation.timed()
+def lineage_table(tax_ids):
+    """
+        Same as get_lineage(), but takes the Taxa IDs directly instead of a file path.
+
+        Lineages are resolved once per distinct taxid and joined back to the taxids in one
+        vectorized take, so the table has exactly one row per taxid, in the same order and
+        with the same index (for a Series). Taxids that cannot be resolved get an empty row.
+
+        Unresolved and merged taxids are reported once for the whole table: in
+        df.attrs["unresolved"] (sorted list of taxids), df.attrs["merged"] ({old taxid: new taxid})
+        and as one warning. df.attrs["taxids"] maps the names of the table to their own taxids
+        (see TaxidsByName).
+        """
+    instrumentation.rows(len(tax_ids))
+    index = tax_ids.index if isinstance(tax_ids, pd.Series) else pd.RangeIndex(len(tax_ids))
+    codes, unique_ids = pd.factorize(np.asarray(tax_ids, dtype=np.int64))
+    resolved = resolver.resolve(unique_ids)
+
     list_of_lineages = []
-    # Extract taxa ids and loop through the list
-    tax_ids = df['Taxa']
-    for id in tax_ids:
+    unresolved = []
+    merged = {}
+    for id in unique_ids.tolist():
         # -2 = 'Not assigned'.
         # We just add 'not assigned' rank also to the list to avoid misunderstandings
-        if id == -2:
-            list_of_lineages.append('Not assigned')
-            continue
-        else:
-            try:
-                list_of_lineages.append(ncbi.get_lineage(id))
-            except ValueError:
-                continue
-    # Call 'sort_ranks' function and store it to the variable 'sorted_lineages'
-    sorted_lineages = sort_ranks(list_of_lineages)
-    return translate_lineage(sorted_lineages)
-
-# Helper function. Sorts ranks so that only major ranks left.
-# Input: List of lineages
-# Output: List of sorted lineages
-def sort_ranks(data):
-    major_ranks = ["superkingdom", "domain", "phylum", "class", "order", "family", "genus", "species"]
-    sorted_ranks = []
-    for lineage in data:
-        # Temporary list for storing ranks.
-        # Is required, so the final list would have separate lists of ranks associated with each element
-        lineage_ranks = []
-        # Check if the element of list has an actual lineage.
-        # If it is the case, just add 'Not assigned' to the list
-        if lineage == "Not assigned":
-            sorted_ranks.append([lineage])
+        if id == NOT_ASSIGNED:
+            list_of_lineages.append(NOT_ASSIGNED_ROW)
+        elif id in resolved:
+            record = resolved[id]
+            list_of_lineages.append(record)
+            if record.taxid != id:
+                merged[id] = record.taxid
         else:
-            # Get ranks for each lineage
-            rank = ncbi.get_rank(lineage)
-            for i in range(len(lineage)):
-                # If the rank is not in the list of major ranks, we skip it
-                if rank[lineage[i]] in major_ranks:
-                    lineage_ranks.append(lineage[i])
-                else:
-                    continue
-            # add the temporary list to the main list
-            sorted_ranks.append((lineage_ranks))
-    return sorted_ranks
-
-# Function translates the lineages into names.
-# Input: List of lineages
-# Output: Translated list of lineages
+            list_of_lineages.append(EMPTY_ROW)
+            unresolved.append(id)
+
+    df = translate_lineage(list_of_lineages).take(codes)
+    df.index = index
+    df.attrs["unresolved"] = sorted(unresolved)
+    df.attrs["merged"] = merged
+    df.attrs["taxids"] = _taxids_by_name(list_of_lineages)
+    _report(unresolved, merged)
+    return df
+
+
+def append_lineages(tax_mat, new_tax_mat):
+    """
+        Appends the rows of a taxonomy table to another one. The columns stay Categoricals
+        (with the union of the names) and the reports in attrs are combined.
+        """
+    columns = {rank: _append_categorical(tax_mat[rank].array, new_tax_mat[rank].array) for rank in tax_mat.columns}
+    df = pd.DataFrame(columns, index=tax_mat.index.append(new_tax_mat.index))
+    df.attrs["unresolved"] = sorted(set(tax_mat.attrs.get("unresolved", []))
+                                    | set(new_tax_mat.attrs.get("unresolved", [])))
+    df.attrs["merged"] = {**tax_mat.attrs.get("merged", {}), **new_tax_mat.attrs.get("merged", {})}
+    df.attrs["taxids"] = TaxidsByName({**new_tax_mat.attrs.get("taxids", {}), **tax_mat.attrs.get("taxids", {})})
+    return df
+
+
+# Helper function. Two Categoricals one after the other, with the sorted union of their names as categories.
+def _append_categorical(first, second):
+    categories = pd.Index(sorted(set(first.categories) | set(second.categories)))
+
+    def recode(part):
+        # The extra last entry maps the code -1 (no name) to -1
+        lookup = np.append(categories.get_indexer(part.categories), -1)
+        return lookup[part.codes]
+
+    return pd.Categorical.from_codes(np.concatenate([recode(first), recode(second)]), categories=categories)
+
+
+# Helper function. {name: taxid} of the named ranks of the records. The first taxid of a name is kept.
+def _taxids_by_name(records):
+    taxids = TaxidsByName()
+    for record in records:
+        for name, taxid in record.named_taxids():
+            taxids.setdefault(name, taxid)
+    return taxids
+
+
+# Helper function. One warning for all unresolved and merged taxids of a table.
+def _report(unresolved, merged):
+    instrumentation.count("get_lineage.unresolved", len(unresolved))
+    instrumentation.count("get_lineage.merged", len(merged))
+    parts = []
+    if unresolved:
+        parts.append(f"{len(unresolved)} taxids could not be resolved ({_preview(unresolved)})")
+    if merged:
+        parts.append(f"{len(merged)} taxids were merged into newer ones "
+                     f"({_preview(f'{old}->{new}' for old, new in merged.items())})")
+    if parts:
+        warnings.warn("; ".join(parts), LineageWarning, stacklevel=4)
+
+
+# Helper function. The first REPORT_PREVIEW items of a list as text.
+def _preview(items):
+    items = [str(item) for item in items]
+    text = ", ".join(items[:REPORT_PREVIEW])
+    return text + ", ..." if len(items) > REPORT_PREVIEW else text
+
+# Function builds the taxonomy table.
+# Input: List of lineages, each one a row of names ordered as RANKS (tuples or LineageRecords)
+# Output: DataFrame with the lineages
 def translate_lineage(list_of_lineages):
-    # Empty list where all names will be stored
-    names = []
-    # Loop through each lineage list and get the names of each rank
-    for lineage in list_of_lineages:
-        # If the rank is 'not assigned' simply add the value to the list.
-        if lineage == ["Not assigned"]:
-            names.append(lineage)
-        else:
-            # get_taxid_translator(lineage) creates a dictionary,
-            # so we need to get all values and store it to the list
-            translate = ncbi.get_taxid_translator(lineage)
-            names.append([translate[taxid] for taxid in lineage])
     # Create a DataFrame where:
     # Rows: taxa
     # Columns: taxonomy lineage associated with the taxa
-    df = pd.DataFrame(names, columns=["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"])
-    return df
\ No newline at end of file
+    # Every column is a Categorical: each name is stored once, the rows only hold integer codes.
+    names_per_rank = list(zip(*map(tuple, list_of_lineages))) or [()] * len(RANKS)
+    columns = {rank: pd.Categorical(list(names)) for rank, names in zip(RANKS, names_per_rank)}
+    df = pd.DataFrame(columns, index=pd.RangeIndex(len(list_of_lineages)))
+    return df
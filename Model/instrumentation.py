@@ -0,0 +1,233 @@
+import io
+import json
+import time
+import pstats
+import cProfile
+import platform
+import threading
+import tracemalloc
+import functools
+from contextlib import contextmanager
+
+# Timings of the Model layer: wall time and row counts of every stage, counters (for example
+# queries sent to the NCBI taxonomy database) and hit rates of the caches.
+#
+# Stages are recorded with the stage() context manager or the timed() decorator:
+#   with instrumentation.stage("modificator.merge_data") as record:
+#       ...
+#       record.rows = len(merged)
+# Inside a decorated function, instrumentation.rows(n) sets the rows of the running stage.
+# Recording is always on; it costs two clock reads per stage.
+#
+# In capture mode the outermost stage of every thread additionally runs under cProfile and the
+# memory allocated by Python is traced with tracemalloc. Both slow the program down and are off by default.
+# Peak memory is the growth during a stage; when stages run concurrently their allocations overlap.
+#
+# The registry is per process. snapshot() returns everything as plain data, export() writes it as JSON.
+
+# Number of functions listed from the profile
+PROFILE_FUNCTIONS = 30
+
+
+class StageRecord:
+    # Data of one running stage. rows can be set inside the with block.
+    __slots__ = ("name", "rows")
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+
+class Instrumentation:
+    """
+        Registry of stage timings, counters and cache statistics. Thread-safe.
+        """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._capturing = False
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # name: {"calls", "seconds", "max_seconds", "rows", "peak_mb"}
+            self._stages = {}
+            # name: count
+            self._counters = {}
+            # name: [hits, misses]
+            self._caches = {}
+            self._profiles = []
+            self._started = time.time()
+
+    # Stages
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = StageRecord(name, rows)
+        running = self._running()
+        depth = len(running)
+        running.append(record)
+        profile = None
+        memory_start = None
+        # Only the outermost stage of a thread is profiled: cProfile cannot be nested
+        if self._capturing and depth == 0:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active in this thread
+                profile = None
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+                memory_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            peak = None
+            if memory_start is not None and tracemalloc.is_tracing():
+                # Memory allocated on top of what was in use when the stage started
+                peak = (tracemalloc.get_traced_memory()[1] - memory_start) / 2 ** 20
+            running.pop()
+            self._add_stage(record, seconds, peak, profile)
+
+    def rows(self, amount):
+        # Sets the number of rows processed by the innermost running stage of this thread
+        running = self._running()
+        if running:
+            running[-1].rows = amount
+
+    def _running(self):
+        # Stages running in this thread, outermost first
+        if not hasattr(self._local, "running"):
+            self._local.running = []
+        return self._local.running
+
+    def timed(self, name=None):
+        # Decorator: every call of the function is a stage (named module.function by default)
+        def decorator(function):
+            stage_name = name or f"{function.__module__.rsplit('.', 1)[-1]}.{function.__name__}"
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _add_stage(self, record, seconds, peak, profile):
+        with self._lock:
+            stage = self._stages.setdefault(record.name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                          "rows": None, "peak_mb": None})
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+            if record.rows is not None:
+                stage["rows"] = (stage["rows"] or 0) + int(record.rows)
+            if peak is not None:
+                stage["peak_mb"] = max(stage["peak_mb"] or 0.0, peak)
+            if profile is not None:
+                self._profiles.append(profile)
+
+    # Counters and caches
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def cache(self, name, hit, amount=1):
+        # Records amount lookups of a cache that were hits (hit=True) or misses
+        with self._lock:
+            stats = self._caches.setdefault(name, [0, 0])
+            stats[0 if hit else 1] += amount
+
+    # Capture mode
+
+    @property
+    def capturing(self):
+        return self._capturing
+
+    def start_capture(self):
+        # cProfile for every following outermost stage, tracemalloc for the whole process
+        with self._lock:
+            self._profiles = []
+            self._capturing = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop_capture(self):
+        with self._lock:
+            self._capturing = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def capture(self):
+        self.start_capture()
+        try:
+            yield self
+        finally:
+            self.stop_capture()
+
+    # Results
+
+    def profile_stats(self, limit=PROFILE_FUNCTIONS):
+        # The slowest functions (by cumulative time) of all captured stages, or []
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return []
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        functions = []
+        for (file_name, line, function), (primitive, calls, total, cumulative, callers) in stats.stats.items():
+            functions.append({"function": f"{function} ({file_name}:{line})", "calls": calls,
+                              "total_seconds": total, "cumulative_seconds": cumulative})
+        functions.sort(key=lambda entry: entry["cumulative_seconds"], reverse=True)
+        return functions[:limit]
+
+    def snapshot(self):
+        """
+            Everything recorded so far as plain data (JSON-serializable).
+
+            Returns
+            -------
+            dict
+                'stages', 'counters', 'caches' (with hit rates), 'profile' (captured functions)
+                and 'meta' (platform and recording period).
+            """
+        with self._lock:
+            stages = {name: {**stage, "mean_seconds": stage["seconds"] / stage["calls"]}
+                      for name, stage in self._stages.items()}
+            counters = dict(self._counters)
+            caches = {name: {"hits": hits, "misses": misses,
+                             "hit_rate": hits / (hits + misses) if hits + misses else None}
+                      for name, (hits, misses) in self._caches.items()}
+            started = self._started
+        return {
+            "meta": {"started": started, "seconds": time.time() - started, "capturing": self._capturing,
+                     "python": platform.python_version(), "platform": platform.platform()},
+            "stages": stages,
+            "counters": counters,
+            "caches": caches,
+            "profile": self.profile_stats(),
+        }
+
+    def export(self, path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(self.snapshot(), handle, indent=2)
+
+
+# The registry of this process
+registry = Instrumentation()
+
+stage = registry.stage
+timed = registry.timed
+rows = registry.rows
+count = registry.count
+cache = registry.cache
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# Names of the OTUs derived from their taxonomy, shared by the table view, the plots and the tooltips.
+#
+# Every rank is stored as integer codes (-1 = not assigned). The deepest assigned rank of all OTUs
+# is found with one argmax over the reversed (OTUs x ranks) assignment mask, and the lowest names
+# are a Categorical whose codes index one sorted list of all names.
+
+
+class TaxonLabels:
+    """
+        Integer-coded taxonomy of a set of OTUs.
+
+        Parameters
+        ----------
+        codes : numpy.ndarray
+            (OTUs x ranks) codes, -1 where a rank is not assigned.
+        names : dict
+            {rank: pandas.Index} names behind the codes of every rank.
+        otus : pandas.Index
+            OTU IDs, in the order of the rows of codes.
+        """
+
+    def __init__(self, codes, names, otus):
+        self.codes = codes
+        self.names = names
+        self.ranks = list(names)
+        self.otus = otus
+        self._lowest = None
+
+    @classmethod
+    def from_table(cls, taxa_table, index=None):
+        # Labels of a taxonomy table (rows: OTUs, columns: ranks), optionally aligned to the OTUs in index
+        if index is not None:
+            taxa_table = taxa_table.reindex(index)
+        codes = np.full(taxa_table.shape, -1, dtype=np.int32)
+        names = {}
+        for position, rank in enumerate(taxa_table.columns):
+            rank_codes, rank_names = pd.factorize(taxa_table[rank], sort=True)
+            codes[:, position] = rank_codes
+            names[rank] = pd.Index(rank_names, name=rank)
+        return cls(codes, names, taxa_table.index)
+
+    def lowest_rank(self):
+        # Position of the deepest assigned rank of every OTU, -1 for OTUs without taxonomy
+        assigned = self.codes >= 0
+        deepest = len(self.ranks) - 1 - np.argmax(assigned[:, ::-1], axis=1)
+        return np.where(assigned.any(axis=1), deepest, -1)
+
+    def lowest_taxa(self):
+        # Name at the deepest assigned rank of every OTU as a Categorical Series (NaN without taxonomy).
+        # The categories are sorted, so sorting by codes sorts by name.
+        if self._lowest is None:
+            deepest = self.lowest_rank()
+            all_names = pd.Index(np.unique(np.concatenate(
+                [self.names[rank].to_numpy(dtype=object) for rank in self.ranks] + [np.array([], dtype=object)])))
+            lowest_codes = np.full(len(self.otus), -1, dtype=np.int32)
+            for position, rank in enumerate(self.ranks):
+                # Code of every name of this rank in the list of all names
+                lookup = all_names.get_indexer(self.names[rank])
+                selected = deepest == position
+                lowest_codes[selected] = lookup[self.codes[selected, position]]
+            self._lowest = pd.Series(pd.Categorical.from_codes(lowest_codes, categories=all_names),
+                                     index=self.otus, name="Lowest Taxa")
+        return self._lowest
+
+    def lineage(self, position):
+        # [(rank, name)] of the assigned ranks of the OTU at a position
+        return [(rank, self.names[rank][code]) for rank, code in zip(self.ranks, self.codes[position]) if code >= 0]
+
+    def tooltip(self, position):
+        # Full lineage of the OTU at a position, one rank per line
+        lineage = self.lineage(position)
+        if not lineage:
+            return "Not assigned"
+        return "\n".join(f"{rank}: {name}" for rank, name in lineage)
@@ -1,32 +1,334 @@
+import hashlib
 import numpy as np
 import pandas as pd
-from scipy import stats
-import matplotlib.pyplot as plt
-from scipy.stats import wilcoxon
-from skbio.stats.distance import permanova
-from Model.get_lineage import *
-from skbio.stats.ordination import pcoa
-from skbio.diversity import beta_diversity
-from Model.modificator import otu_table, tax_table
+from scipy import sparse
+from Model.modificator import otu_table, tax_table, merge_data, otu_index
+from Model.get_lineage import lineage_table, append_lineages
+from Model import batch_stats
+from Model import distances
+from Model import permutation_tests
+from Model import alpha_diversity
+from Model import instrumentation
+from Model.rank_cube import RankCube
+from Model.taxonomy_index import TaxonomyIndex
+from Model.dependencies import DependencyGraph
+from Model.sparse_counts import to_sparse, to_dense, is_sparse, count_matrix, from_matrix
+
+# PCoA uses the randomized SVD ('fsvd') above this number of samples
+FSVD_SAMPLES = 1000
+# Number of principal coordinates computed with 'fsvd'
+PCOA_DIMENSIONS = 10
+# Largest number of sample labels drawn in the PCoA plot
+PCOA_LABELS = 100
+# Cached results of the analyzer and the data they are computed from. When samples are added or removed,
+# the stale results are updated incrementally where possible and dropped (recomputed on next use) otherwise.
+RESULTS = DependencyGraph({
+    "distances": ("otu_table", "taxa_table"),
+    "rarefaction": ("otu_table",),
+    "rank_cube": ("otu_table", "taxa_table"),
+    "taxonomy_index": ("taxa_table", "taxids"),
+})
 
 class MicrobiomeDataAnalyzer:
 
-    def __init__(self, OTU_table: str = "", Taxa_table: str = "", Metadata: str = "") -> None:
+    def __init__(self, OTU_table: str = "", Taxa_table: str = "", Metadata: str = "", sparse: bool = False,
+                 taxids=None) -> None:
+        # With sparse=True the OTU table is stored as a sparse DataFrame: empty cells become 0
+        # and only the non-zero counts take memory. The statistical tests still leave empty cells
+        # out, as for dense tables (see batch_stats). Counts of exactly 0 are stored as empty cells.
+        if sparse and isinstance(OTU_table, pd.DataFrame):
+            OTU_table = to_sparse(OTU_table)
+        # The tables are replaced, never modified in place: their fingerprints (the cache keys of
+        # the computed results) are computed once per assigned table, see _fingerprint().
+        self._tables = {}
+        self._fingerprints = {}
         self.OTU_table = OTU_table
         self.Taxa_table = Taxa_table
         self.Metadata = Metadata
+        # NCBI taxonomy ID of every OTU (Series indexed like the OTU table), if known
+        self.Taxa_ids = taxids
+        # Computed distance matrices: {(metric, data fingerprint, filters): DistanceMatrix}
+        self._distances = {}
+        # Mean rarefied alpha diversity: {(data fingerprint, depth, iterations, seed): DataFrame}
+        self._rarefaction = {}
+        # Abundances at all ranks, rebuilt only when the data changes: (data fingerprint, RankCube)
+        self._rank_cube = (None, None)
+        # Name <-> taxid <-> lineage lookups: ((taxonomy table, taxids), TaxonomyIndex)
+        self._taxonomy_index = (None, None)
+
+    @property
+    def OTU_table(self):
+        return self._tables["otu_table"]
+
+    @OTU_table.setter
+    def OTU_table(self, table):
+        self._set_table("otu_table", table)
+
+    @property
+    def Taxa_table(self):
+        return self._tables["taxa_table"]
+
+    @Taxa_table.setter
+    def Taxa_table(self, table):
+        self._set_table("taxa_table", table)
+
+    def _set_table(self, name, table, key=None):
+        # A new table gets a new fingerprint: the given key or, on first use, a hash of the table
+        self._tables[name] = table
+        self._fingerprints[name] = key
+
+    def _fingerprint(self, name):
+        if self._fingerprints[name] is None:
+            self._fingerprints[name] = distances.fingerprint(self._tables[name])
+        return self._fingerprints[name]
+
+    def fingerprints(self):
+        # Fingerprints of the tables that are DataFrames: {table name: fingerprint}
+        return {name: self._fingerprint(name) for name, table in self._tables.items()
+                if isinstance(table, pd.DataFrame)}
+
+    def assume_fingerprints(self, fingerprints):
+        # Uses fingerprints computed earlier (for example saved in a project) for the current tables
+        for name, key in fingerprints.items():
+            if name in self._tables:
+                self._fingerprints[name] = key
+
+    def beta_diversity(self, metric="braycurtis", min_prevalence=0, min_abundance=0.0):
+        """
+            Distances between the samples (see Model.distances for the metrics).
+
+            Results are memoized by metric, fingerprint of the data and filters, so PCoA,
+            PERMANOVA and other analyses share one computed matrix.
+            Only OTUs found in at least min_prevalence samples with at least min_abundance reads are used.
+            """
+        key = self._distance_key(metric, min_prevalence, min_abundance)
+        instrumentation.cache("analyzer.distances", key in self._distances)
+        if key not in self._distances:
+            otu_table = self.OTU_table
+            if min_prevalence or min_abundance:
+                otu_table = otu_table.loc[batch_stats.prefilter(otu_table, min_prevalence, min_abundance)]
+            with instrumentation.stage(f"analyzer.beta_diversity.{metric}", rows=len(otu_table)):
+                self._distances[key] = distances.beta_diversity(otu_table, metric, self.Taxa_table)
+        return self._distances[key]
+
+    def _distance_key(self, metric, min_prevalence=0, min_abundance=0.0):
+        data = self._fingerprint("otu_table")
+        if metric in distances.UNIFRAC_METRICS:
+            data += self._fingerprint("taxa_table")
+        return metric, data, min_prevalence, min_abundance
+
+    def cached_distances(self):
+        # Already computed distance matrices of the unfiltered data: {metric: DistanceMatrix}
+        return {key[0]: matrix for key, matrix in self._distances.items()
+                if key == self._distance_key(key[0])}
+
+    def remember_distance(self, metric, matrix):
+        # Stores a distance matrix computed elsewhere (for example loaded from a project)
+        self._distances[self._distance_key(metric)] = matrix
+
+    @instrumentation.timed("analyzer.alpha_diversity")
+    def alpha_diversity(self):
+        # Observed, Shannon, Simpson, Chao1 and Pielou of every sample (rows: samples)
+        return alpha_diversity.alpha_diversity(self.OTU_table)
+
+    def rarefaction_curve(self, metric="observed", depths=None, iterations=10, seed=0):
+        """
+            Mean alpha diversity of every sample rarefied to a series of depths.
+
+            All metrics of a depth are computed and cached together, so redrawing a curve
+            or switching the metric only computes depths that were never used before.
+
+            Returns
+            -------
+            pandas.DataFrame
+                Rows: depths, columns: samples. NaN where a sample has fewer reads than the depth.
+            """
+        if metric not in alpha_diversity.METRICS:
+            raise ValueError(f"Unknown metric: {metric}. Use one of {', '.join(alpha_diversity.METRICS)}.")
+        if depths is None:
+            depths = alpha_diversity.rarefaction_depths(self.OTU_table)
+        data = self._fingerprint("otu_table")
+        curve = {}
+        for depth in depths:
+            key = (data, int(depth), iterations, seed)
+            instrumentation.cache("analyzer.rarefaction", key in self._rarefaction)
+            if key not in self._rarefaction:
+                with instrumentation.stage("analyzer.rarefied_diversity"):
+                    self._rarefaction[key] = alpha_diversity.rarefied_diversity(self.OTU_table, int(depth),
+                                                                                iterations, seed)
+            curve[int(depth)] = self._rarefaction[key][metric]
+        return pd.DataFrame(curve).T.rename_axis("Depth")
+
+    def plot_rarefaction(self, canvas, metric="observed", curve=None):
+        if curve is None:
+            curve = self.rarefaction_curve(metric)
+        for sample in curve.columns:
+            canvas.axes.plot(curve.index, curve[sample], label=sample)
+        canvas.axes.set_xlabel('Reads per sample', fontsize=14)
+        canvas.axes.set_ylabel(metric.capitalize(), fontsize=14)
+        canvas.axes.set_title('Rarefaction curves', fontsize=16)
+        canvas.axes.legend(loc='upper left', bbox_to_anchor=(1, 1))
+        canvas.figure.tight_layout()
+        canvas.draw()
 
-    def beta_diversity(self):
-        dropped_df = self.OTU_table.dropna()
-        otumat_transposed = dropped_df.T
-        data = otumat_transposed.values
-        ids = otumat_transposed.index
-        b_div = beta_diversity(metric="braycurtis", counts=data, ids=ids)
-        return b_div
-
+    def rank_cube(self):
+        # Abundances aggregated at every rank. Computed on first use and whenever the tables change.
+        data = self._rank_cube_key()
+        instrumentation.cache("analyzer.rank_cube", self._rank_cube[0] == data)
+        if self._rank_cube[0] != data:
+            with instrumentation.stage("analyzer.rank_cube", rows=len(self.OTU_table)):
+                self._rank_cube = (data, RankCube(self.OTU_table, self.Taxa_table))
+        return self._rank_cube[1]
+
+    def taxonomy_index(self):
+        # Lookups of names, taxids and lineages without the taxonomy database. Built on first use
+        # and again when the taxonomy table or the taxids are replaced. The check is by identity,
+        # so every click stays a dictionary lookup.
+        tables = (self.Taxa_table, self.Taxa_ids)
+        cached_tables = self._taxonomy_index[0]
+        if cached_tables is None or any(new is not old for new, old in zip(tables, cached_tables)):
+            with instrumentation.stage("analyzer.taxonomy_index", rows=len(self.Taxa_table)):
+                self._taxonomy_index = (tables, TaxonomyIndex(self.Taxa_table, self.Taxa_ids))
+        return self._taxonomy_index[1]
+
+    @instrumentation.timed("analyzer.add_samples")
+    def add_samples(self, datasets, metadata=None):
+        """
+            Appends samples and updates the cached results instead of computing everything again.
+
+            Only taxids that are new to the data set are resolved; they become new OTUs at the end
+            of the tables. Cached distance matrices only get the rows of the new samples
+            (see distances.extend_distances) and the rank cube only sums the new samples.
+            Other stale results (see RESULTS) are computed again on their next use.
+
+            Parameters
+            ----------
+            datasets : list
+                DataFrames with a 'Taxa' column and one column per sample or paths to tab-delimited
+                files of the same layout (see modificator.merge_data).
+            metadata : pandas.DataFrame, optional
+                Rows of the new samples (SampleID, Group, Property).
+
+            Returns
+            -------
+            list
+                The added samples.
+            """
+        if self.Taxa_ids is None:
+            raise ValueError("Samples can only be added when the taxids of the OTUs are known.")
+        merged = merge_data(datasets)
+        taxids = merged.pop(merged.columns[0]).to_numpy(dtype=np.int64)
+        samples = list(merged.columns)
+        duplicates = set(samples) & set(self.OTU_table.columns)
+        if duplicates or len(set(samples)) != len(samples):
+            raise ValueError(f"Samples already in the data: {', '.join(map(str, sorted(duplicates or samples)))}")
+        cached_distances, cube = self.cached_distances(), self._current_rank_cube()
+
+        # New taxids become new OTUs. Only their lineages are resolved.
+        new_taxids = np.setdiff1d(taxids, self.Taxa_ids.to_numpy(dtype=np.int64))
+        num_otus = len(self.OTU_table)
+        otus = self.OTU_table.index.append(pd.Index(otu_index(num_otus + len(new_taxids))[num_otus:]))
+        if len(new_taxids):
+            new_ids = pd.Series(new_taxids, index=otus[num_otus:])
+            new_lineages = lineage_table(new_ids)
+            self.Taxa_ids = pd.concat([self.Taxa_ids, new_ids])
+            self._set_table("taxa_table", append_lineages(self.Taxa_table, new_lineages),
+                            _derived_fingerprint(self._fingerprints["taxa_table"],
+                                                 distances.fingerprint(new_lineages)))
+
+        rows = pd.Index(self.Taxa_ids.reindex(otus).to_numpy(dtype=np.int64)).get_indexer(taxids)
+        counts = np.full((len(otus), len(samples)), np.nan, dtype=np.float32)
+        counts[rows] = merged.to_numpy(dtype=np.float32)
+        # Only the new samples are hashed for the fingerprint of the extended table
+        otu_key = _derived_fingerprint(self._fingerprints["otu_table"],
+                                       distances.fingerprint(pd.DataFrame(counts, index=otus, columns=samples)))
+        if is_sparse(self.OTU_table):
+            empty_rows = sparse.csr_matrix((len(new_taxids), self.OTU_table.shape[1]))
+            old = sparse.vstack([count_matrix(self.OTU_table), empty_rows])
+            matrix = sparse.hstack([old, sparse.csr_matrix(np.nan_to_num(counts))])
+            table = from_matrix(matrix, otus, self.OTU_table.columns.append(pd.Index(samples)))
+        else:
+            table = pd.concat([self.OTU_table.reindex(otus), pd.DataFrame(counts, index=otus, columns=samples)],
+                              axis=1)
+        self._set_table("otu_table", table, otu_key)
+        if metadata is not None:
+            self.Metadata = pd.concat([self.Metadata, metadata], ignore_index=True)
+
+        def update_distances():
+            self._distances = {}
+            for metric, matrix in cached_distances.items():
+                self.remember_distance(metric, distances.extend_distances(
+                    matrix, self.OTU_table, metric, self.Taxa_table, otus_changed=len(new_taxids) > 0))
+
+        def update_rank_cube():
+            cube.add_samples(self.OTU_table, self.Taxa_table, samples)
+            self._store_rank_cube(cube)
+
+        changed = ["otu_table", "metadata"] + (["taxa_table", "taxids"] if len(new_taxids) else [])
+        self._refresh(changed, {"distances": update_distances,
+                                "rank_cube": update_rank_cube if cube is not None else None})
+        return samples
+
+    @instrumentation.timed("analyzer.remove_samples")
+    def remove_samples(self, samples):
+        """
+            Removes samples and their metadata. The OTUs and their taxonomy stay (also OTUs that
+            are now empty), so cached distance matrices and the rank cube only drop the removed samples.
+            """
+        samples = list(samples)
+        missing = set(samples) - set(self.OTU_table.columns)
+        if missing:
+            raise ValueError(f"Unknown samples: {', '.join(map(str, sorted(missing)))}")
+        cached_distances, cube = self.cached_distances(), self._current_rank_cube()
+
+        self._set_table("otu_table", self.OTU_table.drop(columns=samples),
+                        _derived_fingerprint(self._fingerprints["otu_table"], repr(samples)))
+        removed = self.Metadata['SampleID'].astype(str).isin([str(sample) for sample in samples])
+        self.Metadata = self.Metadata[~removed].reset_index(drop=True)
+
+        def update_distances():
+            self._distances = {}
+            remaining = [str(sample) for sample in self.OTU_table.columns]
+            for metric, matrix in cached_distances.items():
+                self.remember_distance(metric, matrix.filter(remaining))
+
+        def update_rank_cube():
+            cube.remove_samples(self.OTU_table)
+            self._store_rank_cube(cube)
+
+        self._refresh(["otu_table", "metadata"], {"distances": update_distances,
+                                                  "rank_cube": update_rank_cube if cube is not None else None})
+
+    def _refresh(self, changed, updates):
+        # Updates the results that depend on the changed data. Results without update are dropped.
+        for name in RESULTS.stale(changed):
+            update = updates.get(name)
+            if update is not None:
+                update()
+            elif name == "distances":
+                self._distances = {}
+            elif name == "rarefaction":
+                self._rarefaction = {}
+            elif name == "rank_cube":
+                self._rank_cube = (None, None)
+            elif name == "taxonomy_index":
+                self._taxonomy_index = (None, None)
+
+    def _rank_cube_key(self):
+        return self._fingerprint("otu_table") + self._fingerprint("taxa_table")
+
+    def _current_rank_cube(self):
+        # The cached rank cube if it belongs to the current data, else None
+        if self._rank_cube[1] is None:
+            return None
+        return self._rank_cube[1] if self._rank_cube[0] == self._rank_cube_key() else None
+
+    def _store_rank_cube(self, cube):
+        self._rank_cube = (self._rank_cube_key(), cube)
+
+    @instrumentation.timed("analyzer.plot_rank")
     def plot_rank(self, rank, canvas):
-        taxa_mapping = self.Taxa_table[rank]
-        rank_df = self.OTU_table.groupby(taxa_mapping, axis=0).sum().T
+        rank_df = self.rank_cube().rank_sums(rank).T
 
         resulting_plot = rank_df.plot(kind='bar', stacked=True, ax=canvas.axes)
 
@@ -39,19 +341,15 @@ class MicrobiomeDataAnalyzer:
 
         return resulting_plot, rank_df
 
+    @instrumentation.timed("analyzer.plot_top")
     def plot_top(self, top, canvas):
-        # Calculate top taxa and plot
-        total_counts = self.OTU_table.sum(axis=1)
-        top_otus = total_counts.nlargest(top).index
-
-        top_otus_tax_rank = {}
-        for otu in top_otus:
-            tax_info = self.Taxa_table.loc[otu]
-            specific_rank = tax_info.dropna().iloc[-1] if not tax_info.dropna().empty else 'Unknown'
-            top_otus_tax_rank[otu] = specific_rank
-
-        filtered_df = self.OTU_table.loc[top_otus]
-        filtered_df.index = [top_otus_tax_rank[otu] for otu in filtered_df.index]
+        # Top taxa and their lowest assigned names come from the rank cube
+        cube = self.rank_cube()
+        top_otus = cube.top_otus(top)
+        lowest_taxa = cube.lowest_taxa().loc[top_otus].astype(object).fillna('Unknown')
+
+        filtered_df = to_dense(self.OTU_table.loc[top_otus])
+        filtered_df.index = lowest_taxa.to_numpy()
         df_t = filtered_df.T
         totals = df_t.sum(axis=1)
 
@@ -72,35 +370,65 @@ class MicrobiomeDataAnalyzer:
 
         return resulting_plot, df_t
 
-    def plot_pcoa(self, canvas):
+    @instrumentation.timed("analyzer.pcoa_samples")
+    def pcoa_samples(self, method=None, dimensions=PCOA_DIMENSIONS):
+        """
+            Coordinates of the samples on the principal coordinates, with their group and property.
+            Separate from plotting, so the computation can run outside the GUI thread.
+
+            With more than FSVD_SAMPLES samples the fast randomized SVD ('fsvd') is used by default,
+            which only computes the first dimensions axes instead of all of them.
+            """
+        from skbio.stats.ordination import pcoa
+
         distance = self.beta_diversity()
-        pcoa_results = pcoa(distance)
+        if method is None:
+            method = "fsvd" if len(distance.ids) > FSVD_SAMPLES else "eigh"
+        if method == "fsvd":
+            pcoa_results = pcoa(distance, method="fsvd", dimensions=min(dimensions, len(distance.ids)), seed=0)
+        else:
+            pcoa_results = pcoa(distance)
         pcoa_samples = pcoa_results.samples
 
-        groups = np.array(self.Metadata['Group'])
-        treatment_day = np.array(self.Metadata['Property'])
-        pcoa_samples.insert(0, "Group", groups)
-        pcoa_samples.insert(1, "Property", treatment_day)
+        # Metadata of the samples in the order of the distance matrix
+        metadata = self.Metadata.set_index(self.Metadata['SampleID'].astype(str))
+        metadata = metadata.reindex(list(distance.ids))
+        pcoa_samples.insert(0, "Group", metadata['Group'].to_numpy())
+        pcoa_samples.insert(1, "Property", metadata['Property'].to_numpy())
+        return pcoa_samples
 
-        unique_groups = pcoa_samples['Group'].unique()
-        colors = plt.get_cmap('tab10')(range(len(unique_groups)))
-        color_map = dict(zip(unique_groups, colors))
+    @instrumentation.timed("analyzer.plot_pcoa")
+    def plot_pcoa(self, canvas, pcoa_samples=None, max_labels=PCOA_LABELS):
+        """
+            Scatter plot of the first two principal coordinates, one collection per group.
 
-        seen_groups = set()
+            At most max_labels samples get a text label (evenly spread over the samples, None = all).
 
-        for idx, row in pcoa_samples.iterrows():
-            group = row['Group']
-            pc1 = row['PC1']
-            pc2 = row['PC2']
-            property = row['Property']
+            Returns
+            -------
+            dict
+                {collection: labels} with a hover text for every point of each group's collection.
+            """
+        if pcoa_samples is None:
+            pcoa_samples = self.pcoa_samples()
 
-            if group not in seen_groups:
-                canvas.axes.scatter(pc1, pc2, color=color_map[group], label=group, alpha=0.7)
-                seen_groups.add(group)
-            else:
-                canvas.axes.scatter(pc1, pc2, color=color_map[group], alpha=0.7)
+        from matplotlib import colormaps
 
-            canvas.axes.text(pc1, pc2, property, fontsize=8)
+        unique_groups = pcoa_samples['Group'].unique()
+        colors = colormaps['tab10'](range(len(unique_groups)))
+        collections = {}
+        for group, color in zip(unique_groups, colors):
+            members = pcoa_samples[pcoa_samples['Group'] == group]
+            collection = canvas.axes.scatter(members['PC1'], members['PC2'], color=color, label=group, alpha=0.7)
+            collections[collection] = [f"{sample} ({group}, {prop})"
+                                       for sample, prop in zip(members.index, members['Property'])]
+
+        labelled = np.arange(len(pcoa_samples))
+        if max_labels is not None and len(pcoa_samples) > max_labels:
+            labelled = np.unique(np.linspace(0, len(pcoa_samples) - 1, max_labels).astype(int))
+        for pc1, pc2, prop in zip(pcoa_samples['PC1'].to_numpy()[labelled], pcoa_samples['PC2'].to_numpy()[labelled],
+                                  pcoa_samples['Property'].to_numpy()[labelled]):
+            canvas.axes.text(pc1, pc2, prop, fontsize=8)
 
         canvas.axes.set_xlabel('PC1', fontsize=14)
         canvas.axes.set_ylabel('PC2', fontsize=14)
@@ -108,6 +436,7 @@ class MicrobiomeDataAnalyzer:
         canvas.axes.legend(loc='upper left', bbox_to_anchor=(1, 1))
         canvas.figure.tight_layout()  # Automatically adjust layout to fit labels
         canvas.draw()
+        return collections
 
 
     def prepare_dataset(self):
@@ -128,114 +457,108 @@ class MicrobiomeDataAnalyzer:
 #     # 5. beta_diversity()
 #     # Perform an independent t-Test
 
-    def t_test(self):
-        # Prepare the dataset
-        input_data = self.prepare_dataset()
-
-        # Find all unique color groups in the dataset.
-        unique_groups = input_data['Group'].unique()
-        # Save the possible colors
-        column_property = input_data['Group']
-
-        # Perform t-Test for each OTU column
-        t_test_results = {}
-        for otu in input_data.columns[2:]:  # Skipping 'SampleID' and 'Property'
-
-            # Filter the dataframe by color and drop missing values.
-            groups = [input_data[column_property == property][otu].dropna() for property in unique_groups]
-
-            t_stat, p_value = stats.ttest_ind(*groups)
-
-            # Store the results
-            t_test_results[otu] = (t_stat, p_value)
+    def group_arrays(self):
+        # Splits the samples by group once. Rows: OTUs, columns: samples of the group.
+        return batch_stats.split_groups(self.OTU_table, self.Metadata)
 
-        return t_test_results
+    def t_test(self):
+        # Perform t-Test for all OTUs at once
+        group_names, groups = self.group_arrays()
+        t_stat, p_value = batch_stats.t_test(groups)
+        return batch_stats.results_frame(self.OTU_table.index, t_stat, p_value)
 
     # Perform Anova-Test
     def anova_test(self):
-        # Prepare the dataset
-        input_data = self.prepare_dataset()
-        # Prepare groups for ANOVA
-        # Find all unique groups in the dataset.
-        unique_groups = input_data['Group'].unique()
-        # Save the possible properties (for example: fur color of the subject)
-        column_property = input_data['Group']
-
-        # Perform ANOVA for each OTU column
-        anova_results = {}
-        for otu in input_data.columns[2:]:  # Skipping 'SampleID' and 'Property'
-
-            # Filter the dataframe by color and drop missing values.
-            groups = [input_data[column_property == property][otu].dropna() for property in unique_groups]
-
-            f_value, p_value = stats.f_oneway(*groups)
-
-            # Store the results
-            anova_results[otu] = (f_value, p_value)
-
-        return anova_results
+        # Perform ANOVA for all OTUs at once
+        group_names, groups = self.group_arrays()
+        f_value, p_value = batch_stats.anova(groups)
+        return batch_stats.results_frame(self.OTU_table.index, f_value, p_value)
 
     # Perform Kruskal test. Alternative to the ANOVA-test. Data does not have to be normally distributed.
     def kruskal(self):
-        # Prepare the dataset
-        input_data = self.prepare_dataset()
-        # Find all unique groups in the dataset.
-        unique_groups = input_data['Group'].unique()
-        # Save the possible properties (for example: fur color of the subject)
-        column_property = input_data['Group']
-
-        # Perform Kruskal for each OTU column
-        kruskal_results = {}
-        for otu in input_data.columns[2:]:  # Skipping 'SampleID' and 'Property'
-
-            # Filter the dataframe by color and drop missing values.
-            groups = [input_data[column_property == property][otu].dropna() for property in unique_groups]
-
-            stat, p_value = stats.kruskal(*groups)
-
-            # Store the results
-            kruskal_results[otu] = (stat, p_value)
-
-        # Display the results
-        for otu, (stat, p_value) in kruskal_results.items():
-            print(f"{otu}: H-statistic = {stat}, P-value = {p_value}")
+        # Perform Kruskal for all OTUs at once
+        group_names, groups = self.group_arrays()
+        h_stat, p_value = batch_stats.kruskal(groups)
+        return batch_stats.results_frame(self.OTU_table.index, h_stat, p_value)
 
     def wilcoxon_test(self):
-        # Prepare the dataset
-        input_data = self.prepare_dataset()
-
         # Assuming two unique groups represent paired data (e.g., "before" and "after")
-        if len(input_data['Group'].unique()) != 2:
+        group_names, groups = self.group_arrays()
+        if len(groups) != 2:
             raise ValueError("There must be exactly two groups for the Wilcoxon signed-rank test.")
-
-        # Retrieve the unique groups for clarity
-        group1, group2 = input_data['Group'].unique()
-
-        # Perform Wilcoxon test for each OTU column
-        wilcoxon_results = {}
-
-        for otu in input_data.columns[2:]:  # Skipping 'SampleID' and 'Group'
-
-            # Filter the dataframe by group and drop missing values
-            group1_data = input_data[input_data['Group'] == group1][otu].dropna()
-            group2_data = input_data[input_data['Group'] == group2][otu].dropna()
-
-            # Ensure equal lengths before performing the test
-            min_len = min(len(group1_data), len(group2_data))
-            if min_len > 0:
-                stat, p_value = wilcoxon(group1_data[:min_len], group2_data[:min_len])
-
-                # Store the results
-                wilcoxon_results[otu] = (stat, p_value)
-            else:
-                wilcoxon_results[otu] = (None, None)
-
-        # Display the results
-        for otu, (stat, p_value) in wilcoxon_results.items():
-            print(f"{otu}: Wilcoxon statistic = {stat}, P-value = {p_value}")
-
-    def permanova(self):
-        distance = self.beta_diversity()
-        grouping = self.Metadata['Group']
-        permanova_results = permanova(distance, grouping)
-        return permanova_results
\ No newline at end of file
+        w_stat, p_value = batch_stats.wilcoxon(groups)
+        return batch_stats.results_frame(self.OTU_table.index, w_stat, p_value)
+
+    @instrumentation.timed("analyzer.differential_abundance")
+    def differential_abundance(self, test='t_test', correction='fdr_bh', alpha=0.05,
+                               min_prevalence=2, min_abundance=0.0):
+        """
+            Tests all OTUs with one of the batched tests and returns one compact result table.
+
+            OTUs found in fewer than min_prevalence samples, with fewer than min_abundance reads
+            or that cannot reach significance (see batch_stats.testable) are not tested.
+
+            Parameters
+            ----------
+            test : str
+                't_test', 'anova', 'kruskal' or 'wilcoxon'.
+            correction : str
+                'fdr_bh', 'bonferroni' or 'none'.
+            alpha : float
+                Significance level of the q-values.
+
+            Returns
+            -------
+            pandas.DataFrame
+                Columns 'statistic', 'pvalue', 'qvalue' and 'significant' for the tested OTUs,
+                sorted by q-value.
+            """
+        if test not in batch_stats.TESTS:
+            raise ValueError(f"Unknown test: {test}")
+        selected = batch_stats.prefilter(self.OTU_table, min_prevalence, min_abundance)
+        otus = self.OTU_table.loc[selected]
+        group_names, groups = batch_stats.split_groups(otus, self.Metadata)
+        keep = batch_stats.testable(test, groups, alpha)
+        instrumentation.rows(int(keep.sum()))
+        groups = [group[keep] for group in groups]
+        statistic, p_value = batch_stats.TESTS[test](groups)
+
+        result = batch_stats.results_frame(otus.index[keep], statistic, p_value)
+        result['qvalue'] = batch_stats.adjust_pvalues(result['pvalue'], correction)
+        result['significant'] = result['qvalue'] <= alpha
+        return result.sort_values(['qvalue', 'pvalue'], na_position='last')
+
+    def sample_groups(self, distance):
+        # Group of every sample of a distance matrix, in the order of its IDs
+        sample_groups = self.Metadata.set_index('SampleID')['Group']
+        sample_groups.index = sample_groups.index.astype(str)
+        return sample_groups.loc[list(distance.ids)].to_numpy()
+
+    # Permutation tests of the grouping on the beta diversity. The distances come from the cache.
+    # alpha enables early stopping, seed makes the p-value reproducible, workers is the number of
+    # processes (see permutation_tests).
+    @instrumentation.timed("analyzer.permanova")
+    def permanova(self, metric="braycurtis", permutations=999, seed=None, alpha=None, workers=None):
+        distance = self.beta_diversity(metric)
+        return permutation_tests.permanova(distance, self.sample_groups(distance), permutations,
+                                           seed=seed, alpha=alpha, workers=workers)
+
+    @instrumentation.timed("analyzer.anosim")
+    def anosim(self, metric="braycurtis", permutations=999, seed=None, alpha=None, workers=None):
+        distance = self.beta_diversity(metric)
+        return permutation_tests.anosim(distance, self.sample_groups(distance), permutations,
+                                        seed=seed, alpha=alpha, workers=workers)
+
+    @instrumentation.timed("analyzer.permdisp")
+    def permdisp(self, metric="braycurtis", permutations=999, seed=None, alpha=None, workers=None):
+        distance = self.beta_diversity(metric)
+        return permutation_tests.permdisp(distance, self.sample_groups(distance), permutations,
+                                          seed=seed, alpha=alpha, workers=workers)
+
+
+# Helper function. Fingerprint of a table built from another table by a change (for example added samples),
+# from the fingerprint of the old table and of the change only. None if the old fingerprint was never computed.
+def _derived_fingerprint(fingerprint, change):
+    if fingerprint is None:
+        return None
+    return hashlib.sha1((fingerprint + change).encode()).hexdigest()
@@ -1,16 +1,79 @@
+import os
+import numpy as np
 import pandas as pd
 from io import StringIO
-from Model.get_lineage import get_lineage
-from functools import reduce
+from Model.get_lineage import get_lineage, lineage_table
+from Model import instrumentation
 
-# Function merges all datasets into 1 comparison dataset in csv format.
-def merge_data(list_of_datasets):
+@instrumentation.timed()
+def merge_data(list_of_datasets, output_path=None):
+    """
+        Merges all datasets into 1 comparison dataset.
 
-    df_merged = reduce(lambda left, right: pd.merge(left,right, on=['Taxa'], how='outer'), list_of_datasets)
-    # Save the output in csv file
-    pd.DataFrame.to_csv(df_merged, 'merged.csv', sep='\t', index=False)
+        One global, sorted index of Taxa IDs is built first. The read counts of every
+        sample are then scattered into one preallocated (taxa x samples) float32 matrix,
+        so every dataset is copied exactly once. Taxa missing in a sample stay empty (NaN).
 
-    print('Datasets were successfully merged!')
+        Parameters
+        ----------
+        list_of_datasets : list
+            DataFrames with a 'Taxa' column and one column per sample (as returned by
+            dataset_modifier) or paths to tab-delimited files of the same layout.
+            Files are streamed: only their Taxa column is read in the first pass
+            and only one file is held in memory at a time in the second.
+        output_path : str, optional
+            Where to save the merged dataset. The format follows the extension:
+            '.parquet', '.npz' (arrays 'counts', 'taxa' and 'samples') or tab-delimited text otherwise.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The comparison dataset: a 'Taxa' column followed by one column per sample.
+        """
+    # First pass: Taxa IDs and sample names of every dataset
+    taxa_per_dataset = []
+    samples = []
+    for dataset in list_of_datasets:
+        if isinstance(dataset, pd.DataFrame):
+            taxa_per_dataset.append(dataset.iloc[:, 0].to_numpy(dtype=np.int64))
+            samples.extend(dataset.columns[1:])
+        else:
+            taxa_column = pd.read_csv(dataset, sep="\t", usecols=[0], dtype="int64")
+            taxa_per_dataset.append(taxa_column.iloc[:, 0].to_numpy())
+            samples.extend(pd.read_csv(dataset, sep="\t", nrows=0).columns[1:])
+    all_taxa = np.unique(np.concatenate(taxa_per_dataset)) if taxa_per_dataset else np.array([], dtype=np.int64)
+
+    # Second pass: scatter the counts of every dataset into the matrix
+    counts = np.full((len(all_taxa), len(samples)), np.nan, dtype=np.float32)
+    column = 0
+    for dataset, taxa in zip(list_of_datasets, taxa_per_dataset):
+        if not isinstance(dataset, pd.DataFrame):
+            dataset = read_comparison_file(dataset)
+        values = dataset.iloc[:, 1:].to_numpy(dtype=np.float32)
+        rows = np.searchsorted(all_taxa, taxa)
+        counts[rows, column:column + values.shape[1]] = values
+        column += values.shape[1]
+
+    df_merged = pd.DataFrame(counts, columns=samples)
+    df_merged.insert(0, 'Taxa', all_taxa)
+    instrumentation.rows(len(all_taxa))
+
+    if output_path is not None:
+        with instrumentation.stage("modificator.write_comparison_file", rows=len(df_merged)):
+            write_comparison_file(df_merged, output_path)
+        print('Datasets were successfully merged!')
+    return df_merged
+
+# Function saves a comparison dataset. The format follows the extension of the path.
+def write_comparison_file(df, output_path):
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == '.parquet':
+        df.to_parquet(output_path, index=False)
+    elif extension == '.npz':
+        np.savez(output_path, counts=df.iloc[:, 1:].to_numpy(), taxa=df['Taxa'].to_numpy(),
+                 samples=np.asarray(df.columns[1:], dtype=str))
+    else:
+        pd.DataFrame.to_csv(df, output_path, sep='\t', index=False)
 
 # Function modifies the given file:
 # 1. skips first 2 rows;
@@ -32,25 +95,69 @@ def dataset_modifier(input, name):
         # df.to_csv(input, sep='\t', index=False)
         return df
 
+# Function reads a comparison file in one pass.
+# Taxa IDs are parsed as integers and the read counts as float32 (empty cells become NaN).
+def read_comparison_file(comparison_file):
+    # Read only the header first to know the sample columns
+    header = pd.read_csv(comparison_file, sep="\t", nrows=0).columns
+    dtypes = {column: "float32" for column in header[1:]}
+    dtypes[header[0]] = "int64"
+    with instrumentation.stage("modificator.read_comparison_file") as record:
+        df = pd.read_csv(comparison_file, sep="\t", dtype=dtypes)
+        record.rows = len(df)
+    return df
+
+def load_comparison_file(comparison_file):
+    """
+        Parses a comparison file once and builds everything needed for the analysis.
+
+        Parameters
+        ----------
+        comparison_file : str
+            Path to a tab-delimited file with a 'Taxa' column of NCBI taxonomy IDs
+            followed by one column of read counts per sample.
+
+        Returns
+        -------
+        tuple
+            (otu_mat, taxids, tax_mat) where otu_mat is the OTU table (float32 counts),
+            taxids is a Series mapping every OTU to its taxonomy ID and
+            tax_mat is the taxonomy table. All three share the OTU index.
+        """
+    return split_comparison(read_comparison_file(comparison_file))
+
+# Function splits a comparison dataset (Taxa column + one column per sample) into
+# (otu_mat, taxids, tax_mat), like load_comparison_file() does for a file.
+@instrumentation.timed()
+def split_comparison(merged_df):
+    # Split the Taxa IDs from the counts without copying the count columns
+    taxids = merged_df.pop(merged_df.columns[0])
+    new_index = otu_index(len(merged_df))
+    merged_df.index = new_index
+    taxids.index = new_index
+    # One row per taxid with the OTU index of the taxids, unresolved taxids included
+    tax_mat = lineage_table(taxids)
+    return merged_df, taxids, tax_mat
+
+# Function creates the OTU index: OTU1, OTU2, ...
+def otu_index(num_of_rows):
+    return ['OTU' + str(i + 1) for i in range(num_of_rows)]
+
 def otu_table(comparison_file):
     # Read the comparison csv file
-    merged_df = pd.read_csv(comparison_file,sep = "\t")
+    merged_df = read_comparison_file(comparison_file)
     # Index of the column with Taxa IDs
     column_index_to_delete = 0
     # Drop the column with Taxa IDs
     if column_index_to_delete < len(merged_df.columns):
         merged_df = merged_df.drop(merged_df.columns[column_index_to_delete], axis=1)
-    # Get the number of rows in the dataset
-    num_of_rows = len(merged_df)
     # Set the index of the dataframe
-    new_index = ['OTU' + str(i+1)for i in range(num_of_rows)]
-    merged_df.index = new_index
+    merged_df.index = otu_index(len(merged_df))
     return merged_df
 
 def tax_table(dataframe):
     # Get the Dataframe with lineages
     df = get_lineage(dataframe)
     # Set the index for the dataframe
-    new_index = ['OTU' + str(i + 1) for i in range(len(df))]
-    df.index = new_index
-    return df
\ No newline at end of file
+    df.index = otu_index(len(df))
+    return df
@@ -0,0 +1,212 @@
+import os
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# Permutation tests on distance matrices: PERMANOVA, ANOSIM and PERMDISP.
+#
+# Permutations are evaluated in batches: a batch of permuted groupings is turned into one-hot
+# matrices and the test statistic of all of them is computed with a few matrix products.
+# Batches are spread over a process pool. Every batch gets its own child of one
+# numpy SeedSequence, so the result only depends on the seed, never on the number of workers.
+# With alpha set, the test stops as soon as the p-value is confidently above or below alpha.
+
+# Number of permutations evaluated in one batch
+BATCH_SIZE = 100
+# Below this amount of work (permutations x samples^2) the batches run in this process
+PARALLEL_WORK = 50_000_000
+# z-value of the confidence interval used for early stopping (99.9%)
+STOP_Z = 3.29
+# Start method of the worker processes. A forked child of a process with running threads (GUI, BLAS) can deadlock.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Data of the running test in a worker process, set by _init_worker
+_worker_state = None
+
+
+def permanova(distance_matrix, grouping, permutations=999, seed=None, workers=None, alpha=None):
+    """
+        PERMANOVA (pseudo-F) test of the grouping on a distance matrix.
+
+        Parameters
+        ----------
+        distance_matrix : skbio.DistanceMatrix
+        grouping : array-like
+            Group of every sample, in the order of distance_matrix.ids.
+        permutations : int
+            Maximal number of permutations.
+        seed : int, optional
+            Seed of the permutations, for reproducible p-values.
+        workers : int, optional
+            Number of processes. By default all cores for large tests and 1 for small ones.
+        alpha : float, optional
+            Enables early stopping once the p-value is confidently above or below alpha.
+
+        Returns
+        -------
+        pandas.Series
+            The same fields as skbio's permanova().
+        """
+    labels, num_groups = _encode(grouping)
+    data = {"squared": np.asarray(distance_matrix.data, dtype=np.float64) ** 2, "sizes": np.bincount(labels)}
+    return _run("PERMANOVA", "pseudo-F", "permanova", data, labels, num_groups,
+                permutations, seed, workers, alpha)
+
+
+def anosim(distance_matrix, grouping, permutations=999, seed=None, workers=None, alpha=None):
+    # ANOSIM (R statistic). Same parameters and result as permanova().
+    from scipy import stats
+
+    labels, num_groups = _encode(grouping)
+    distances = np.asarray(distance_matrix.data, dtype=np.float64)
+    upper = np.triu_indices(len(labels), k=1)
+    ranks = np.zeros_like(distances)
+    ranks[upper] = stats.rankdata(distances[upper])
+    ranks += ranks.T
+    data = {"ranks": ranks, "sizes": np.bincount(labels)}
+    return _run("ANOSIM", "R", "anosim", data, labels, num_groups,
+                permutations, seed, workers, alpha)
+
+
+def permdisp(distance_matrix, grouping, permutations=999, seed=None, workers=None, alpha=None):
+    # PERMDISP (F statistic of the distances to the group centroids in principal coordinate space).
+    # Same parameters and result as permanova(). Axes with negative eigenvalues are left out.
+    labels, num_groups = _encode(grouping)
+    data = {"coordinates": _principal_coordinates(distance_matrix), "sizes": np.bincount(labels)}
+    return _run("PERMDISP", "F-value", "permdisp", data, labels, num_groups,
+                permutations, seed, workers, alpha)
+
+
+# Helper function. Integer codes 0 ... k-1 of the groups.
+def _encode(grouping):
+    codes, names = pd.factorize(np.asarray(grouping))
+    if len(names) < 2:
+        raise ValueError("At least two groups are required.")
+    if len(names) == len(codes):
+        raise ValueError("Every group contains one sample only.")
+    return codes, len(names)
+
+
+# Helper function. Coordinates of the samples on all principal coordinates with positive eigenvalues.
+def _principal_coordinates(distance_matrix):
+    distances = np.asarray(distance_matrix.data, dtype=np.float64)
+    n = len(distances)
+    centering = np.eye(n) - np.full((n, n), 1.0 / n)
+    gower = -0.5 * centering @ (distances ** 2) @ centering
+    eigenvalues, eigenvectors = np.linalg.eigh(gower)
+    positive = eigenvalues > 1e-10 * max(1.0, eigenvalues.max())
+    return eigenvectors[:, positive] * np.sqrt(eigenvalues[positive])
+
+
+# Helper function. (permutations x samples x groups) one-hot matrices of a batch of groupings.
+def _one_hot(labels, num_groups):
+    return (labels[:, :, None] == np.arange(num_groups)).astype(np.float64)
+
+
+# Helper function. Sum of values[i, j] over all pairs (i, j) of the same group, for every grouping and group.
+def _within_sums(values, one_hot):
+    # values @ one-hot for all groupings at once: (samples x permutations*groups)
+    num_permutations, num_samples, num_groups = one_hot.shape
+    flat = one_hot.transpose(1, 0, 2).reshape(num_samples, -1)
+    products = (flat * (values @ flat)).sum(axis=0)
+    return products.reshape(num_permutations, num_groups)
+
+
+def _statistic(test, data, labels):
+    # Test statistic for every row of labels (permutations x samples)
+    sizes = data["sizes"]
+    num_groups = len(sizes)
+    one_hot = _one_hot(labels, num_groups)
+    num_samples = labels.shape[1]
+
+    if test == "permanova":
+        squared = data["squared"]
+        total = squared.sum() / (2.0 * num_samples)
+        within = (_within_sums(squared, one_hot) / (2.0 * sizes)).sum(axis=1)
+        return ((total - within) / (num_groups - 1)) / (within / (num_samples - num_groups))
+
+    if test == "anosim":
+        ranks = data["ranks"]
+        num_pairs = num_samples * (num_samples - 1) / 2.0
+        num_within = (sizes * (sizes - 1) / 2.0).sum()
+        within = _within_sums(ranks, one_hot).sum(axis=1) / 2.0
+        between = ranks.sum() / 2.0 - within
+        mean_within = within / num_within
+        mean_between = between / (num_pairs - num_within)
+        return (mean_between - mean_within) / (num_pairs / 2.0)
+
+    if test == "permdisp":
+        coordinates = data["coordinates"]
+        # Group centroids of every grouping: (permutations x groups x axes)
+        centroids = np.einsum("psg,sa->pga", one_hot, coordinates) / sizes[None, :, None]
+        own_centroids = np.take_along_axis(centroids, labels[:, :, None], axis=1)
+        spread = np.sqrt(((coordinates[None, :, :] - own_centroids) ** 2).sum(axis=2))
+        # One-way ANOVA of the distances to the centroids
+        group_means = np.einsum("psg,ps->pg", one_hot, spread) / sizes
+        grand_mean = spread.mean(axis=1, keepdims=True)
+        between = (sizes * (group_means - grand_mean) ** 2).sum(axis=1)
+        own_means = np.take_along_axis(group_means, labels, axis=1)
+        within = ((spread - own_means) ** 2).sum(axis=1)
+        return (between / (num_groups - 1)) / (within / (num_samples - num_groups))
+
+    raise ValueError(f"Unknown test: {test}")
+
+
+def _init_worker(test, data, labels):
+    global _worker_state
+    _worker_state = (test, data, labels)
+
+
+# Number of permutations of one batch with a statistic >= the observed one
+def _count_batch(seed_sequence, size, observed):
+    test, data, labels = _worker_state
+    return _count(test, data, labels, seed_sequence, size, observed)
+
+
+def _count(test, data, labels, seed_sequence, size, observed):
+    rng = np.random.default_rng(seed_sequence)
+    permuted = rng.permuted(np.broadcast_to(labels, (size, len(labels))), axis=1)
+    return int((_statistic(test, data, permuted) >= observed).sum())
+
+
+# Helper function. True when the p-value is confidently on one side of alpha.
+def _confident(hits, done, alpha):
+    p_value = (hits + 1) / (done + 1)
+    margin = STOP_Z * np.sqrt(p_value * (1 - p_value) / done)
+    return p_value + margin < alpha or p_value - margin > alpha
+
+
+def _run(method, statistic_name, test, data, labels, num_groups, permutations, seed, workers, alpha):
+    observed = float(_statistic(test, data, labels[None, :])[0])
+    sizes = [min(BATCH_SIZE, permutations - start) for start in range(0, permutations, BATCH_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers is None:
+        workers = (os.cpu_count() or 1) if permutations * len(labels) ** 2 >= PARALLEL_WORK else 1
+
+    hits = done = 0
+    if workers > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD),
+                                 initializer=_init_worker, initargs=(test, data, labels)) as pool:
+            futures = [pool.submit(_count_batch, seed_sequence, size, observed)
+                       for seed_sequence, size in zip(seeds, sizes)]
+            # Results are taken in batch order, so early stopping is reproducible as well
+            for future, size in zip(futures, sizes):
+                hits += future.result()
+                done += size
+                if alpha is not None and _confident(hits, done, alpha):
+                    break
+            for future in futures:
+                future.cancel()
+    else:
+        for seed_sequence, size in zip(seeds, sizes):
+            hits += _count(test, data, labels, seed_sequence, size, observed)
+            done += size
+            if alpha is not None and _confident(hits, done, alpha):
+                break
+
+    p_value = (hits + 1) / (done + 1) if done else np.nan
+    return pd.Series([method, statistic_name, len(labels), num_groups, observed, p_value, done],
+                     index=["method name", "test statistic name", "sample size", "number of groups",
+                            "test statistic", "p-value", "number of permutations"],
+                     name=f"{method} results")
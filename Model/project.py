@@ -0,0 +1,153 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from Model.microbiome_class import MicrobiomeDataAnalyzer
+from Model.get_lineage import TaxidsByName
+from Model.sparse_counts import is_sparse, from_matrix
+
+# A project is a directory of .npy files plus a manifest.json:
+#   counts.npy                          dense OTU table (OTUs x samples, float32)
+#   counts_data/indices/indptr.npy      the same as a CSR matrix for sparse OTU tables
+#   taxids.npy                          NCBI taxonomy ID of every OTU (optional)
+#   tax_<rank>.npy                      integer codes of every rank of the taxonomy table (-1 = empty)
+#   distances/<metric>.npy              computed distance matrices
+# The names behind the codes, the taxids of the names, the unresolved and merged taxids, the row and
+# column labels, the fingerprints of the tables and the metadata are in the manifest.
+# Loading memory-maps the arrays, so nothing is parsed and several processes share the same pages.
+
+PROJECT_VERSION = 1
+MANIFEST = "manifest.json"
+
+
+def save_project(path, analyzer, distances=None):
+    """
+        Saves the data of an analyzer as a project directory.
+
+        Parameters
+        ----------
+        path : str
+            Project directory. Created if it does not exist, existing files are overwritten.
+        analyzer : MicrobiomeDataAnalyzer
+        distances : dict, optional
+            {metric name: skbio.DistanceMatrix} of already computed distances.
+            By default the distances cached by the analyzer are saved.
+        """
+    if distances is None:
+        distances = analyzer.cached_distances()
+    os.makedirs(os.path.join(path, "distances"), exist_ok=True)
+    otu_table = analyzer.OTU_table
+    manifest = {
+        "version": PROJECT_VERSION,
+        "otus": [str(otu) for otu in otu_table.index],
+        "samples": [str(sample) for sample in otu_table.columns],
+        "sparse": is_sparse(otu_table),
+        "taxonomy": {},
+        "metadata": None,
+        "distances": {},
+        # Cache keys of the tables, so loading does not hash them again
+        "fingerprints": analyzer.fingerprints(),
+    }
+
+    if manifest["sparse"]:
+        counts = otu_table.sparse.to_coo().tocsr()
+        np.save(os.path.join(path, "counts_data.npy"), counts.data.astype(np.float32))
+        np.save(os.path.join(path, "counts_indices.npy"), counts.indices)
+        np.save(os.path.join(path, "counts_indptr.npy"), counts.indptr)
+    else:
+        np.save(os.path.join(path, "counts.npy"), otu_table.to_numpy(dtype=np.float32))
+
+    if getattr(analyzer, "Taxa_ids", None) is not None:
+        np.save(os.path.join(path, "taxids.npy"), np.asarray(analyzer.Taxa_ids, dtype=np.int64))
+
+    if isinstance(analyzer.Taxa_table, pd.DataFrame):
+        manifest["taxonomy_index"] = [str(otu) for otu in analyzer.Taxa_table.index]
+        for rank in analyzer.Taxa_table.columns:
+            codes, names = pd.factorize(analyzer.Taxa_table[rank])
+            np.save(os.path.join(path, f"tax_{rank}.npy"), codes.astype(np.int32))
+            manifest["taxonomy"][rank] = [str(name) for name in names]
+        attrs = analyzer.Taxa_table.attrs
+        manifest["taxonomy_attrs"] = {
+            "taxids": {str(name): int(taxid) for name, taxid in attrs.get("taxids", {}).items()},
+            "unresolved": [int(taxid) for taxid in attrs.get("unresolved", [])],
+            "merged": {str(old): int(new) for old, new in attrs.get("merged", {}).items()},
+        }
+
+    if isinstance(analyzer.Metadata, pd.DataFrame):
+        manifest["metadata"] = analyzer.Metadata.to_dict(orient="list")
+
+    for metric, matrix in distances.items():
+        np.save(os.path.join(path, "distances", f"{metric}.npy"), matrix.data)
+        manifest["distances"][metric] = [str(sample) for sample in matrix.ids]
+
+    # The manifest is written last: a project without it is incomplete
+    with open(os.path.join(path, MANIFEST), "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle)
+
+
+def load_project(path, mmap=True):
+    """
+        Loads a project saved with save_project().
+
+        Parameters
+        ----------
+        path : str
+            Project directory.
+        mmap : bool
+            Memory-map the arrays (read-only) instead of reading them into memory.
+
+        Returns
+        -------
+        tuple
+            (analyzer, distances) where distances is a dict {metric name: skbio.DistanceMatrix}.
+        """
+    from skbio.stats.distance import DistanceMatrix
+
+    with open(os.path.join(path, MANIFEST), encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    if manifest.get("version") != PROJECT_VERSION:
+        raise ValueError(f"Unsupported project version: {manifest.get('version')}")
+    mmap_mode = "r" if mmap else None
+
+    def load(name):
+        return np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+
+    index = pd.Index(manifest["otus"])
+    if manifest["sparse"]:
+        counts = sparse.csr_matrix((load("counts_data.npy"), load("counts_indices.npy"), load("counts_indptr.npy")),
+                                   shape=(len(manifest["otus"]), len(manifest["samples"])))
+        otu_table = from_matrix(counts, index, manifest["samples"])
+    else:
+        # copy=False keeps the memory-mapped array as the data of the DataFrame
+        otu_table = pd.DataFrame(load("counts.npy"), index=index, columns=manifest["samples"], copy=False)
+
+    taxids = None
+    if os.path.exists(os.path.join(path, "taxids.npy")):
+        taxids = pd.Series(load("taxids.npy"), index=index, name="Taxa", copy=False)
+
+    tax_table = None
+    if manifest["taxonomy"]:
+        tax_table = pd.DataFrame(index=pd.Index(manifest["taxonomy_index"]))
+        for rank, names in manifest["taxonomy"].items():
+            tax_table[rank] = pd.Categorical.from_codes(load(f"tax_{rank}.npy"), categories=names)
+        attrs = manifest.get("taxonomy_attrs", {})
+        tax_table.attrs["unresolved"] = attrs.get("unresolved", [])
+        tax_table.attrs["merged"] = {int(old): new for old, new in attrs.get("merged", {}).items()}
+        tax_table.attrs["taxids"] = TaxidsByName(attrs.get("taxids", {}))
+
+    metadata = None
+    if manifest["metadata"] is not None:
+        metadata = pd.DataFrame(manifest["metadata"])
+
+    distances = {}
+    for metric, ids in manifest["distances"].items():
+        distances[metric] = DistanceMatrix(load(os.path.join("distances", f"{metric}.npy")), ids=ids, validate=False)
+
+    analyzer = MicrobiomeDataAnalyzer(otu_table, tax_table, metadata, taxids=taxids)
+    # Projects saved without fingerprints get them hashed on first use
+    analyzer.assume_fingerprints(manifest.get("fingerprints", {}))
+    for metric, matrix in distances.items():
+        analyzer.remember_distance(metric, matrix)
+    return analyzer, distances
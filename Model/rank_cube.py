@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from Model.sparse_counts import count_matrix
+from Model.labels import TaxonLabels
+
+# Read counts summed at every taxonomic rank, computed once per data set.
+#
+# Every rank of the taxonomy table is factorized into integer codes (-1 = not assigned, see Model.labels).
+# The indicator matrices of all ranks are stacked into one sparse (names of all ranks x OTUs)
+# matrix, so the sums of all seven ranks come from one product with the count matrix.
+#
+# add_samples() and remove_samples() update a cube in place: only the counts of added samples are
+# summed, the sums of the other samples are kept (OTUs added with new samples have no reads in them).
+
+
+class RankCube:
+    """
+        Abundances of an OTU table aggregated at all ranks of its taxonomy table.
+
+        Attributes
+        ----------
+        ranks : list
+            Rank names (the columns of the taxonomy table).
+        labels : TaxonLabels
+            Integer-coded taxonomy of the OTUs and their lowest assigned names.
+        otu_totals : pandas.Series
+            Reads of every OTU.
+        sample_totals : pandas.Series
+            Reads of every sample.
+        """
+
+    def __init__(self, otu_table, taxa_table):
+        self.labels = TaxonLabels.from_table(taxa_table, otu_table.index)
+        self.ranks = self.labels.ranks
+        self.otus = otu_table.index
+        self.samples = otu_table.columns
+
+        counts = count_matrix(otu_table)
+        self.otu_totals = pd.Series(np.asarray(counts.sum(axis=1)).ravel(), index=self.otus)
+        self.sample_totals = pd.Series(np.asarray(counts.sum(axis=0)).ravel(), index=self.samples)
+        self._sums = _rank_sums(self.labels, counts)
+        self._frames = {}
+
+    def add_samples(self, otu_table, taxa_table, samples):
+        """
+            Adds the sums of new samples in place.
+
+            Parameters
+            ----------
+            otu_table : pandas.DataFrame
+                All samples: the samples of the cube followed by the new ones. May contain new OTUs.
+            taxa_table : pandas.DataFrame
+                Taxonomy table of all OTUs.
+            samples : list
+                The new samples (columns of otu_table).
+            """
+        labels = TaxonLabels.from_table(taxa_table, otu_table.index)
+        counts = count_matrix(otu_table[list(samples)])
+        added_sums = _rank_sums(labels, counts)
+        old_columns = otu_table.columns.get_indexer(self.samples)
+        new_columns = otu_table.columns.get_indexer(samples)
+        for rank in self.ranks:
+            # Names of the cube are a subset of the new names
+            rows = labels.names[rank].get_indexer(self.labels.names[rank])
+            sums = np.zeros((len(labels.names[rank]), len(otu_table.columns)))
+            sums[np.ix_(rows, old_columns)] = self._sums[rank]
+            sums[:, new_columns] = added_sums[rank]
+            self._sums[rank] = sums
+
+        added_totals = np.asarray(counts.sum(axis=1)).ravel()
+        self.otu_totals = self.otu_totals.reindex(otu_table.index, fill_value=0.0) + added_totals
+        self.sample_totals = pd.concat([self.sample_totals, pd.Series(np.asarray(counts.sum(axis=0)).ravel(),
+                                                                      index=pd.Index(samples))])
+        self.sample_totals = self.sample_totals.reindex(otu_table.columns)
+        self.labels, self.otus, self.samples = labels, otu_table.index, otu_table.columns
+        self._frames = {}
+
+    def remove_samples(self, otu_table):
+        # Drops the sums of the samples that are no longer columns of otu_table, in place. The OTUs stay.
+        keep = self.samples.get_indexer(otu_table.columns)
+        for rank in self.ranks:
+            self._sums[rank] = self._sums[rank][:, keep]
+        self.otu_totals = pd.Series(np.asarray(count_matrix(otu_table).sum(axis=1)).ravel(), index=self.otus)
+        self.sample_totals = self.sample_totals.iloc[keep]
+        self.samples = otu_table.columns
+        self._frames = {}
+
+    def rank_sums(self, rank):
+        # Rows: names of the rank (sorted), columns: samples. OTUs without a name at the rank are left out.
+        if rank not in self._frames:
+            self._frames[rank] = pd.DataFrame(self._sums[rank], index=self.labels.names[rank],
+                                              columns=self.samples)
+        return self._frames[rank]
+
+    def relative_abundance(self, rank):
+        # Share of the reads of every sample per name of the rank
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.rank_sums(rank) / self.sample_totals.to_numpy()
+
+    def lowest_taxa(self):
+        # Name at the deepest assigned rank of every OTU (categorical, NaN without taxonomy)
+        return self.labels.lowest_taxa()
+
+    def top_otus(self, top):
+        # OTUs with the most reads
+        return self.otu_totals.nlargest(top).index
+
+
+# Helper function. {rank: (names x samples) sums} of the counts of all ranks from one stacked indicator product.
+def _rank_sums(labels, counts):
+    codes, names = labels.codes, labels.names
+    # Row offsets[i] + code belongs to rank i
+    sizes = [len(names[rank]) for rank in labels.ranks]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    assigned = codes >= 0
+    otu_numbers = np.broadcast_to(np.arange(len(codes))[:, None], codes.shape)
+    rows = (codes + offsets[:-1])[assigned]
+    indicator = sparse.csr_matrix((np.ones(len(rows)), (rows, otu_numbers[assigned])),
+                                  shape=(offsets[-1], len(codes)))
+    sums = indicator @ counts
+    sums = sums.toarray() if sparse.issparse(sums) else np.asarray(sums)
+    return {rank: sums[offsets[i]:offsets[i + 1]] for i, rank in enumerate(labels.ranks)}
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Helpers for OTU tables stored as sparse DataFrames (pandas SparseDtype with fill value 0).
+# Most OTU tables are mostly empty. Empty cells are stored as 0 instead of NaN,
+# so the memory grows with the number of non-zero counts only.
+
+
+def to_sparse(otu_table, dtype="float32"):
+    # Empty cells (NaN) become the fill value 0
+    return otu_table.fillna(0).astype(pd.SparseDtype(dtype, 0))
+
+
+def from_matrix(matrix, index, columns, dtype="float32"):
+    # Sparse DataFrame of a scipy.sparse (OTUs x samples) matrix
+    frame = pd.DataFrame.sparse.from_spmatrix(sparse.csc_matrix(matrix), index=index, columns=columns)
+    return frame.astype(pd.SparseDtype(dtype, 0))
+
+
+def is_sparse(otu_table):
+    return len(otu_table.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in otu_table.dtypes)
+
+
+def to_dense(otu_table):
+    # Dense copy of a (usually small) part of a sparse table, for plotting
+    if is_sparse(otu_table):
+        return otu_table.sparse.to_dense()
+    return otu_table
+
+
+def count_matrix(otu_table):
+    """
+        Counts as a matrix with one row per OTU and one column per sample.
+
+        Returns a scipy.sparse CSR matrix for sparse tables (without densifying)
+        and a float64 array with empty cells set to 0 for dense tables.
+        """
+    if is_sparse(otu_table):
+        return otu_table.sparse.to_coo().tocsr()
+    return np.nan_to_num(otu_table.to_numpy(dtype=np.float64))
+
+
+def row_sums(otu_table):
+    # Total read count of every OTU as a dense Series
+    return pd.Series(np.asarray(count_matrix(otu_table).sum(axis=1)).ravel(), index=otu_table.index)
+
+
+def aggregate(otu_table, labels):
+    """
+        Sums the OTUs sharing a label (for example all OTUs of one genus).
+
+        The sum is one product with a sparse indicator matrix (labels x OTUs),
+        so sparse tables are never densified. OTUs without a label are left out,
+        like groupby() does.
+
+        Parameters
+        ----------
+        otu_table : pandas.DataFrame
+            Rows: OTUs, columns: samples.
+        labels : pandas.Series
+            Label of every OTU, indexed by OTU ID.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Rows: labels (sorted), columns: samples.
+        """
+    labels = labels.reindex(otu_table.index)
+    codes, names = pd.factorize(labels, sort=True)
+    assigned = codes >= 0
+    indicator = sparse.csr_matrix(
+        (np.ones(assigned.sum()), (codes[assigned], np.flatnonzero(assigned))),
+        shape=(len(names), len(otu_table)))
+    sums = indicator @ count_matrix(otu_table)
+    if sparse.issparse(sums):
+        sums = sums.toarray()
+    return pd.DataFrame(sums, index=pd.Index(names, name=labels.name), columns=otu_table.columns)
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+from Model.labels import TaxonLabels
+
+# In-memory lookups between taxon names, NCBI taxids and lineages, built once from the resolved
+# taxonomy table. Interactive lookups (clicks, tooltips, status bar) are dictionary accesses
+# instead of queries against the taxonomy database.
+#
+# Only the distinct lineages of the table are walked: rows with the same rank codes share one lineage.
+# The taxid of a name is its own taxid from lineage resolution (taxa_table.attrs["taxids"], see
+# Model.get_lineage.lineage_table), never the taxid of an OTU below it.
+
+
+class TaxonomyIndex:
+    """
+        Bidirectional index name <-> taxid <-> lineage of the taxa of a data set.
+
+        Parameters
+        ----------
+        taxa_table : pandas.DataFrame
+            Taxonomy table (rows: OTUs, columns: ranks).
+        taxids : pandas.Series, optional
+            NCBI taxid of every OTU, indexed like the taxonomy table. Their lowest assigned
+            names are found by taxid as well.
+        """
+
+    def __init__(self, taxa_table, taxids=None):
+        labels = TaxonLabels.from_table(taxa_table)
+        # name -> ((rank, name), ...) from the highest rank down to the name
+        self._lineages = {}
+        for row_codes in np.unique(labels.codes, axis=0):
+            lineage = []
+            for rank, code in zip(labels.ranks, row_codes):
+                if code >= 0:
+                    name = labels.names[rank][code]
+                    lineage.append((rank, name))
+                    # The first lineage found is kept for names used in several lineages
+                    self._lineages.setdefault(name, tuple(lineage))
+
+        # name <-> own taxid of every named taxon
+        self._taxid_of = {name: int(taxid) for name, taxid in taxa_table.attrs.get("taxids", {}).items()
+                          if name in self._lineages}
+        self._name_of = {taxid: name for name, taxid in self._taxid_of.items()}
+        # OTU taxid -> name at the deepest assigned rank of the OTU (for example a strain -> its species)
+        if taxids is not None:
+            pairs = pd.DataFrame({"taxid": taxids.reindex(taxa_table.index).to_numpy(),
+                                  "name": labels.lowest_taxa().astype(object).to_numpy()})
+            pairs = pairs.dropna().drop_duplicates("taxid")
+            for taxid, name in zip(pairs["taxid"].astype(np.int64).tolist(), pairs["name"]):
+                self._name_of.setdefault(taxid, name)
+
+    def __contains__(self, name):
+        return name in self._lineages
+
+    def __len__(self):
+        return len(self._lineages)
+
+    def lineage(self, name):
+        # [(rank, name)] from the highest rank down to the name, or None for unknown names
+        lineage = self._lineages.get(name)
+        return list(lineage) if lineage is not None else None
+
+    def taxid(self, name):
+        # Own taxid of the named taxon, or None
+        return self._taxid_of.get(name)
+
+    def name(self, taxid):
+        # Name of the taxon or lowest assigned name of the OTUs with the taxid, or None
+        return self._name_of.get(int(taxid))
+
+    def lineage_of_taxid(self, taxid):
+        name = self.name(taxid)
+        return self.lineage(name) if name is not None else None
+
+    def describe(self, name):
+        # One line for the status bar: the lineage and the taxid of a name
+        lineage = self.lineage(name)
+        if lineage is None:
+            return None
+        path = ", ".join(taxon for rank, taxon in lineage)
+        taxid = self.taxid(name)
+        return f"{path} (taxid {taxid})" if taxid is not None else path
@@ -0,0 +1,303 @@
+import os
+import csv
+import json
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+# A taxonomy snapshot is a compact, offline copy of the NCBI taxonomy: a directory of .npy files
+# indexed by taxid plus a manifest.json:
+#   parent.npy          parent taxid of every taxid (-1 = no such taxid; the root is its own parent)
+#   rank.npy            rank code of every taxid (index into the ranks of the manifest)
+#   name.npy            name code of every taxid (index into the interned names, -1 = none)
+#   name_offsets.npy    start of every interned name in names.bin (one more entry than names)
+#   names.bin           the interned scientific names, UTF-8, back to back
+#   merged.npy          (old taxid, new taxid) rows of merged taxids, sorted by the old taxid
+# Loading memory-maps the arrays. A lineage is a walk along parent.npy in memory: for many
+# taxids at once it is one vectorized step per level of the tree instead of database queries.
+#
+# Snapshots are compiled from an NCBI taxdump directory (nodes.dmp, names.dmp, merged.dmp) or
+# from the SQLite database of ete3. Model/data/taxdump_fixture is a small taxdump for offline use:
+#   python -m Model.taxonomy_snapshot Model/data/taxdump_fixture ~/.statapp/taxonomy
+#
+# TaxonomySnapshot provides the methods of ete3's NCBITaxa used by Model.get_lineage,
+# so it can be used wherever the NCBITaxa instance is used.
+
+SNAPSHOT_VERSION = 1
+MANIFEST = "manifest.json"
+ROOT = 1
+# Fixture taxdump shipped with the repository
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "taxdump_fixture")
+
+
+def compile_snapshot(source, output_dir):
+    """
+        Compiles a taxonomy snapshot.
+
+        Parameters
+        ----------
+        source : str
+            NCBI taxdump directory (with nodes.dmp and names.dmp, optionally merged.dmp)
+            or the taxa.sqlite file of ete3.
+        output_dir : str
+            Snapshot directory. Created if it does not exist, existing files are overwritten.
+
+        Returns
+        -------
+        TaxonomySnapshot
+        """
+    if os.path.isdir(source):
+        nodes, merged = _read_taxdump(source)
+    else:
+        nodes, merged = _read_ete3(source)
+
+    size = int(nodes["taxid"].max()) + 1
+    taxids = nodes["taxid"].to_numpy(dtype=np.int64)
+    parent = np.full(size, -1, dtype=np.int32)
+    parent[taxids] = nodes["parent"].to_numpy(dtype=np.int32)
+    parent[ROOT] = ROOT
+    rank_codes, ranks = pd.factorize(nodes["rank"].fillna("no rank"))
+    rank = np.zeros(size, dtype=np.int16)
+    rank[taxids] = rank_codes
+    name_codes, names = pd.factorize(nodes["name"])
+    name = np.full(size, -1, dtype=np.int32)
+    name[taxids] = name_codes
+    encoded = [str(value).encode("utf-8") for value in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    merged = merged.sort_values("old").to_numpy(dtype=np.int64).reshape(-1, 2)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for file_name, array in (("parent.npy", parent), ("rank.npy", rank), ("name.npy", name),
+                             ("name_offsets.npy", offsets), ("merged.npy", merged)):
+        np.save(os.path.join(output_dir, file_name), array)
+    with open(os.path.join(output_dir, "names.bin"), "wb") as handle:
+        handle.write(b"".join(encoded))
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "source": os.path.abspath(source),
+        "taxa": int(len(taxids)),
+        "ranks": [str(value) for value in ranks],
+    }
+    # The manifest is written last: a snapshot without it is incomplete
+    with open(os.path.join(output_dir, MANIFEST), "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2)
+    return TaxonomySnapshot(output_dir)
+
+
+def is_snapshot(directory):
+    return os.path.exists(os.path.join(directory, MANIFEST))
+
+
+# Helper function. (nodes, merged) of a taxdump directory. Only scientific names are kept.
+def _read_taxdump(directory):
+    # Fields are separated by '\t|\t', so every other column of a tab-separated read is a '|'
+    def read(file_name, columns, names):
+        return pd.read_csv(os.path.join(directory, file_name), sep="\t", header=None, usecols=columns,
+                           names=names, quoting=csv.QUOTE_NONE, dtype=str, keep_default_na=False)
+
+    nodes = read("nodes.dmp", [0, 2, 4], ["taxid", "parent", "rank"])
+    names = read("names.dmp", [0, 2, 6], ["taxid", "name", "class"])
+    names = names[names["class"] == "scientific name"].drop_duplicates("taxid")
+    nodes = nodes.merge(names[["taxid", "name"]], on="taxid", how="left")
+    nodes[["taxid", "parent"]] = nodes[["taxid", "parent"]].astype(np.int64)
+    merged_path = os.path.join(directory, "merged.dmp")
+    if os.path.exists(merged_path):
+        merged = read("merged.dmp", [0, 2], ["old", "new"]).astype(np.int64)
+    else:
+        merged = pd.DataFrame({"old": [], "new": []}, dtype=np.int64)
+    return nodes, merged
+
+
+# Helper function. (nodes, merged) of the SQLite database of ete3.
+def _read_ete3(path):
+    with sqlite3.connect(path) as connection:
+        nodes = pd.read_sql_query("SELECT taxid, parent, rank, spname AS name FROM species", connection)
+        merged = pd.read_sql_query("SELECT taxid_old AS old, taxid_new AS new FROM merged", connection)
+    # The root has an empty parent in ete3
+    nodes["parent"] = pd.to_numeric(nodes["parent"], errors="coerce").fillna(ROOT).astype(np.int64)
+    return nodes, merged
+
+
+class TaxonomySnapshot:
+    """
+        A compiled taxonomy snapshot (see compile_snapshot()), memory-mapped.
+
+        The arrays are read-only, so one instance can be shared by all threads.
+
+        Parameters
+        ----------
+        directory : str
+            Snapshot directory.
+        mmap : bool
+            Memory-maps the arrays. Without it they are read into memory.
+        """
+
+    def __init__(self, directory, mmap=True):
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as handle:
+            manifest = json.load(handle)
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"{directory}: unsupported snapshot version {manifest.get('version')}")
+        mmap_mode = "r" if mmap else None
+
+        def load(file_name):
+            return np.load(os.path.join(directory, file_name), mmap_mode=mmap_mode)
+
+        self.directory = directory
+        # The manifest identifies the version of the snapshot, like the database file of NCBITaxa
+        self.dbfile = os.path.join(directory, MANIFEST)
+        self.ranks = manifest["ranks"]
+        self.parent = load("parent.npy")
+        self.rank = load("rank.npy")
+        self.name = load("name.npy")
+        self.name_offsets = load("name_offsets.npy")
+        self.merged = load("merged.npy")
+        with open(os.path.join(directory, "names.bin"), "rb") as handle:
+            self.names = handle.read()
+        self._name_index = None
+
+    def __len__(self):
+        return int((self.parent >= 0).sum())
+
+    def taxids(self):
+        # All taxids of the snapshot
+        return np.flatnonzero(np.asarray(self.parent) >= 0)
+
+    def translate(self, taxids):
+        # Taxids with merged (obsolete) taxids replaced by their new taxid
+        taxids = np.asarray(taxids, dtype=np.int64)
+        if len(self.merged) == 0:
+            return taxids
+        old = self.merged[:, 0]
+        positions = np.searchsorted(old, taxids).clip(max=len(old) - 1)
+        found = old[positions] == taxids
+        return np.where(found, self.merged[positions, 1], taxids)
+
+    def known(self, taxids):
+        # True for every taxid that is in the snapshot (merged taxids are not translated)
+        taxids = np.asarray(taxids, dtype=np.int64)
+        inside = (taxids >= 0) & (taxids < len(self.parent))
+        known = np.zeros(len(taxids), dtype=bool)
+        known[inside] = self.parent[taxids[inside]] >= 0
+        return known
+
+    def rank_names(self, taxids):
+        return [self.ranks[code] for code in self.rank[np.asarray(taxids, dtype=np.int64)]]
+
+    def scientific_names(self, taxids):
+        names = []
+        for code in self.name[np.asarray(taxids, dtype=np.int64)]:
+            if code < 0:
+                names.append(None)
+            else:
+                names.append(self.names[self.name_offsets[code]:self.name_offsets[code + 1]].decode("utf-8"))
+        return names
+
+    def paths(self, taxids):
+        """
+            Lineages of many taxids by one vectorized walk up the tree.
+
+            Returns
+            -------
+            numpy.ndarray
+                (taxids x depth) taxids from every taxid up to the root, padded with -1.
+            """
+        current = np.asarray(taxids, dtype=np.int64)
+        steps = [current]
+        active = current != ROOT
+        while active.any():
+            current = np.where(active, self.parent[current], -1)
+            steps.append(current)
+            active = (current != ROOT) & (current >= 0)
+        return np.stack(steps, axis=1)
+
+    def major_lineages(self, taxids, major_ranks):
+        """
+            Taxids at the major ranks of every taxid, without per-taxid queries.
+
+            Parameters
+            ----------
+            taxids : array-like
+            major_ranks : dict
+                {NCBI rank: column}, see Model.get_lineage.MAJOR_RANKS.
+
+            Returns
+            -------
+            dict
+                {taxid: (names by column, taxids of these names by column)} for every known taxid,
+                None where a column is not assigned. Merged taxids are translated, unknown taxids are left out.
+            """
+        taxids = np.asarray(list(taxids), dtype=np.int64)
+        nodes = self.translate(taxids)
+        keep = self.known(nodes)
+        taxids, nodes = taxids[keep], nodes[keep]
+        num_columns = max(major_ranks.values()) + 1
+        column_of_rank = np.array([major_ranks.get(rank, -1) for rank in self.ranks], dtype=np.int64)
+
+        paths = self.paths(nodes)
+        valid = paths >= 0
+        columns = np.where(valid, column_of_rank[self.rank[np.where(valid, paths, 0)]], -1)
+        # A rank can occur more than once in a path; the highest node of it is used, as in the NCBITaxa
+        # lineage. The path is walked down from the root and only columns not yet assigned are set.
+        major = np.full((len(nodes), num_columns), -1, dtype=np.int64)
+        for step in range(paths.shape[1] - 1, -1, -1):
+            rows = np.flatnonzero(columns[:, step] >= 0)
+            rows = rows[major[rows, columns[rows, step]] < 0]
+            major[rows, columns[rows, step]] = paths[rows, step]
+
+        assigned = np.unique(major[major >= 0])
+        name_of = dict(zip(assigned.tolist(), self.scientific_names(assigned)))
+        return {int(taxid): ([name_of.get(node) for node in row], [node if node >= 0 else None for node in row])
+                for taxid, row in zip(taxids, major.tolist())}
+
+    # Methods of ete3's NCBITaxa
+
+    def get_lineage(self, taxid):
+        node = int(self.translate([int(taxid)])[0])
+        if not self.known([node])[0]:
+            raise ValueError(f"{taxid} taxid not found")
+        path = self.paths([node])[0]
+        return path[path >= 0][::-1].tolist()
+
+    def get_lineage_translator(self, taxids):
+        # Like NCBITaxa, merged and unknown taxids are left out
+        taxids = np.asarray(list(taxids), dtype=np.int64)
+        taxids = taxids[self.known(taxids)]
+        paths = self.paths(taxids)
+        return {int(taxid): path[path >= 0][::-1].tolist() for taxid, path in zip(taxids, paths)}
+
+    def get_rank(self, taxids):
+        taxids = np.asarray(list(taxids), dtype=np.int64)
+        taxids = taxids[self.known(taxids)]
+        return dict(zip(taxids.tolist(), self.rank_names(taxids)))
+
+    def get_taxid_translator(self, taxids):
+        taxids = np.asarray(list(taxids), dtype=np.int64)
+        taxids = taxids[self.known(taxids)]
+        return {taxid: name for taxid, name in zip(taxids.tolist(), self.scientific_names(taxids))
+                if name is not None}
+
+    def get_name_translator(self, names):
+        # {name: [taxids]}. The index of all names is built on the first call.
+        if self._name_index is None:
+            taxids = self.taxids()
+            index = {}
+            for taxid, name in zip(taxids.tolist(), self.scientific_names(taxids)):
+                if name is not None:
+                    index.setdefault(name, []).append(taxid)
+            self._name_index = index
+        return {name: self._name_index[name] for name in names if name in self._name_index}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Compiles an offline taxonomy snapshot.")
+    parser.add_argument("source", help="NCBI taxdump directory or the taxa.sqlite file of ete3")
+    parser.add_argument("output", help="Snapshot directory")
+    args = parser.parse_args(arguments)
+    snapshot = compile_snapshot(args.source, args.output)
+    print(f"{len(snapshot)} taxa written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
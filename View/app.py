@@ -1,6 +1,5 @@
 import sys
 import os
-import numpy as np
 import pandas as pd
 
 import matplotlib as mpl
@@ -12,48 +11,36 @@ from PyQt6 import uic
 from PyQt6.QtWidgets import (
     QMainWindow, QApplication,
     QLabel, QToolBar, QStatusBar, QCheckBox, QPushButton, QDialog, QDialogButtonBox, QVBoxLayout, QFileDialog,
-    QGridLayout, QWidget, QMenu, QHBoxLayout, QTableView, QSizePolicy, QSplitter
+    QGridLayout, QWidget, QMenu, QHBoxLayout, QTableView, QSizePolicy, QSplitter, QProgressBar, QHeaderView
 )
 from PyQt6.QtGui import QAction, QIcon, QKeySequence, QStandardItemModel, QStandardItem
-from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt6.QtCore import QModelIndex
 
 from Model.microbiome_class import MicrobiomeDataAnalyzer
-from Model.modificator import otu_table, tax_table
+from Model.modificator import load_comparison_file
+from Model.get_lineage import get_ncbi, taxonomy_loaded
+from Model.project import save_project, load_project
+from View.jobs import JobScheduler
+from View.interaction import ScatterHover, BarHitIndex
+from View.table_model import OTUTableModel
+from View.diagnostics import DiagnosticsDialog
 
 from matplotlib.backends.backend_qt5agg import (
     FigureCanvasQTAgg as FigureCanvas,
     NavigationToolbar2QT as NavigationToolbar,
 )
 
+# Number of OTUs shown in the result table of a test
+RESULT_ROWS = 50
+# Number of unresolved taxids named after an import
+LINEAGE_PREVIEW = 20
+
 class MplCanvas(FigureCanvasQTAgg):
     def __init__(self, parent=None, width=8, height=6, dpi=100):
         fig = Figure(figsize=(width, height), dpi=dpi)
         self.axes = fig.add_subplot(111)
         super().__init__(fig)
 
-class TableModel(QAbstractTableModel):
-    def __init__(self, data):
-        super().__init__()
-        self._data = data
-
-    def rowCount(self, index):
-        return self._data.shape[0]
-
-    def columnCount(self, parnet=None):
-        return self._data.shape[1]
-
-    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
-        if index.isValid():
-            if role == Qt.ItemDataRole.DisplayRole or role == Qt.ItemDataRole.EditRole:
-                value = self._data.iloc[index.row(), index.column()]
-                return str(value)
-
-    def headerData(self, col, orientation, role):
-        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
-            return self._data.columns[col]
-    def flags(self, index):
-        return Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEnabled
-
 class MainWindow(QMainWindow):
 
     def __init__(self):
@@ -62,13 +49,37 @@ class MainWindow(QMainWindow):
 
         # Connect the existing action from the UI file
         self.menuImport.triggered.connect(self.open_file_dialog)
+        self.actionOpen_project.triggered.connect(self.open_project_dialog)
+        self.actionSave_project.triggered.connect(self.save_project_dialog)
         self.plot_top_button.clicked.connect(self.plot_stat)
         self.plot_rank_button.clicked.connect(self.plot_rank)
         self.plot_pcoa_button.clicked.connect(self.plot_pcoa)
         self.anova_button.clicked.connect(self.anova)
         self.ttest_button.clicked.connect(self.t_test)
+        self.tableView.clicked.connect(self.on_taxa_cell_clicked)
+        self.taxa_filter.textChanged.connect(self.filter_table)
+        # Sorting is done by the model. Fixed row heights avoid measuring every row.
+        self.tableView.setSortingEnabled(True)
+        self.tableView.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
         self.textEdit.setText("Welcome to the StatApp! \nPlease import your file for statistical analysis.")
 
+        # Long computations run in the background. Progress and a cancel button live in the status bar.
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton("Cancel")
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+        self.jobs = JobScheduler(self.statusBar(), self.progress_bar, self)
+        self.jobs.busy_changed.connect(self.on_busy_changed)
+        self.cancel_button.clicked.connect(self.jobs.cancel_all)
+        self.on_busy_changed(False)
+
+        # Timings of the Model layer, for reports of slow or hanging operations
+        self.diagnostics_dialog = None
+        diagnostics_action = QAction("Diagnostics...", self)
+        diagnostics_action.triggered.connect(self.show_diagnostics)
+        self.menuBar().addMenu("Help").addAction(diagnostics_action)
+
         # setup default plot settings
         mpl.rcParams['font.size'] = 8
         mpl.rcParams['axes.titlesize'] = 8
@@ -78,8 +89,18 @@ class MainWindow(QMainWindow):
         mpl.rcParams['legend.fontsize'] = 8
 
 # Random forest
-# how to disconnect gui from the calculation process
-# make on background process
+
+    def on_busy_changed(self, busy):
+        self.progress_bar.setVisible(busy)
+        self.cancel_button.setVisible(busy)
+        if busy:
+            self.progress_bar.setValue(0)
+
+    def show_diagnostics(self):
+        if self.diagnostics_dialog is None:
+            self.diagnostics_dialog = DiagnosticsDialog(self)
+        self.diagnostics_dialog.show()
+        self.diagnostics_dialog.raise_()
 
     def open_file_dialog(self):
         dialog = QFileDialog(self)
@@ -91,25 +112,89 @@ class MainWindow(QMainWindow):
             selected_path = dialog.selectedFiles()
             if selected_path:
                 filepath = selected_path[0]
-                filename = os.path.basename(filepath)
-                otu_mat, otu_mat_copy, tax_mat, metadata = self.process_file(filepath)
-                self.data_input = MicrobiomeDataAnalyzer(otu_mat, tax_mat, metadata) # Does saving input data as attribute make sense?
-                # beta_div = self.data_input.beta_diversity()
-        DT = otu_mat_copy
-        model = TableModel(DT)
+                self.jobs.submit("Import", self.load_file, self.on_file_loaded, filepath)
+
+    # Runs in the background
+    def load_file(self, job, filepath):
+        if not taxonomy_loaded():
+            # The taxonomy database is opened on first use only
+            job.report(0, "Opening the NCBI taxonomy database...")
+            get_ncbi()
+        job.report(10, f"Reading {os.path.basename(filepath)} and resolving lineages...")
+        otu_mat, tax_mat, metadata, taxids = self.process_file(filepath)
+        job.report(90, "Aggregating ranks and preparing the table...")
+        analyzer = MicrobiomeDataAnalyzer(otu_mat, tax_mat, metadata, taxids=taxids)
+        # Built here, so clicks on taxa are answered from memory
+        analyzer.taxonomy_index()
+        return filepath, analyzer, self.table_frame(analyzer)
+
+    def on_file_loaded(self, result):
+        filepath, analyzer, table = result
+        self.data_input = analyzer # Does saving input data as attribute make sense?
+        self.show_table(table, os.path.basename(filepath))
+        self.show_lineage_notice(analyzer.Taxa_table)
+
+    # Taxids without lineage keep their rows (with an empty lineage). The user is told once per file.
+    def show_lineage_notice(self, tax_mat):
+        unresolved = tax_mat.attrs.get("unresolved", [])
+        merged = tax_mat.attrs.get("merged", {})
+        notes = []
+        if unresolved:
+            preview = ", ".join(str(taxid) for taxid in unresolved[:LINEAGE_PREVIEW])
+            notes.append(f"{len(unresolved)} taxids have no lineage in the taxonomy database and are shown "
+                         f"without taxonomy: {preview}{', ...' if len(unresolved) > LINEAGE_PREVIEW else ''}")
+        if merged:
+            notes.append(f"{len(merged)} obsolete taxids were replaced by their current taxids.")
+        if notes:
+            self.textEdit.append("\n".join(notes))
+            self.statusBar().showMessage(notes[0], 10000)
+
+    def open_project_dialog(self):
+        path = QFileDialog.getExistingDirectory(self, "Open project")
+        if path:
+            self.jobs.submit("Open project", self.load_project, self.on_project_loaded, path)
+
+    # Runs in the background
+    def load_project(self, job, path):
+        job.report(0, f"Opening project {os.path.basename(path)}...")
+        analyzer, distances = load_project(path)
+        analyzer.taxonomy_index()
+        return path, analyzer, self.table_frame(analyzer)
+
+    def on_project_loaded(self, result):
+        path, analyzer, table = result
+        self.data_input = analyzer
+        self.show_table(table, os.path.basename(path))
+
+    def save_project_dialog(self):
+        if not hasattr(self, "data_input"):
+            self.statusBar().showMessage("Nothing to save. Please import a file first.")
+            return
+        path = QFileDialog.getExistingDirectory(self, "Save project to")
+        if path:
+            analyzer = self.data_input
+            self.jobs.submit("Save project", lambda job: save_project(path, analyzer),
+                             lambda result: self.statusBar().showMessage(f"Project saved to {path}", 5000))
+
+    def show_table(self, table, filename):
+        otu_table, leading_columns = table
+        # The full lineage of a taxon is shown as tooltip
+        model = OTUTableModel(otu_table, tooltip=self.data_input.rank_cube().labels.tooltip,
+                              leading_columns=leading_columns)
         self.tableView.setModel(model)
+        model.set_filter(self.taxa_filter.text())
         #self.tableView.setVerticalHeaderLabels(all_taxa.to_list())
         self.textEdit.setText(f"File name: {filename}")
-        # Connect click signal
-        self.tableView.clicked.connect(self.on_taxa_cell_clicked)
+
+    # Shows only the taxa whose lowest assigned name contains the text
+    def filter_table(self, text):
+        model = self.tableView.model()
+        if model is not None:
+            model.set_filter(text)
 
     def process_file(self, file_path):
-        otu_mat = otu_table(file_path)
-        tax_mat = tax_table(file_path)
-        last_assigned_taxon = tax_mat.apply(lambda row: row.dropna().iloc[-1] if not row.dropna().empty else np.nan,
-                                            axis=1)
-        otu_mat_copy = otu_mat.copy()
-        otu_mat_copy.insert(0, 'Lowest Taxa', last_assigned_taxon)
+        # The file is parsed only once for both tables
+        otu_mat, taxids, tax_mat = load_comparison_file(file_path)
         metadata = {
             'SampleID': ['Alice00-1mio.daa', 'Alice01-1mio.daa',
                          'Alice03-1mio.daa', 'Alice06-1mio.daa',
@@ -125,25 +210,48 @@ class MainWindow(QMainWindow):
                          '0-', '1+', '3+', '6+', '8-', '34-']
         }
         metadata_alice_bob = pd.DataFrame(metadata)
-        return otu_mat, otu_mat_copy, tax_mat, metadata_alice_bob
+        return otu_mat, tax_mat, metadata_alice_bob, taxids
+
+    # OTU table and the lowest assigned taxon shown in front of it. The table is not copied,
+    # so a memory-mapped project stays on disk. Building the rank cube here also prepares the rank plots.
+    def table_frame(self, analyzer):
+        lowest_taxa = analyzer.rank_cube().lowest_taxa().reindex(analyzer.OTU_table.index)
+        return analyzer.OTU_table, {'Lowest Taxa': lowest_taxa.array}
 
     # Cleans subplots for new plotting functions
     def clear_canvas(self):
+        # Event handlers of the previous plot are removed, so they do not pile up
+        if getattr(self, "plot_hover", None) is not None:
+            self.plot_hover.disconnect()
+            self.plot_hover = None
+        for connection in getattr(self, "plot_connections", []):
+            self.graph_widget.mpl_disconnect(connection)
+        self.plot_connections = []
         self.graph_widget.axes.clear()
 
     def t_test(self):
-        self.textEdit.clear()
-        result = self.data_input.t_test()
-        # Display the results
-        for otu, (t_stat, p_value) in result.items():
-            self.textEdit.append(f"{otu}: T statistic = {t_stat}, P-value = {p_value}")
+        self.show_test_results('t_test', "t-Test")
 
     def anova(self):
+        self.show_test_results('anova', "ANOVA")
+
+    # Runs the test in the background and shows the most significant OTUs as one table
+    def show_test_results(self, test, title):
+        analyzer = self.data_input
+        self.jobs.submit(title, lambda job: self.run_test(job, analyzer, test),
+                         lambda result: self.on_test_finished(title, result))
+
+    # Runs in the background
+    def run_test(self, job, analyzer, test):
+        job.report(0, f"Running {test} on {len(analyzer.OTU_table)} OTUs...")
+        return analyzer.differential_abundance(test)
+
+    def on_test_finished(self, title, result):
         self.textEdit.clear()
-        result = self.data_input.anova_test()
-        # Display the results
-        for otu, (f_value, p_value) in result.items():
-            self.textEdit.append(f"{otu}: F-value = {f_value}, P-value = {p_value}")
+        significant = int(result['significant'].sum())
+        summary = f"<p>{title}: {len(result)} OTUs tested, {significant} significant (q &le; 0.05)</p>"
+        table = result.head(RESULT_ROWS).to_html(float_format='{:.3g}'.format)
+        self.textEdit.setHtml(summary + table)
 
     def plot_stat(self):
         self.clear_canvas()
@@ -151,7 +259,7 @@ class MainWindow(QMainWindow):
         top_plot, top_df = self.data_input.plot_top(5, self.graph_widget)
 
         # Connect the event handler to the canvas
-        self.graph_widget.mpl_connect("button_press_event", lambda event: self.on_click(event, top_plot, top_df))
+        self.connect_bar_inspection(top_df)
 
     def plot_rank(self):
         self.clear_canvas()
@@ -160,25 +268,45 @@ class MainWindow(QMainWindow):
         rank_plot, rank_df = self.data_input.plot_rank("Phylum", self.graph_widget)
 
         # Connect the event handler to the canvas
-        self.graph_widget.mpl_connect("button_press_event", lambda event: self.on_click(event, rank_plot, rank_df))
+        self.connect_bar_inspection(rank_df)
 
     def plot_pcoa(self):
+        # Distances and ordination are computed in the background, drawing happens in the GUI thread
+        analyzer = self.data_input
+        self.jobs.submit("PCoA", lambda job: self.compute_pcoa(job, analyzer), self.on_pcoa_computed)
+
+    # Runs in the background
+    def compute_pcoa(self, job, analyzer):
+        job.report(0, "Computing beta diversity and PCoA...")
+        return analyzer.pcoa_samples()
+
+    def on_pcoa_computed(self, pcoa_samples):
         self.clear_canvas()
-        self.data_input.plot_pcoa(self.graph_widget)
-
-    def on_click(self, event, plot, df):
-        totals = df.sum(axis=1)
-        # Check if the click occurred inside the axes
-        if event.inaxes == self.graph_widget.axes:
-            for bar_group, group_name in zip(plot.containers, df.columns):
-                for rect, value, total in zip(bar_group, df[group_name], totals):
-                    height = rect.get_height()
-                    # Check if the mouse click is inside the rectangle
-                    if rect.contains(event)[0]:  # Returns (True, details) if inside
-                        taxon = group_name
-                        percentage = f'{(value / total) * 100:.1f}%'  # Calculate percentage
-                        self.statusBar().showMessage(f"Taxon:{taxon}, Percentage: {percentage}, Read Count: {height}")
-                        break
+        collections = self.data_input.plot_pcoa(self.graph_widget, pcoa_samples)
+        # The hovered sample is highlighted by blitting and named in the status bar
+        self.plot_hover = ScatterHover(self.graph_widget, collections,
+                                       lambda label: self.statusBar().showMessage(label or ""))
+        self.graph_widget.draw_idle()
+
+    # Clicks and mouse movement over a stacked bar chart show the segment under the mouse
+    def connect_bar_inspection(self, df):
+        bar_index = BarHitIndex(df)
+        self.plot_connections = [
+            self.graph_widget.mpl_connect("button_press_event", lambda event: self.on_click(event, bar_index)),
+            self.graph_widget.mpl_connect("motion_notify_event", lambda event: self.on_click(event, bar_index)),
+        ]
+
+    def on_click(self, event, bar_index):
+        # Check if the event occurred inside the axes
+        if event.inaxes != self.graph_widget.axes:
+            return
+        hit = bar_index.hit(event.xdata, event.ydata)
+        if hit is None:
+            return
+        sample, taxon, value, percentage = hit
+        lineage = self.data_input.taxonomy_index().describe(taxon)
+        self.statusBar().showMessage(f"Sample: {sample}, Taxon:{taxon}, Percentage: {percentage:.1f}%, "
+                                     f"Read Count: {value:g}" + (f" | {lineage}" if lineage else ""))
 
     def on_plot_click(self, event):
         if event.inaxes:  # Check if the click is inside the plot area
@@ -187,8 +315,6 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage(f"Clicked at: x={x:.2f}, y={y:.2f}")
 
     def on_taxa_cell_clicked(self, index: QModelIndex):
-        from ete3 import NCBITaxa
-        ncbi = NCBITaxa()
         # index holds both row & column
         if index.column() != 0:
             return
@@ -196,36 +322,12 @@ class MainWindow(QMainWindow):
         # Retrieve the taxon name
         taxa_name = index.data()
 
-        # Lookup full classification
-        try:
-            tax_tab = self.data_input.Taxa_table
-            # Find location of the value
-            # matches = tax_tab[tax_tab == taxa_name]
-            # Step 1: Convert name to taxid
-            name2taxid = ncbi.get_name_translator([taxa_name])
-            taxid = name2taxid[taxa_name][0]
-
-            # Step 2: Get full lineage taxids
-            lineage = ncbi.get_lineage(taxid)
-
-            # Step 4: (Optional) Get ranks for each taxid
-            major_ranks = ["superkingdom", "domain", "phylum", "class", "order", "family", "genus", "species"]
-            ranks = ncbi.get_rank(lineage)
-            sorted_ranks = {k: v for (k, v) in ranks.items() if v in major_ranks}
-            sorted_lineage = [k for (k,v) in sorted_ranks.items()]
-            # Step 3: Map lineage taxids to names
-            names = ncbi.get_taxid_translator(sorted_lineage)
-            # Build ordered path (Domain → ... → species/order/etc.)
-
-            taxonomy_path = [names[t] for t in sorted_lineage]
-
-        except KeyError:
+        # Lookup full classification in the index built at import, no database query
+        description = self.data_input.taxonomy_index().describe(taxa_name)
+        if description is None:
             self.statusBar().showMessage(f"No full taxonomy found for '{taxa_name}'")
             return
-
-        # Format for display
-
-        self.statusBar().showMessage(', '.join(map(str, taxonomy_path)))
+        self.statusBar().showMessage(description)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,123 @@
+from PyQt6.QtCore import QTimer
+from PyQt6.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QTabWidget, QTableWidget, QTableWidgetItem, QPushButton,
+    QCheckBox, QFileDialog, QHeaderView, QLabel
+)
+
+from Model import instrumentation
+
+# Refresh interval of the open diagnostics window in milliseconds
+REFRESH_MS = 1000
+
+
+class DiagnosticsDialog(QDialog):
+    """
+        Shows the stage timings, counters and cache hit rates recorded by Model.instrumentation.
+
+        Capture mode (cProfile + tracemalloc) can be switched on for a slow operation and the
+        whole report exported as JSON, to be attached to a bug report.
+        """
+
+    def __init__(self, parent=None, registry=instrumentation.registry):
+        super().__init__(parent)
+        self.registry = registry
+        self.setWindowTitle("Diagnostics")
+        self.resize(800, 500)
+
+        self.stages = self._table(["Stage", "Calls", "Total s", "Mean s", "Max s", "Rows", "Peak MB"])
+        self.counters = self._table(["Counter", "Count"])
+        self.caches = self._table(["Cache", "Hits", "Misses", "Hit rate"])
+        self.profile = self._table(["Function", "Calls", "Own s", "Cumulative s"])
+        tabs = QTabWidget()
+        tabs.addTab(self.stages, "Stages")
+        tabs.addTab(self.counters, "Counters")
+        tabs.addTab(self.caches, "Caches")
+        tabs.addTab(self.profile, "Profile")
+
+        self.capture_box = QCheckBox("Capture profile and memory (slower)")
+        self.capture_box.setChecked(registry.capturing)
+        self.capture_box.toggled.connect(self.set_capture)
+        reset_button = QPushButton("Reset")
+        reset_button.clicked.connect(self.reset)
+        export_button = QPushButton("Export JSON...")
+        export_button.clicked.connect(self.export)
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.close)
+        self.summary = QLabel()
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.capture_box)
+        buttons.addStretch()
+        buttons.addWidget(reset_button)
+        buttons.addWidget(export_button)
+        buttons.addWidget(close_button)
+        layout = QVBoxLayout(self)
+        layout.addWidget(tabs)
+        layout.addWidget(self.summary)
+        layout.addLayout(buttons)
+
+        # Timings of running background jobs appear while the window is open
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def _table(self, headers):
+        table = QTableWidget(0, len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        table.verticalHeader().setVisible(False)
+        table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        return table
+
+    def _fill(self, table, rows):
+        table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                table.setItem(row, column, QTableWidgetItem(_format(value)))
+
+    def refresh(self):
+        snapshot = self.registry.snapshot()
+        self._fill(self.stages, [(name, stage["calls"], stage["seconds"], stage["mean_seconds"],
+                                  stage["max_seconds"], stage["rows"], stage["peak_mb"])
+                                 for name, stage in sorted(snapshot["stages"].items(),
+                                                           key=lambda item: -item[1]["seconds"])])
+        self._fill(self.counters, sorted(snapshot["counters"].items()))
+        self._fill(self.caches, [(name, cache["hits"], cache["misses"], cache["hit_rate"])
+                                 for name, cache in sorted(snapshot["caches"].items())])
+        self._fill(self.profile, [(entry["function"], entry["calls"], entry["total_seconds"],
+                                   entry["cumulative_seconds"]) for entry in snapshot["profile"]])
+        self.summary.setText(f"Recorded over {snapshot['meta']['seconds']:.0f} s"
+                             + (", capturing" if snapshot["meta"]["capturing"] else ""))
+
+    def set_capture(self, enabled):
+        if enabled:
+            self.registry.start_capture()
+        else:
+            self.registry.stop_capture()
+        self.refresh()
+
+    def reset(self):
+        self.registry.reset()
+        self.refresh()
+
+    def export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export diagnostics", "diagnostics.json", "JSON (*.json)")
+        if path:
+            self.registry.export(path)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start(REFRESH_MS)
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+
+# Helper function. Table text of a value: empty for None, 3 significant digits for floats.
+def _format(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.3g}"
+    return str(value)
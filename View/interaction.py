@@ -0,0 +1,125 @@
+import numpy as np
+
+# Mouse interaction with the plots of the canvas.
+#
+# Hover feedback is drawn with blitting: the rendered figure is saved once after every full draw,
+# and on mouse movement only the saved background and the animated highlight artists are
+# repainted. The plot itself is never redrawn while hovering.
+# Bar charts are hit-tested with an index of the cumulative bar heights instead of the rectangles.
+
+
+class ScatterHover:
+    """
+        Highlights the point under the mouse in one or more scatter collections.
+
+        Parameters
+        ----------
+        canvas : FigureCanvas
+            Canvas with an 'axes' attribute (see MplCanvas).
+        collections : dict
+            {collection: labels} where labels holds one text per point of the collection.
+        on_hover : callable, optional
+            Called with the label of the hovered point, or None when the mouse leaves all points.
+        """
+
+    def __init__(self, canvas, collections, on_hover=None):
+        self.canvas = canvas
+        self.axes = canvas.axes
+        self.collections = collections
+        self.on_hover = on_hover
+        self._background = None
+        self._current = None
+        # Animated artists are skipped by normal draws and painted by blitting only
+        self._marker, = self.axes.plot([], [], marker='o', markersize=12, markerfacecolor='none',
+                                       markeredgecolor='black', linestyle='', animated=True)
+        self._annotation = self.axes.annotate("", xy=(0, 0), xytext=(8, 8), textcoords='offset points',
+                                              fontsize=8, animated=True,
+                                              bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
+        self._connections = [
+            canvas.mpl_connect('draw_event', self._on_draw),
+            canvas.mpl_connect('motion_notify_event', self._on_move),
+        ]
+
+    def disconnect(self):
+        # Removes the event handlers and the highlight artists
+        for connection in self._connections:
+            self.canvas.mpl_disconnect(connection)
+        self._connections = []
+        for artist in (self._marker, self._annotation):
+            if artist.axes is not None:
+                artist.remove()
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+
+    def _hit(self, event):
+        # (collection, point number) of the point under the mouse, or None
+        for collection in self.collections:
+            contains, details = collection.contains(event)
+            if contains and len(details["ind"]):
+                return collection, int(details["ind"][0])
+        return None
+
+    def _on_move(self, event):
+        if self._background is None:
+            return
+        hit = self._hit(event) if event.inaxes == self.axes else None
+        if hit == self._current:
+            return
+        self._current = hit
+        self.canvas.restore_region(self._background)
+        if hit is not None:
+            collection, point = hit
+            x, y = collection.get_offsets()[point]
+            label = self.collections[collection][point]
+            self._marker.set_data([x], [y])
+            self._annotation.xy = (x, y)
+            self._annotation.set_text(label)
+            self.axes.draw_artist(self._marker)
+            self.axes.draw_artist(self._annotation)
+        if self.on_hover is not None:
+            self.on_hover(None if hit is None else self.collections[hit[0]][hit[1]])
+        self.canvas.blit(self.canvas.figure.bbox)
+
+
+
+class BarHitIndex:
+    """
+        Finds the segment of a stacked bar chart under a point by binary search.
+
+        Built once from the plotted data: bar i is centered at x = i (as drawn by
+        DataFrame.plot(kind='bar')) and its segments end at the cumulative sums of the row.
+        A lookup rounds x to the bar and searches the cumulative heights of that bar,
+        so it takes O(log taxa) instead of testing every rectangle.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            The plotted data. Rows: bars (samples), columns: stacked segments (taxa).
+        width : float
+            Bar width used for plotting.
+        """
+
+    def __init__(self, df, width=0.5):
+        self.bars = df.index
+        self.segments = df.columns
+        self.values = np.nan_to_num(df.to_numpy(dtype=np.float64))
+        self.tops = np.cumsum(self.values, axis=1)
+        self.totals = self.tops[:, -1] if self.tops.shape[1] else np.zeros(len(df))
+        self.width = width
+
+    def hit(self, x, y):
+        # (bar, segment, value, percentage of the bar) at the data coordinates x, y, or None
+        if x is None or y is None or y < 0:
+            return None
+        bar = int(np.rint(x))
+        if bar < 0 or bar >= len(self.bars) or abs(x - bar) > self.width / 2:
+            return None
+        # First segment whose top is above y. Empty segments have no height and are skipped.
+        segment = int(np.searchsorted(self.tops[bar], y, side='right'))
+        if segment >= len(self.segments):
+            return None
+        value = self.values[bar, segment]
+        total = self.totals[bar]
+        percentage = 100.0 * value / total if total else np.nan
+        return self.bars[bar], self.segments[segment], value, percentage
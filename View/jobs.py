@@ -0,0 +1,148 @@
+import threading
+import traceback
+
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    # Raised inside a job when it was cancelled. Stops the job at its next progress report.
+    pass
+
+
+class JobSignals(QObject):
+    # QRunnable is not a QObject, so the signals of a job live here.
+    # They are emitted from the worker thread and delivered in the GUI thread.
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class Job(QRunnable):
+    """
+        A piece of work that runs in the thread pool.
+
+        The function is called as function(job, *args). It can call job.report(percent, message)
+        to show its progress. Reporting is also the point where a cancelled job stops.
+        """
+
+    def __init__(self, key, function, *args):
+        super().__init__()
+        self.key = key
+        self.function = function
+        self.args = args
+        self.signals = JobSignals()
+        self._cancelled = threading.Event()
+        # The scheduler keeps the reference, Qt must not delete the object after run()
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def report(self, percent, message=""):
+        if self.is_cancelled():
+            raise JobCancelled()
+        self.signals.progress.emit(int(percent), message)
+
+    def run(self):
+        try:
+            if self.is_cancelled():
+                raise JobCancelled()
+            result = self.function(self, *self.args)
+            # Results of a job cancelled while it was computing are thrown away
+            if self.is_cancelled():
+                raise JobCancelled()
+        except JobCancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            self.signals.failed.emit(traceback.format_exc())
+        else:
+            self.signals.finished.emit(result)
+
+
+class JobScheduler(QObject):
+    """
+        Runs jobs in a QThreadPool so the GUI stays responsive.
+
+        Jobs are identified by a key (for example the name of the button that started them).
+        Submitting a key that is still running does not start a second job, so repeated clicks
+        are coalesced into one run. A cancelled job frees its key at once, so the same action
+        can be started again while the cancelled one stops. Progress and errors are shown in
+        the status bar.
+        """
+
+    # Emitted when the number of running jobs changes
+    busy_changed = pyqtSignal(bool)
+
+    def __init__(self, status_bar, progress_bar=None, parent=None):
+        super().__init__(parent)
+        self.status_bar = status_bar
+        self.progress_bar = progress_bar
+        self.pool = QThreadPool.globalInstance()
+        self._jobs = {}
+        # Cancelled jobs that are still running. Qt does not own them (see Job), so they are kept here.
+        self._stopping = set()
+
+    def submit(self, key, function, on_finished, *args):
+        # Repeated click while the same job is running
+        if key in self._jobs:
+            self.status_bar.showMessage(f"'{key}' is already running...")
+            return self._jobs[key]
+
+        job = Job(key, function, *args)
+        job.signals.progress.connect(self._on_progress)
+        job.signals.finished.connect(lambda result: self._on_finished(job, on_finished, result))
+        job.signals.failed.connect(lambda error: self._on_failed(job, error))
+        job.signals.cancelled.connect(lambda: self._on_cancelled(job))
+        self._jobs[key] = job
+        self.busy_changed.emit(True)
+        self.pool.start(job)
+        return job
+
+    def is_running(self, key):
+        return key in self._jobs
+
+    def cancel(self, key):
+        if key in self._jobs:
+            self._cancel(self._jobs[key])
+
+    def cancel_all(self):
+        for job in list(self._jobs.values()):
+            self._cancel(job)
+        self.status_bar.showMessage("Cancelling...")
+
+    def _cancel(self, job):
+        # The job stops at its next report and its result is thrown away
+        job.cancel()
+        self._remove(job)
+        self._stopping.add(job)
+
+    def _on_progress(self, percent, message):
+        if message:
+            self.status_bar.showMessage(message)
+        if self.progress_bar is not None:
+            self.progress_bar.setValue(percent)
+
+    def _on_finished(self, job, on_finished, result):
+        self._remove(job)
+        self.status_bar.showMessage("Done", 3000)
+        on_finished(result)
+
+    def _on_failed(self, job, error):
+        self._remove(job)
+        # The last line of the traceback holds the exception message
+        self.status_bar.showMessage(f"'{job.key}' failed: {error.strip().splitlines()[-1]}")
+
+    def _on_cancelled(self, job):
+        self._remove(job)
+        self.status_bar.showMessage(f"'{job.key}' was cancelled", 3000)
+
+    def _remove(self, job):
+        self._stopping.discard(job)
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+        if not self._jobs:
+            self.busy_changed.emit(False)
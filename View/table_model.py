@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+
+class OTUTableModel(QAbstractTableModel):
+    """
+        Table model for large OTU tables.
+
+        Every column is extracted once into a NumPy array (categorical columns stay Categoricals).
+        The columns of a dense table are views of its data, so a memory-mapped table is not copied.
+        Extra columns shown in front of the table (for example the lowest taxa) are passed separately
+        as {header: values in the row order of the table}.
+        The display strings of a column are formatted in one vectorized pass the first time
+        the column is painted and are cached. Categorical columns only format their categories.
+        Rows are handed to the view in batches of FETCH_ROWS (canFetchMore/fetchMore).
+        Sorting and filtering are done in the model on the arrays; the view only sees
+        the order of the visible rows.
+        The OTU IDs are shown as vertical headers. tooltip(source row) optionally provides tooltips.
+        """
+
+    # Number of rows added to the view per fetchMore() call
+    FETCH_ROWS = 1000
+
+    def __init__(self, data, tooltip=None, leading_columns=None):
+        super().__init__()
+        leading_columns = leading_columns or {}
+        self._headers = [str(header) for header in leading_columns] + [str(column) for column in data.columns]
+        self._columns = [_column_values(pd.Series(values)) for values in leading_columns.values()] + \
+                        [_column_values(data[column]) for column in data.columns]
+        self._tooltip = tooltip
+        self._row_ids = np.asarray(data.index.astype(str))
+        self._display = [None] * len(self._columns)
+        # Source rows in the order they are shown, after filtering and sorting
+        self._order = np.arange(len(data))
+        self._loaded = min(self.FETCH_ROWS, len(self._order))
+        self._sort_column = None
+        self._sort_order = Qt.SortOrder.AscendingOrder
+        self._filter = ("", 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._columns)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._order[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole or role == Qt.ItemDataRole.EditRole:
+            return self.display_column(index.column())[row]
+        if role == Qt.ItemDataRole.UserRole:
+            # Raw value, for example for custom delegates
+            value = self._columns[index.column()][row]
+            return value.item() if isinstance(value, np.generic) else value
+        if role == Qt.ItemDataRole.ToolTipRole and self._tooltip is not None:
+            return self._tooltip(int(row))
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if orientation == Qt.Orientation.Horizontal:
+            return self._headers[section]
+        return self._row_ids[self._order[section]]
+
+    def flags(self, index):
+        return Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEnabled
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return self._loaded < len(self._order)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.FETCH_ROWS, len(self._order) - self._loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+        self._loaded += count
+        self.endInsertRows()
+
+    # Display strings of a column, formatted once for all rows
+    def display_column(self, column):
+        if self._display[column] is None:
+            values = self._columns[column]
+            if isinstance(values, pd.Categorical):
+                names = np.append(values.categories.astype(str).to_numpy(dtype=object), "")
+                # Code -1 (missing) picks the empty string at the end
+                self._display[column] = names[values.codes]
+            else:
+                missing = pd.isna(values)
+                self._display[column] = np.where(missing, "", values.astype(str)).astype(object)
+        return self._display[column]
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self._sort_column = column
+        self._sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        self._apply_order()
+        self.layoutChanged.emit()
+
+    def set_filter(self, text, column=0):
+        # Keeps the rows whose display string in the column contains the text (case-insensitive)
+        self._filter = (text, column)
+        self.beginResetModel()
+        self._apply_order()
+        self._loaded = min(self.FETCH_ROWS, len(self._order))
+        self.endResetModel()
+
+    # Recomputes the visible rows from the current filter and sort settings
+    def _apply_order(self):
+        text, column = self._filter
+        rows = np.arange(len(self._row_ids))
+        if text:
+            values = self._columns[column]
+            if isinstance(values, pd.Categorical):
+                # Only the categories are searched
+                found = values.categories.astype(str).str.contains(text, case=False, regex=False)
+                matches = np.isin(values.codes, np.flatnonzero(found))
+            else:
+                matches = pd.Series(self.display_column(column)).str.contains(text, case=False, regex=False)
+                matches = matches.to_numpy()
+            rows = rows[matches]
+        if self._sort_column is not None:
+            keys = pd.Series(self._columns[self._sort_column][rows])
+            ascending = self._sort_order == Qt.SortOrder.AscendingOrder
+            # Missing values always go last. Positions are used, so the keys can be of any type.
+            positions = keys.sort_values(ascending=ascending, na_position='last', kind='stable').index
+            rows = rows[positions.to_numpy()]
+        self._order = rows
+
+    # Source row (position in the DataFrame) of a visible row
+    def source_row(self, row):
+        return int(self._order[row])
+
+
+# Helper function. Values of a column as shown by the model: a Categorical or a NumPy array (a view if possible).
+def _column_values(column):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.array
+    return column.to_numpy(copy=False)
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Import-time benchmark of the entry modules.
+#
+# Every module is imported in a fresh interpreter with -X importtime. The cumulative time of
+# the module and its slowest dependencies are reported, and heavy dependencies that must only
+# be loaded on first use are flagged if an entry module imports them eagerly.
+#
+# Usage (from the repository root):
+#   python benchmarks/import_time.py
+#   python benchmarks/import_time.py --repeat 5 --json import_times.json
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["Model.microbiome_class", "Model.project", "Controller.pipeline", "View.app"]
+# Dependencies that are imported lazily and must not appear in the startup imports
+LAZY_MODULES = ["ete3", "skbio", "scipy.stats", "matplotlib.pyplot"]
+
+
+def import_times(module):
+    # {imported module: cumulative microseconds} of one import of module in a fresh interpreter
+    environment = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=REPOSITORY, capture_output=True, text=True, env=environment)
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr}")
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure(module, repeat=3, top=5):
+    runs = [import_times(module) for _ in range(repeat)]
+    total = statistics.median(run[module] for run in runs)
+    last = runs[-1]
+    slowest = sorted((name for name in last if name != module and "." not in name),
+                     key=last.get, reverse=True)[:top]
+    return {
+        "module": module,
+        "seconds": total / 1e6,
+        "slowest": {name: last[name] / 1e6 for name in slowest},
+        "eager_lazy_modules": [name for name in LAZY_MODULES if name in last],
+    }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Measures the import time of the entry modules.")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3, help="Imports per module (the median is reported)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(arguments)
+
+    results = [measure(module, args.repeat) for module in args.modules]
+    for result in results:
+        slowest = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in result["slowest"].items())
+        print(f"{result['module']:<28} {result['seconds']:6.2f}s   slowest: {slowest}")
+        if result["eager_lazy_modules"]:
+            print(f"{'':<28} imports eagerly: {', '.join(result['eager_lazy_modules'])}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2)
+    return 1 if any(result["eager_lazy_modules"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,214 @@
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+
+# Benchmarks of the hot paths: ingestion, lineage resolution, statistics, distances and plots.
+#
+# Synthetic data of the chosen size is generated first (see benchmarks/synthetic.py).
+# Every case is timed over several repeats (the median is reported) and run once more under
+# tracemalloc for its peak memory. Caches of the analyzer and the lineage resolver are cleared
+# before every run, so each run does the full work.
+#
+# Baselines are plain JSON files and are not part of the repository: they depend on the machine.
+#   python benchmarks/run.py --size medium --save benchmarks/baselines/medium.json
+#   python benchmarks/run.py --size medium --compare benchmarks/baselines/medium.json
+# A case regresses when its time or peak memory grows by more than the tolerance; the exit code is then 1.
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY not in sys.path:
+    sys.path.insert(0, REPOSITORY)
+
+import matplotlib
+matplotlib.use("Agg")
+
+from benchmarks.synthetic import SIZES, generate
+
+DEFAULT_TOLERANCE = 0.25
+
+
+class Context:
+    # Data shared by the cases. Later cases use what earlier ones produced.
+    def __init__(self, paths, metadata_path, directory):
+        self.paths = paths
+        self.metadata_path = metadata_path
+        self.merged_path = os.path.join(directory, "merged.csv")
+        self.analyzer = None
+
+
+def _fresh_resolver():
+    # Cold lineage resolution: a resolver without memory or disk cache
+    from Model import get_lineage
+    get_lineage.resolver = get_lineage.LineageResolver(cache_dir=None)
+
+
+def _fresh_analyzer(context):
+    # The analyzer without memoized distances, rank cube or rarefaction
+    from Model.microbiome_class import MicrobiomeDataAnalyzer
+    analyzer = context.analyzer
+    return MicrobiomeDataAnalyzer(analyzer.OTU_table, analyzer.Taxa_table, analyzer.Metadata,
+                                  taxids=analyzer.Taxa_ids)
+
+
+def _plot_case(plot):
+    # plot(analyzer, canvas) on a headless canvas
+    def case(context):
+        from Controller.pipeline import FigureFile
+        plot(_fresh_analyzer(context), FigureFile())
+    return case
+
+
+def case_merge_data(context):
+    from Model.modificator import merge_data
+    merge_data(context.paths)
+
+
+def case_otu_table(context):
+    from Model.modificator import otu_table
+    otu_table(context.merged_path)
+
+
+def case_tax_table(context):
+    from Model.modificator import tax_table
+    _fresh_resolver()
+    tax_table(context.merged_path)
+
+
+def case_load_comparison_file(context):
+    from Model.modificator import load_comparison_file
+    _fresh_resolver()
+    load_comparison_file(context.merged_path)
+
+
+def _analyzer_case(method, *args, **kwargs):
+    def case(context):
+        getattr(_fresh_analyzer(context), method)(*args, **kwargs)
+    return case
+
+
+# name: function(context). Run in this order.
+CASES = {
+    "merge_data": case_merge_data,
+    "otu_table": case_otu_table,
+    "tax_table": case_tax_table,
+    "load_comparison_file": case_load_comparison_file,
+    "t_test": _analyzer_case("t_test"),
+    "anova_test": _analyzer_case("anova_test"),
+    "kruskal": _analyzer_case("kruskal"),
+    "wilcoxon_test": _analyzer_case("wilcoxon_test"),
+    "differential_abundance": _analyzer_case("differential_abundance", "t_test"),
+    "alpha_diversity": _analyzer_case("alpha_diversity"),
+    "beta_diversity_braycurtis": _analyzer_case("beta_diversity", "braycurtis"),
+    "beta_diversity_jaccard": _analyzer_case("beta_diversity", "jaccard"),
+    "beta_diversity_aitchison": _analyzer_case("beta_diversity", "aitchison"),
+    "beta_diversity_weighted_unifrac": _analyzer_case("beta_diversity", "weighted_unifrac"),
+    "permanova": _analyzer_case("permanova", permutations=999, seed=0),
+    "rank_cube": _analyzer_case("rank_cube"),
+    "plot_top": _plot_case(lambda analyzer, canvas: analyzer.plot_top(5, canvas)),
+    "plot_rank": _plot_case(lambda analyzer, canvas: analyzer.plot_rank("Phylum", canvas)),
+    "plot_pcoa": _plot_case(lambda analyzer, canvas: analyzer.plot_pcoa(canvas)),
+}
+
+
+def prepare(directory, size, seed=0):
+    # Generates the data, writes the merged file and builds the analyzer used by the analysis cases
+    from Model.modificator import merge_data, load_comparison_file
+    from Model.microbiome_class import MicrobiomeDataAnalyzer
+    from Controller.pipeline import read_metadata
+
+    paths, metadata_path = generate(directory, seed=seed, **size)
+    context = Context(paths, metadata_path, directory)
+    merge_data(paths, context.merged_path)
+    otu_mat, taxids, tax_mat = load_comparison_file(context.merged_path)
+    metadata = read_metadata(metadata_path)
+    context.analyzer = MicrobiomeDataAnalyzer(otu_mat, tax_mat, metadata, taxids=taxids)
+    return context
+
+
+def measure(case, context, repeat):
+    # (median seconds, peak MB) of a case
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        case(context)
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        case(context)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), peak / 2 ** 20
+
+
+def compare(results, baseline, tolerance):
+    # Names of the cases whose time or memory grew by more than the tolerance
+    regressions = []
+    for name, result in results.items():
+        reference = baseline["cases"].get(name)
+        if reference is None:
+            continue
+        for key in ("seconds", "peak_mb"):
+            if reference[key] > 0 and result[key] > reference[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {reference[key]:.3f} -> {result[key]:.3f}")
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths on synthetic data.")
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--cases", nargs="+", choices=CASES, help="Cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data", help="Directory for the synthetic data (default: a temporary directory)")
+    parser.add_argument("--save", help="Write the results as baseline to this file")
+    parser.add_argument("--compare", help="Compare with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative growth of time and memory (default: 0.25)")
+    args = parser.parse_args(arguments)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        context = prepare(args.data or temporary, SIZES[args.size], args.seed)
+        results = {}
+        for name in args.cases or CASES:
+            try:
+                seconds, peak_mb = measure(CASES[name], context, args.repeat)
+            except Exception as error:
+                print(f"{name:<34} failed: {type(error).__name__}: {error}")
+                continue
+            results[name] = {"seconds": seconds, "peak_mb": peak_mb}
+            print(f"{name:<34} {seconds:9.4f} s {peak_mb:10.1f} MB")
+
+    report = {
+        "meta": {"size": args.size, **SIZES[args.size], "repeat": args.repeat, "seed": args.seed,
+                 "python": platform.python_version(), "machine": platform.machine(),
+                 "processor": platform.processor(), "cpus": os.cpu_count()},
+        "cases": results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        if baseline["meta"].get("size") != args.size:
+            print(f"Warning: the baseline was measured with size {baseline['meta'].get('size')}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
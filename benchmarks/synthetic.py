@@ -0,0 +1,123 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+# Synthetic comparison datasets in the layout of Model/data/alice.csv and bob.csv:
+# a 'Taxa' column of NCBI taxids followed by one column of read counts per sample,
+# tab-delimited, empty cells for taxa without reads.
+#
+# Taxa x samples x sparsity scale up to production sizes. Taxids are taken from the installed
+# taxonomy database, so lineage resolution does real work. When the database has fewer taxa than
+# requested, unknown taxids are added (they exercise the merged/unknown-taxid path).
+# Counts are Poisson draws around a log-normal abundance per taxon. Every dataset is one group
+# of the metadata file.
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY not in sys.path:
+    sys.path.insert(0, REPOSITORY)
+
+SIZES = {
+    "small": {"num_taxa": 2_000, "num_samples": 20, "sparsity": 0.5},
+    "medium": {"num_taxa": 20_000, "num_samples": 100, "sparsity": 0.8},
+    "large": {"num_taxa": 100_000, "num_samples": 300, "sparsity": 0.9},
+    "production": {"num_taxa": 500_000, "num_samples": 1_000, "sparsity": 0.95},
+}
+# Rows written at once, limits the memory of the generator
+WRITE_ROWS = 50_000
+# First taxid used for taxids that are not in the database
+UNKNOWN_TAXIDS = 2_000_000_000
+
+
+def taxid_pool(limit, seed=0):
+    # Up to limit taxids of the installed taxonomy database, in random order
+    from Model.get_lineage import get_ncbi
+
+    taxonomy = get_ncbi()
+    if hasattr(taxonomy, "taxids"):
+        # A compiled taxonomy snapshot
+        taxids = np.asarray(taxonomy.taxids(), dtype=np.int64)
+    else:
+        taxids = np.array([row[0] for row in taxonomy.db.execute("SELECT taxid FROM species")], dtype=np.int64)
+    taxids = taxids[taxids > 1]
+    rng = np.random.default_rng(seed)
+    return rng.permutation(taxids)[:limit]
+
+
+def generate(directory, num_taxa, num_samples, sparsity=0.9, num_datasets=2, unknown=0.0, seed=0):
+    """
+        Writes num_datasets comparison files and a metadata file to directory.
+
+        Parameters
+        ----------
+        num_taxa : int
+            Taxa over all datasets (rows of the merged table). The first one is 'Not assigned' (-2).
+        num_samples : int
+            Samples over all datasets, split evenly.
+        sparsity : float
+            Share of empty cells.
+        unknown : float
+            Share of taxids that are not in the taxonomy database (at least, if the database is small).
+
+        Returns
+        -------
+        tuple
+            (list of dataset paths, metadata path)
+        """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    known = taxid_pool(int(round((num_taxa - 1) * (1 - unknown))), seed)
+    missing = num_taxa - 1 - len(known)
+    taxids = np.concatenate([[-2], known, UNKNOWN_TAXIDS + np.arange(missing)]).astype(np.int64)
+    # Mean reads of every taxon, a few very abundant ones and a long tail
+    abundance = rng.lognormal(mean=2.0, sigma=1.5, size=num_taxa)
+    abundance[0] = abundance.max()
+
+    paths, metadata = [], []
+    for dataset, samples in enumerate(np.array_split(np.arange(num_samples), num_datasets)):
+        group = f"Group{dataset + 1}"
+        names = [f"{group}_S{sample:04d}" for sample in samples]
+        metadata.extend((name, group, str(position)) for position, name in enumerate(names))
+        path = os.path.join(directory, f"dataset_{dataset + 1}.csv")
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write("\t".join(["Taxa"] + names) + "\n")
+            for start in range(0, num_taxa, WRITE_ROWS):
+                rows = slice(start, min(start + WRITE_ROWS, num_taxa))
+                counts = rng.poisson(abundance[rows, None], size=(rows.stop - start, len(samples)))
+                counts = counts.astype(np.float32)
+                counts[(rng.random(counts.shape) < sparsity) | (counts == 0)] = np.nan
+                block = pd.DataFrame(counts, columns=names)
+                block.insert(0, "Taxa", taxids[rows])
+                # Taxa without reads in this dataset are not listed, like in MEGAN exports
+                block = block[block[names].notna().any(axis=1)]
+                block.to_csv(handle, sep="\t", header=False, index=False, float_format="%.1f")
+        paths.append(path)
+
+    metadata_path = os.path.join(directory, "metadata.tsv")
+    pd.DataFrame(metadata, columns=["SampleID", "Group", "Property"]).to_csv(metadata_path, sep="\t", index=False)
+    return paths, metadata_path
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Writes synthetic comparison datasets.")
+    parser.add_argument("directory")
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--taxa", type=int, help="Overrides the number of taxa of the size")
+    parser.add_argument("--samples", type=int, help="Overrides the number of samples of the size")
+    parser.add_argument("--sparsity", type=float, help="Overrides the share of empty cells of the size")
+    parser.add_argument("--datasets", type=int, default=2)
+    parser.add_argument("--unknown", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(arguments)
+    size = dict(SIZES[args.size])
+    for key, value in (("num_taxa", args.taxa), ("num_samples", args.samples), ("sparsity", args.sparsity)):
+        if value is not None:
+            size[key] = value
+    paths, metadata_path = generate(args.directory, num_datasets=args.datasets, unknown=args.unknown,
+                                    seed=args.seed, **size)
+    print("\n".join(paths + [metadata_path]))
+
+
+if __name__ == "__main__":
+    main()
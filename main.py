@@ -1,12 +1,54 @@
-from Model.model import Model
-# from view import view
-from Controller.controller import Controller
+import argparse
 
-#model = Model()
-#view = View()
-#controller = Controller(model, view)
+from Controller.pipeline import DEFAULT_OPTIONS, run_pipeline
 
-# Some user input
-#user_input = ...
-#controller.manipulate(user_input)
+# Command-line entry point of the headless pipeline (see Controller/pipeline.py).
+# The GUI is started with View/app.py.
+#
+# Example:
+#   python main.py exports/ --metadata metadata.tsv --output results/ --workers 4
 
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Runs the statapp analysis on directories of MEGAN exports.")
+    parser.add_argument("input", help="Directory of MEGAN export files, or of one sub-directory per study")
+    parser.add_argument("--metadata", help="Tab-delimited file with the columns SampleID, Group and Property")
+    parser.add_argument("--output", default="results", help="Output directory (default: results)")
+    parser.add_argument("--workers", type=int, help="Number of studies analysed in parallel (default: all cores)")
+    parser.add_argument("--tests", nargs="+", default=DEFAULT_OPTIONS["tests"],
+                        choices=["t_test", "anova", "kruskal", "wilcoxon"], help="Differential abundance tests")
+    parser.add_argument("--correction", default=DEFAULT_OPTIONS["correction"],
+                        choices=["fdr_bh", "bonferroni", "none"], help="Multiple testing correction")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_OPTIONS["alpha"], help="Significance level")
+    parser.add_argument("--metric", default=DEFAULT_OPTIONS["metric"], help="Beta-diversity metric for PERMANOVA")
+    parser.add_argument("--permutations", type=int, default=DEFAULT_OPTIONS["permutations"])
+    parser.add_argument("--seed", type=int, default=DEFAULT_OPTIONS["seed"], help="Seed of the permutations")
+    parser.add_argument("--rank", default=DEFAULT_OPTIONS["rank"], help="Rank of the abundance table and plot")
+    parser.add_argument("--top", type=int, default=DEFAULT_OPTIONS["top"], help="Number of taxa in the top plot")
+    parser.add_argument("--no-figures", action="store_true", help="Skip the PNG figures")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    args = parse_arguments(arguments)
+    options = {
+        "tests": args.tests,
+        "correction": args.correction,
+        "alpha": args.alpha,
+        "metric": args.metric,
+        "permutations": args.permutations,
+        "seed": args.seed,
+        "rank": args.rank,
+        "top": args.top,
+        "figures": not args.no_figures,
+    }
+    summaries = run_pipeline(args.input, args.metadata, args.output, options, args.workers)
+    failed = [summary for summary in summaries if "failed" in summary]
+    for summary in summaries:
+        status = f"failed: {summary['failed']}" if "failed" in summary else "done"
+        print(f"{summary['study']}: {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
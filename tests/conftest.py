@@ -0,0 +1,22 @@
+import pytest
+
+from Model import get_lineage
+from Model.taxonomy_snapshot import FIXTURE, TaxonomySnapshot, compile_snapshot
+
+# Lineages are resolved against the snapshot of the fixture taxdump (Model/data/taxdump_fixture),
+# without ete3, its database or the network.
+
+
+@pytest.fixture(scope="session")
+def snapshot_dir(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("taxonomy"))
+    compile_snapshot(FIXTURE, directory)
+    return directory
+
+
+@pytest.fixture
+def resolver(snapshot_dir, monkeypatch):
+    # lineage_table() uses the module-wide resolver
+    resolver = get_lineage.LineageResolver(TaxonomySnapshot(snapshot_dir), cache_dir=None)
+    monkeypatch.setattr(get_lineage, "resolver", resolver)
+    return resolver
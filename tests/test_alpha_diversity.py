@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from skbio.diversity import alpha
+
+from Model import alpha_diversity
+from Model.sparse_counts import to_sparse
+
+# Alpha diversity against skbio, and the invariants of rarefaction on dense and sparse tables.
+
+
+def otu_table(sparse):
+    rng = np.random.default_rng(3)
+    counts = rng.poisson(2, size=(50, 7)).astype(np.float32)
+    counts[rng.random(counts.shape) < 0.3] = np.nan
+    counts[:, 6] = np.nan
+    counts[0, 6] = 3.0
+    table = pd.DataFrame(counts, index=[f"OTU{i}" for i in range(50)], columns=[f"S{i}" for i in range(7)])
+    return to_sparse(table) if sparse else table
+
+
+@pytest.fixture(params=[False, True], ids=["dense", "sparse"])
+def sparse(request):
+    return request.param
+
+
+def test_alpha_diversity_matches_skbio(sparse):
+    result = alpha_diversity.alpha_diversity(otu_table(sparse))
+    assert list(result.columns) == list(alpha_diversity.METRICS)
+    for sample, values in otu_table(False).items():
+        counts = np.nan_to_num(values.to_numpy(dtype=np.float64)).astype(int)
+        row = result.loc[sample]
+        assert row["observed"] == alpha.observed_features(counts)
+        assert row["shannon"] == pytest.approx(alpha.shannon(counts, base=np.e), abs=1e-12)
+        assert row["simpson"] == pytest.approx(alpha.simpson(counts), abs=1e-12)
+        assert row["chao1"] == pytest.approx(alpha.chao1(counts, bias_corrected=True))
+        if row["observed"] > 1:
+            assert row["pielou"] == pytest.approx(alpha.pielou_e(counts, base=np.e))
+        else:
+            assert np.isnan(row["pielou"])
+
+
+def test_rarefy(sparse):
+    table = otu_table(sparse)
+    counts = np.nan_to_num(otu_table(False).to_numpy(dtype=np.float64))
+    rarefied, samples = alpha_diversity.rarefy(table, 20, iterations=4, seed=0)
+    # The sample with 3 reads is left out
+    assert list(samples) == [f"S{i}" for i in range(6)]
+    assert rarefied.shape == (4, 6, 50)
+    assert (rarefied.sum(axis=2) == 20).all()
+    # Only OTUs with reads are drawn
+    assert not rarefied[:, counts[:, :6].T == 0].any()
+    np.testing.assert_array_equal(alpha_diversity.rarefy(otu_table(not sparse), 20, iterations=4, seed=0)[0],
+                                  rarefied)
+
+
+def test_rarefied_diversity(sparse, monkeypatch):
+    table = otu_table(sparse)
+    expected = alpha_diversity.rarefied_diversity(table, 20, iterations=30, seed=1)
+    assert expected.loc["S6"].isna().all()
+    # The same seed and blocks give the same result on dense and sparse tables and with any number of threads
+    monkeypatch.setattr(alpha_diversity, "WORKERS", 1)
+    pd.testing.assert_frame_equal(alpha_diversity.rarefied_diversity(otu_table(not sparse), 20, 30, seed=1),
+                                  expected)
+
+    # Blocks of a few samples and iterations cover every sample and iteration once
+    monkeypatch.setattr(alpha_diversity, "BLOCK_ELEMENTS", 100)
+    small_blocks = alpha_diversity.rarefied_diversity(table, 20, iterations=30, seed=1)
+    assert small_blocks.loc["S6"].isna().all()
+    assert (small_blocks.loc[:"S5", "observed"] <= 20).all()
+    stable = ["observed", "shannon", "simpson"]
+    np.testing.assert_allclose(small_blocks.loc[:"S5", stable], expected.loc[:"S5", stable], rtol=0.1)
+
+    # With one read per sample every rarefied sample has one OTU
+    one_read = alpha_diversity.rarefied_diversity(table, 1, iterations=5, seed=1)
+    assert (one_read["observed"] == 1).all()
+    assert (one_read["simpson"] == 0).all()
@@ -0,0 +1,125 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from Model import batch_stats
+from Model.microbiome_class import MicrobiomeDataAnalyzer
+from Model.sparse_counts import to_sparse
+
+# The batched tests against scipy.stats, one OTU at a time. Counts are positive float32 values, so NaN are
+# the only empty cells and the sparse table (float32, empty cells = NaN) holds the same values as the dense one.
+
+
+def otu_table(num_groups, group_size, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = [f"S{i}" for i in range(num_groups * group_size)]
+    shape = (40, len(samples))
+    # Continuous values without ties, Poisson counts with ties and Poisson counts with many missing values
+    counts = np.vstack([rng.gamma(2.0, 10.0, size=(10, shape[1])) + 1,
+                        rng.poisson(5, size=(20, shape[1])) + 1.0,
+                        rng.poisson(3, size=(10, shape[1])) + 1.0])
+    counts[10:30][rng.random((20, shape[1])) < 0.2] = np.nan
+    counts[30:][rng.random((10, shape[1])) < 0.6] = np.nan
+    groups = np.repeat([f"G{i}" for i in range(num_groups)], group_size)
+    metadata = pd.DataFrame({"SampleID": samples, "Group": groups, "Property": 0})
+    return pd.DataFrame(counts.astype(np.float32), index=[f"OTU{i}" for i in range(shape[0])], columns=samples), metadata
+
+
+def scipy_results(function, groups):
+    # Per-OTU reference: missing values are dropped from every group
+    statistic, p_value = [], []
+    for row in range(groups[0].shape[0]):
+        values = [group[row][~np.isnan(group[row])] for group in groups]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            try:
+                result = function(values)
+            except ValueError:
+                result = (np.nan, np.nan)
+        statistic.append(result[0])
+        p_value.append(result[1])
+    return np.array(statistic, dtype=float), np.array(p_value, dtype=float)
+
+
+def paired_wilcoxon(values):
+    # Pairs the remaining values by position, up to the length of the shorter group
+    num_pairs = min(len(values[0]), len(values[1]))
+    return stats.wilcoxon(values[0][:num_pairs], values[1][:num_pairs])
+
+
+CASES = [
+    ("t_test", 2, lambda values: stats.ttest_ind(*values)),
+    ("anova", 3, lambda values: stats.f_oneway(*values)),
+    ("kruskal", 3, lambda values: stats.kruskal(*values)),
+    ("wilcoxon", 2, paired_wilcoxon),
+]
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("test, num_groups, reference", CASES)
+def test_batched_tests_match_scipy(test, num_groups, reference, sparse):
+    # 20 samples per group: the Wilcoxon test uses the exact, the permutation and the normal p-values
+    table, metadata = otu_table(num_groups, 20)
+    _, dense_groups = batch_stats.split_groups(table, metadata)
+    _, groups = batch_stats.split_groups(to_sparse(table) if sparse else table, metadata)
+
+    statistic, p_value = batch_stats.TESTS[test](groups)
+    expected_statistic, expected_p_value = scipy_results(reference, dense_groups)
+    np.testing.assert_allclose(statistic, expected_statistic, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(p_value, expected_p_value, rtol=1e-7, atol=1e-12)
+
+
+def test_wilcoxon_pairs_after_dropping_missing_values():
+    group1 = np.array([[1.0, np.nan, 3.0, 7.0, 2.0]])
+    group2 = np.array([[np.nan, 2.0, 5.0, 1.0, np.nan]])
+    differences = batch_stats._paired_differences(group1, group2)
+    np.testing.assert_array_equal(differences, [[-1.0, -2.0, 6.0, np.nan, np.nan]])
+
+
+def test_split_groups_of_sparse_tables():
+    table, metadata = otu_table(2, 5)
+    names, dense = batch_stats.split_groups(table, metadata)
+    sparse_names, sparse_groups = batch_stats.split_groups(to_sparse(table), metadata)
+    assert names == sparse_names == ["G0", "G1"]
+    for dense_group, sparse_group in zip(dense, sparse_groups):
+        np.testing.assert_array_equal(batch_stats._densify(sparse_group), dense_group)
+
+
+def test_adjust_pvalues():
+    p_values = [0.01, np.nan, 0.04, 0.03, 0.5]
+    np.testing.assert_allclose(batch_stats.adjust_pvalues(p_values, 'fdr_bh'), [0.04, np.nan, 0.16 / 3, 0.16 / 3, 0.5])
+    np.testing.assert_allclose(batch_stats.adjust_pvalues(p_values, 'bonferroni'), [0.04, np.nan, 0.16, 0.12, 1.0])
+    np.testing.assert_allclose(batch_stats.adjust_pvalues(p_values, 'none'), p_values)
+    with pytest.raises(ValueError):
+        batch_stats.adjust_pvalues(p_values, 'holm')
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_prefilter_and_testable(sparse):
+    table = pd.DataFrame([[1.0, 2.0, np.nan, 4.0],    # kept
+                          [5.0, np.nan, np.nan, np.nan],  # found in one sample only
+                          [1.0, 1.0, np.nan, np.nan],  # too few reads
+                          [3.0, 3.0, 3.0, 3.0]],  # same value everywhere
+                         index=["a", "b", "c", "d"], columns=["S0", "S1", "S2", "S3"], dtype=np.float32)
+    metadata = pd.DataFrame({"SampleID": table.columns, "Group": ["x", "x", "y", "y"], "Property": 0})
+    if sparse:
+        table = to_sparse(table)
+    np.testing.assert_array_equal(batch_stats.prefilter(table, 2, 3.0), [True, False, False, True])
+    _, groups = batch_stats.split_groups(table, metadata)
+    # b and c have an empty group, d is constant
+    np.testing.assert_array_equal(batch_stats.testable('t_test', groups), [True, False, False, False])
+
+
+def test_differential_abundance_table():
+    table, metadata = otu_table(2, 20)
+    table.iloc[0] = 5.0
+    analyzer = MicrobiomeDataAnalyzer(table, None, metadata)
+    result = analyzer.differential_abundance('t_test', 'fdr_bh', alpha=0.05)
+    assert "OTU0" not in result.index
+    assert len(result) == len(table) - 1
+    assert result['qvalue'].is_monotonic_increasing
+    np.testing.assert_allclose(result['qvalue'], batch_stats.adjust_pvalues(result['pvalue']))
+    assert (result['significant'] == (result['qvalue'] <= 0.05)).all()
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import pdist, squareform
+
+from Model import distances
+from Model.microbiome_class import MicrobiomeDataAnalyzer
+from Model.sparse_counts import to_sparse
+
+# The distance metrics against scipy.spatial.distance.pdist on the counts (empty cells = 0 reads).
+# UniFrac is compared with the same distances on the read shares below every branch of the taxonomy.
+
+
+def otu_table(sparse):
+    rng = np.random.default_rng(1)
+    counts = rng.poisson(4, size=(30, 8)).astype(np.float32)
+    counts[rng.random(counts.shape) < 0.4] = np.nan
+    table = pd.DataFrame(counts, index=[f"OTU{i}" for i in range(30)], columns=[f"S{i}" for i in range(8)])
+    return to_sparse(table) if sparse else table
+
+
+def taxa_table():
+    otus = [f"OTU{i}" for i in range(30)]
+    taxa = pd.DataFrame({"Phylum": ["P0", "P1", "P2"] * 10,
+                         "Genus": [f"G{i % 6}" for i in range(30)]}, index=otus)
+    taxa.loc["OTU0", "Genus"] = None
+    taxa.loc["OTU1"] = None
+    return taxa
+
+
+def counts(table):
+    # Samples x OTUs
+    return np.nan_to_num(table.sparse.to_dense().to_numpy(dtype=np.float64) if hasattr(table, "sparse")
+                         else table.to_numpy(dtype=np.float64)).T
+
+
+def branch_shares(table, taxa):
+    # Read share of every sample below every branch: the lineage prefixes and the OTUs themselves
+    values = counts(table)
+    shares = values / values.sum(axis=1, keepdims=True)
+    branches = {}
+    for otu, lineage in taxa.iterrows():
+        names = [name for name in lineage if name is not None and not pd.isna(name)]
+        for depth in range(1, len(names) + 1):
+            branches.setdefault(tuple(names[:depth]), []).append(table.index.get_loc(otu))
+    columns = [shares[:, rows].sum(axis=1) for rows in branches.values()]
+    return np.column_stack([shares] + columns)
+
+
+@pytest.fixture(params=[False, True], ids=["dense", "sparse"])
+def sparse(request, monkeypatch):
+    # Small blocks, so the sums of minima are computed in several blocks
+    monkeypatch.setattr(distances, "BLOCK_ELEMENTS", 100)
+    return request.param
+
+
+def test_metrics_match_pdist(sparse):
+    table = otu_table(sparse)
+    values = counts(table)
+    logs = np.log(values + 1.0)
+    clr = logs - logs.mean(axis=1, keepdims=True)
+    expected = {
+        "braycurtis": pdist(values, "braycurtis"),
+        "jaccard": pdist(values > 0, "jaccard"),
+        "aitchison": pdist(clr, "euclidean"),
+    }
+    for metric, distance in expected.items():
+        result = distances.beta_diversity(table, metric)
+        assert list(result.ids) == list(table.columns)
+        np.testing.assert_allclose(result.data, squareform(distance), atol=1e-10, err_msg=metric)
+
+
+def test_unifrac_matches_branch_shares(sparse):
+    table, taxa = otu_table(sparse), taxa_table()
+    shares = branch_shares(table, taxa)
+    np.testing.assert_allclose(distances.beta_diversity(table, "weighted_unifrac", taxa).data,
+                               squareform(pdist(shares, "cityblock")), atol=1e-10)
+    np.testing.assert_allclose(distances.beta_diversity(table, "unweighted_unifrac", taxa).data,
+                               squareform(pdist(shares > 0, "jaccard")), atol=1e-10)
+
+
+@pytest.mark.parametrize("metric", list(distances.METRICS))
+def test_rows_of_some_samples(sparse, metric):
+    table, taxa = otu_table(sparse), taxa_table()
+    args = (taxa,) if metric in distances.UNIFRAC_METRICS else ()
+    full = distances.METRICS[metric](table, *args)
+    np.testing.assert_allclose(distances.METRICS[metric](table, *args, columns=np.array([2, 5])),
+                               full[[2, 5]], atol=1e-10)
+
+
+def test_distances_are_memoized():
+    analyzer = MicrobiomeDataAnalyzer(otu_table(False), taxa_table(), None)
+    distance = analyzer.beta_diversity("braycurtis")
+    assert analyzer.beta_diversity("braycurtis") is distance
+    assert analyzer.cached_distances() == {"braycurtis": distance}
+    assert analyzer.beta_diversity("braycurtis", min_prevalence=3) is not distance
+    with pytest.raises(ValueError):
+        distances.beta_diversity(otu_table(False), "weighted_unifrac")
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Model import distances
+from Model.get_lineage import lineage_table
+from Model.microbiome_class import MicrobiomeDataAnalyzer
+from Model.modificator import merge_data, otu_index
+from Model.sparse_counts import to_dense
+
+# Adding and removing samples updates the cached results incrementally (see MicrobiomeDataAnalyzer.add_samples).
+# The results must equal those of an analyzer built from scratch with the same samples.
+
+FIRST = pd.DataFrame({"Taxa": [562, 817, 1385, 186803],
+                      "A1": [10.0, 3.0, np.nan, 7.0], "A2": [4.0, np.nan, 2.0, 1.0], "A3": [np.nan, 8.0, 5.0, 2.0],
+                      "A4": [6.0, 1.0, 1.0, np.nan]})
+# 562 and 817 are known OTUs, 820 and 12333 (merged into 10239) are new
+SECOND = pd.DataFrame({"Taxa": [562, 820, 817, 12333],
+                       "B1": [2.0, 9.0, np.nan, 4.0], "B2": [np.nan, 3.0, 6.0, 1.0], "B3": [5.0, 5.0, 2.0, np.nan]})
+RESULTS = list(distances.METRICS)
+
+
+def metadata(samples):
+    return pd.DataFrame({"SampleID": samples, "Group": [sample[0] for sample in samples], "Property": 0})
+
+
+def build(datasets, sparse):
+    merged = merge_data(datasets)
+    taxids = merged.pop("Taxa").astype(np.int64)
+    merged.index = taxids.index = otu_index(len(merged))
+    return MicrobiomeDataAnalyzer(merged, lineage_table(taxids), metadata(list(merged.columns)), sparse=sparse,
+                                  taxids=taxids)
+
+
+def by_taxid(analyzer):
+    # Dense OTU table indexed by taxid, in taxid order, so tables with different OTU orders can be compared
+    table = to_dense(analyzer.OTU_table).astype(np.float64).fillna(0.0)
+    return table.set_axis(analyzer.Taxa_ids.reindex(table.index).to_numpy()).sort_index()
+
+
+def assert_same_results(analyzer, fresh):
+    pd.testing.assert_frame_equal(by_taxid(analyzer), by_taxid(fresh))
+    cached = analyzer.cached_distances()
+    assert sorted(cached) == sorted(RESULTS)
+    for metric in RESULTS:
+        expected = fresh.beta_diversity(metric)
+        assert list(cached[metric].ids) == list(expected.ids)
+        np.testing.assert_allclose(cached[metric].data, expected.data, atol=1e-10, err_msg=metric)
+    cube, fresh_cube = analyzer._current_rank_cube(), fresh.rank_cube()
+    assert cube is not None
+    for rank in fresh_cube.ranks:
+        pd.testing.assert_frame_equal(cube.rank_sums(rank), fresh_cube.rank_sums(rank), check_dtype=False)
+    pd.testing.assert_series_equal(cube.sample_totals, fresh_cube.sample_totals, check_dtype=False)
+    pd.testing.assert_frame_equal(analyzer.alpha_diversity(), fresh.alpha_diversity())
+
+
+def warm(analyzer):
+    for metric in RESULTS:
+        analyzer.beta_diversity(metric)
+    analyzer.rank_cube()
+
+
+@pytest.mark.parametrize("sparse", [False, True], ids=["dense", "sparse"])
+@pytest.mark.filterwarnings("ignore::Model.get_lineage.LineageWarning")
+def test_add_and_remove_samples(resolver, sparse):
+    analyzer = build([FIRST], sparse)
+    warm(analyzer)
+
+    assert analyzer.add_samples([SECOND], metadata(["B1", "B2", "B3"])) == ["B1", "B2", "B3"]
+    assert list(analyzer.Metadata["SampleID"]) == ["A1", "A2", "A3", "A4", "B1", "B2", "B3"]
+    assert_same_results(analyzer, build([FIRST, SECOND], sparse))
+
+    analyzer.remove_samples(["A2", "B2"])
+    fresh = build([FIRST.drop(columns="A2"), SECOND.drop(columns="B2")], sparse)
+    assert list(analyzer.Metadata["SampleID"]) == ["A1", "A3", "A4", "B1", "B3"]
+    assert_same_results(analyzer, fresh)
+
+
+@pytest.mark.filterwarnings("ignore::Model.get_lineage.LineageWarning")
+def test_changes_are_not_hashed_twice(resolver, monkeypatch):
+    analyzer = build([FIRST], False)
+    warm(analyzer)
+    hashed = []
+    fingerprint = distances.fingerprint
+    monkeypatch.setattr(distances, "fingerprint", lambda frame: hashed.append(frame.shape) or fingerprint(frame))
+    analyzer.add_samples([SECOND])
+    analyzer.remove_samples(["B1"])
+    warm(analyzer)
+    # Only the new lineages and the counts of the new samples, never the whole tables
+    assert hashed == [(2, 7), (6, 3)]
+
+
+def test_invalid_changes(resolver):
+    analyzer = build([FIRST], False)
+    with pytest.raises(ValueError):
+        analyzer.add_samples([FIRST])
+    with pytest.raises(ValueError):
+        analyzer.remove_samples(["C1"])
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from skbio.stats.distance import DistanceMatrix, anosim, permanova, permdisp
+
+from Model import permutation_tests
+
+# The batched permutation tests against skbio. The statistics do not depend on the permutations;
+# the p-values depend on the seed only, not on the number of processes.
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(2)
+    points = rng.normal(size=(24, 3))
+    grouping = np.repeat(["a", "b", "c"], 8)
+    points[grouping == "b"] += 0.8
+    points[grouping == "c"] *= 1.5
+    distances = np.sqrt(((points[:, None] - points[None, :]) ** 2).sum(axis=2))
+    return DistanceMatrix(distances, ids=[f"S{i}" for i in range(24)]), grouping
+
+
+TESTS = [
+    (permutation_tests.permanova, lambda matrix, grouping: permanova(matrix, grouping, permutations=0)),
+    (permutation_tests.anosim, lambda matrix, grouping: anosim(matrix, grouping, permutations=0)),
+    (permutation_tests.permdisp,
+     lambda matrix, grouping: permdisp(matrix, grouping, test="centroid", permutations=0)),
+]
+
+
+@pytest.mark.parametrize("test, reference", TESTS)
+def test_statistics_match_skbio(data, test, reference):
+    result, expected = test(*data, permutations=99, seed=0), reference(*data)
+    assert result["method name"] == expected["method name"]
+    assert result["test statistic name"] == expected["test statistic name"]
+    assert result["sample size"] == expected["sample size"] == 24
+    assert result["number of groups"] == expected["number of groups"] == 3
+    assert result["test statistic"] == pytest.approx(expected["test statistic"], rel=1e-9)
+
+
+@pytest.mark.parametrize("test", [permutation_tests.permanova, permutation_tests.anosim])
+def test_p_values_do_not_depend_on_the_workers(data, test):
+    inline = test(*data, permutations=499, seed=7, workers=1)
+    parallel = test(*data, permutations=499, seed=7, workers=2)
+    assert inline["p-value"] == parallel["p-value"]
+    assert inline["number of permutations"] == parallel["number of permutations"] == 499
+    assert test(*data, permutations=499, seed=8, workers=1)["number of permutations"] == 499
+
+
+def test_early_stopping(data):
+    # The p-value (about 0.24) is confidently above alpha long before 9999 permutations
+    result = permutation_tests.permanova(*data, permutations=9999, seed=0, workers=1, alpha=0.05)
+    assert result["number of permutations"] < 9999
+    assert result["p-value"] > 0.05
+    # Early stopping is reproducible with the process pool as well
+    parallel = permutation_tests.permanova(*data, permutations=9999, seed=0, workers=2, alpha=0.05)
+    assert parallel["number of permutations"] == result["number of permutations"]
+    assert parallel["p-value"] == result["p-value"]
+
+
+def test_invalid_groupings(data):
+    matrix, _ = data
+    with pytest.raises(ValueError):
+        permutation_tests.permanova(matrix, ["a"] * 24)
+    with pytest.raises(ValueError):
+        permutation_tests.anosim(matrix, [str(i) for i in range(24)])
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Model import distances
+from Model.microbiome_class import MicrobiomeDataAnalyzer
+from Model.project import load_project, save_project
+from Model.sparse_counts import to_dense
+
+# Saving and loading projects (Model/project.py)
+
+
+def analyzer(sparse):
+    rng = np.random.default_rng(0)
+    counts = rng.poisson(3, size=(12, 6)).astype(np.float32)
+    counts[rng.random(counts.shape) < 0.3] = np.nan
+    otus = [f"OTU{i}" for i in range(12)]
+    samples = [f"S{i}" for i in range(6)]
+    taxa = pd.DataFrame({"Phylum": ["Firmicutes", "Bacteroidetes"] * 6,
+                         "Genus": [f"Genus{i % 4}" for i in range(12)]}, index=otus)
+    metadata = pd.DataFrame({"SampleID": samples, "Group": ["a", "b"] * 3, "Property": [0] * 6})
+    return MicrobiomeDataAnalyzer(pd.DataFrame(counts, index=otus, columns=samples), taxa, metadata, sparse=sparse)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("mmap", [False, True])
+def test_round_trip(tmp_path, sparse, mmap):
+    saved = analyzer(sparse)
+    saved.beta_diversity("braycurtis")
+    save_project(str(tmp_path), saved)
+
+    loaded, matrices = load_project(str(tmp_path), mmap=mmap)
+    assert list(loaded.OTU_table.dtypes) == list(saved.OTU_table.dtypes)
+    pd.testing.assert_frame_equal(to_dense(loaded.OTU_table), to_dense(saved.OTU_table), check_dtype=False)
+    assert (loaded.Taxa_table.astype(str) == saved.Taxa_table.astype(str)).all().all()
+    np.testing.assert_array_equal(matrices["braycurtis"].data, saved.beta_diversity("braycurtis").data)
+
+
+def test_load_does_not_hash_the_tables(tmp_path, monkeypatch):
+    saved = analyzer(True)
+    distance = saved.beta_diversity("braycurtis")
+    save_project(str(tmp_path), saved)
+
+    monkeypatch.setattr(distances, "fingerprint", lambda frame: pytest.fail("table hashed on load"))
+    loaded, _ = load_project(str(tmp_path))
+    # The stored distance matrix is found under the saved fingerprint
+    assert loaded.beta_diversity("braycurtis") is loaded.cached_distances()["braycurtis"]
+    np.testing.assert_array_equal(loaded.beta_diversity("braycurtis").data, distance.data)
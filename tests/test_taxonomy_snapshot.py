@@ -0,0 +1,98 @@
+import warnings
+
+import pandas as pd
+import pytest
+
+from Model import get_lineage
+from Model.taxonomy_snapshot import TaxonomySnapshot, compile_snapshot, is_snapshot
+
+# Lineage resolution against the snapshot of the fixture taxdump (Model/data/taxdump_fixture),
+# without ete3, its database or the network (fixtures in conftest.py).
+
+ESCHERICHIA_COLI = ("Bacteria", "Proteobacteria", "Gammaproteobacteria", "Enterobacterales",
+                    "Enterobacteriaceae", "Escherichia", "Escherichia coli")
+BACTEROIDES_FRAGILIS = ("Bacteria", "Bacteroidetes", "Bacteroidia", "Bacteroidales",
+                        "Bacteroidaceae", "Bacteroides", "Bacteroides fragilis")
+VIRUSES = ("Viruses", None, None, None, None, None, None)
+
+
+def rows(table):
+    return [tuple(None if pd.isna(name) else name for name in row) for row in table.itertuples(index=False)]
+
+
+def test_compiled_snapshot(snapshot_dir):
+    snapshot = TaxonomySnapshot(snapshot_dir)
+    assert is_snapshot(snapshot_dir)
+    assert snapshot.get_lineage(562) == [1, 131567, 2, 1224, 1236, 91347, 543, 561, 562]
+    assert snapshot.get_lineage(12333) == [1, 10239]
+    assert snapshot.get_rank([561, 562]) == {561: "genus", 562: "species"}
+    assert snapshot.get_taxid_translator([562]) == {562: "Escherichia coli"}
+    assert snapshot.get_name_translator(["Escherichia coli"]) == {"Escherichia coli": [562]}
+    with pytest.raises(ValueError):
+        snapshot.get_lineage(999999)
+
+
+def test_lineage_table_of_known_taxids(resolver):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", get_lineage.LineageWarning)
+        table = get_lineage.lineage_table(pd.Series([562, 817, -2]))
+    assert list(table.columns) == get_lineage.RANKS
+    assert rows(table) == [ESCHERICHIA_COLI, BACTEROIDES_FRAGILIS, ("Not assigned",) + (None,) * 6]
+    assert table.attrs["unresolved"] == []
+    assert table.attrs["merged"] == {}
+    assert table.attrs["taxids"]["Escherichia"] == 561
+    assert table.attrs["taxids"]["Escherichia coli"] == 562
+
+
+def test_lineage_table_of_merged_taxid(resolver):
+    with pytest.warns(get_lineage.LineageWarning, match="merged"):
+        table = get_lineage.lineage_table(pd.Series([12333]))
+    assert rows(table) == [VIRUSES]
+    assert table.attrs["merged"] == {12333: 10239}
+    assert table.attrs["unresolved"] == []
+
+
+def test_lineage_table_of_unknown_taxids(resolver):
+    with pytest.warns(get_lineage.LineageWarning, match="could not be resolved"):
+        table = get_lineage.lineage_table(pd.Series([0, 562, 999999]))
+    assert rows(table) == [(None,) * 7, ESCHERICHIA_COLI, (None,) * 7]
+    assert table.attrs["unresolved"] == [0, 999999]
+
+
+def test_lineage_table_keeps_one_row_per_taxid(resolver):
+    taxids = pd.Series([562, 999999, 562, 12333, -2], index=["OTU4", "OTU3", "OTU2", "OTU1", "OTU0"])
+    with pytest.warns(get_lineage.LineageWarning):
+        table = get_lineage.lineage_table(taxids)
+    assert list(table.index) == list(taxids.index)
+    assert rows(table) == [ESCHERICHIA_COLI, (None,) * 7, ESCHERICHIA_COLI, VIRUSES,
+                           ("Not assigned",) + (None,) * 6]
+
+
+def test_unresolved_taxids_are_cached(snapshot_dir, tmp_path):
+    resolver = get_lineage.LineageResolver(TaxonomySnapshot(snapshot_dir), cache_dir=str(tmp_path))
+    assert set(resolver.resolve([562, 999999])) == {562}
+
+    # A new resolver reads both from the cache file and does not query the taxonomy again
+    cached = get_lineage.LineageResolver(TaxonomySnapshot(snapshot_dir), cache_dir=str(tmp_path))
+    cached._query = lambda taxids: pytest.fail(f"queried {taxids}")
+    assert set(cached.resolve([562, 999999])) == {562}
+
+
+def test_major_lineages_use_the_highest_node_of_a_rank(tmp_path):
+    # Two nested genera (and two nested superkingdoms): the column gets the higher one
+    source = tmp_path / "taxdump"
+    source.mkdir()
+    nodes = [(1, 1, "no rank"), (2, 1, "superkingdom"), (3, 2, "superkingdom"), (10, 3, "genus"),
+             (11, 10, "genus"), (12, 11, "species")]
+    names = {1: "root", 2: "Outer", 3: "Inner", 10: "Upper", 11: "Lower", 12: "Lower species"}
+    (source / "nodes.dmp").write_text("".join(f"{node}\t|\t{parent}\t|\t{rank}\t|\t\t|\t0\t|\n"
+                                              for node, parent, rank in nodes))
+    (source / "names.dmp").write_text("".join(f"{node}\t|\t{name}\t|\t\t|\tscientific name\t|\n"
+                                              for node, name in names.items()))
+    (source / "merged.dmp").write_text("")
+    compile_snapshot(str(source), str(tmp_path / "snapshot"))
+
+    lineages = TaxonomySnapshot(str(tmp_path / "snapshot")).major_lineages([12, 11], get_lineage.MAJOR_RANKS)
+    assert lineages[12] == (["Outer", None, None, None, None, "Upper", "Lower species"],
+                            [2, None, None, None, None, 10, 12])
+    assert lineages[11][1] == [2, None, None, None, None, 10, None]